@@ -0,0 +1,686 @@
+#!/usr/bin/env python
+# gridbug benchmarks
+# -*- coding: utf-8 -*-
+"""
+ Benchmarks for the gridbug service
+
+ Author: Jason A. Cox
+ For more information see https://github.com/jasonacox/gridbug
+
+ Command line: python bench.py [benchmark] [sizes]
+      [benchmark] is one of:
+          ingest  - time for updategraph() to ingest one cycle of payloads
+          gossip  - bytes and CPU of full versus delta bug list exchange
+          http    - requests/s and latency of the asyncio and thread API servers
+          wire    - bytes and encode/decode CPU of JSON and compact bug lists
+          probe   - round-trip time and CPU of http, tcp and udp probes
+          grid    - convergence, CPU, memory and traffic of a simulated grid
+          partitions - cost of keeping partitions current as links change
+          alerts  - alert debounce cost and delivery to a local webhook receiver
+          buglist - time to load a bug list and apply a changed one in place
+      [sizes] is an optional comma separated list of grid sizes
+              (concurrent clients for http, probes per method for probe,
+              edges changing color for alerts)
+
+"""
+# Modules
+from __future__ import print_function
+import contextlib
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import requests
+import requests.adapters
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import zlib
+from urllib.parse import urlsplit
+
+# gridbug.py configures itself from the environment on import
+os.environ["GRIDBUGCONF"] = ""
+os.environ.setdefault("GB_ID", "node0")
+os.environ.setdefault("GB_NODEURL", "localhost:8777")
+os.environ.setdefault("GB_GRIDKEY", "benchmark")
+import gridbug
+
+SIZES = [10, 50, 100, 250, 500, 1000]
+CLIENTS = [1, 8, 32, 128]
+WIRESIZES = [100, 1000, 10000]
+PROBES = [2000]
+GRIDSIZES = [10, 50, 100]
+ALERTSIZES = [100, 1000, 10000]
+BUGLISTSIZES = [1000, 5000, 20000]
+DURATION = 3        # seconds of load per http run
+GRIDPOLL = 2        # GB_POLL of simulated nodes, raised by 1s per 5 nodes
+GRIDLIMIT = 30      # poll cycles to wait for a simulated grid to converge
+
+def makegrid(n):
+    """
+    Build the payloads every node of an n node grid would send in one cycle
+    """
+    ids = ["node%d" % i for i in range(n)]
+    entries = [{"host": "%s:8777" % i, "id": i, "alive": True} for i in ids]
+    return [{"node_id": i, "node_host": "%s:8777" % i, "gridbugs": entries} for i in ids]
+
+def resetgrid():
+    gridbug.state = gridbug.GridState({"version": 1, "gridbugs": []})
+
+def bench_ingest(sizes):
+    """
+    Ingest time against grid size - one payload per node, N entries each
+    """
+    print("%8s %10s %12s %12s %14s" % ("nodes", "edges", "cold (ms)", "steady (ms)", "per entry (us)"))
+    for n in sizes:
+        payloads = makegrid(n)
+        resetgrid()
+        start = time.perf_counter()
+        for p in payloads:
+            gridbug.updategraph(p)
+        cold = time.perf_counter() - start
+        for p in payloads:
+            gridbug.updategraph(p)
+        start = time.perf_counter()
+        for p in payloads:
+            gridbug.updategraph(p)
+        steady = time.perf_counter() - start
+        print("%8d %10d %12.1f %12.1f %14.2f" % (n, len(gridbug.state.graph.edges),
+            cold * 1000, steady * 1000, steady * 1e6 / (n * n)))
+
+def loadgrid(n):
+    """
+    Install an n node bug list as this node's own, as loadbugs() would
+    """
+    bugs = {"version": 1, "node_id": "node0", "node_host": "node0:8777",
+        "node_role": "node", "node_build": gridbug.BUILD, "gridbugs":
+        [{"host": "node%d:8777" % i, "id": "node%d" % i, "alive": True} for i in range(n)]}
+    gridbug.state = gridbug.GridState(bugs)
+
+def bench_gossip(sizes, rounds=20, churn=0.01):
+    """
+    Bytes and encode/decode time per exchange for a steady grid where
+    `churn` of the links change state between exchanges
+    """
+    print("%8s %12s %12s %10s %12s %12s %10s" % ("nodes", "full (B)", "delta (B)", "ratio",
+        "full (us)", "delta (us)", "ratio"))
+    random.seed(1)
+    for n in sizes:
+        loadgrid(n)
+        fullbytes = deltabytes = 0
+        fulltime = deltatime = 0.0
+        grid = gridbug.state
+        for r in range(rounds):
+            since = grid.bugs["generation"]
+            for bug in random.sample(grid.bugs["gridbugs"], max(1, int(n * churn))):
+                grid.setalive(bug, not bug["alive"])
+            start = time.perf_counter()
+            data = json.dumps(grid.bugpayload())
+            json.loads(data)
+            fulltime += time.perf_counter() - start
+            fullbytes += len(data)
+            start = time.perf_counter()
+            data = json.dumps(grid.bugpayload(since))
+            json.loads(data)
+            deltatime += time.perf_counter() - start
+            deltabytes += len(data)
+        print("%8d %12d %12d %9.1fx %12.1f %12.1f %9.1fx" % (n, fullbytes / rounds,
+            deltabytes / rounds, fullbytes / deltabytes, fulltime * 1e6 / rounds,
+            deltatime * 1e6 / rounds, fulltime / deltatime))
+
+def bench_partitions(sizes, rounds=50):
+    """
+    Time to keep partitions current on a full mesh of N nodes (N*(N-1)
+    green edges) when a link flaps inside the component, when a link is
+    lost and the component must be checked for a split, and when a
+    partitioned node rejoins and components merge
+    """
+    print("%8s %10s %12s %12s %12s %12s" % ("nodes", "edges", "build (ms)", "flap (us)",
+        "split (ms)", "merge (ms)"))
+    random.seed(1)
+    for n in sizes:
+        ids = ["node%d" % i for i in range(n)]
+        parts = gridbug.Partitions()
+        start = time.perf_counter()
+        for s in ids:
+            parts.addnode(s)
+            for t in ids:
+                if s != t:
+                    parts.edge(s, t, True)
+        parts.resolve()
+        build = time.perf_counter() - start
+        flap = split = merge = 0.0
+        for r in range(rounds):
+            s, t = random.sample(ids, 2)
+            # Lost and restored within one ingest batch - stays one component
+            start = time.perf_counter()
+            parts.edge(s, t, False)
+            parts.edge(s, t, True)
+            parts.resolve()
+            flap += time.perf_counter() - start
+            # Cut every link out of one node - the component splits
+            start = time.perf_counter()
+            for t in ids:
+                if t != s:
+                    parts.edge(s, t, False)
+            parts.resolve()
+            split += time.perf_counter() - start
+            assert len(parts.members) == 2
+            # Restore them - the components merge again
+            start = time.perf_counter()
+            for t in ids:
+                if t != s:
+                    parts.edge(s, t, True)
+            parts.resolve()
+            merge += time.perf_counter() - start
+            assert len(parts.members) == 1
+        print("%8d %10d %12.1f %12.1f %12.2f %12.2f" % (n, n * (n - 1), build * 1000,
+            flap * 1e6 / rounds, split * 1000 / rounds, merge * 1000 / rounds))
+
+def timed(fn, arg, rounds):
+    start = time.perf_counter()
+    for r in range(rounds):
+        result = fn(arg)
+    return result, (time.perf_counter() - start) * 1000 / rounds
+
+def bench_wire(sizes, rounds=5):
+    """
+    Bytes on the wire and encode/decode time of a full bug list as JSON,
+    zlib compressed JSON and the compact wire format
+    """
+    if sizes is SIZES:
+        sizes = WIRESIZES
+    print("%8s %8s %12s %12s %12s" % ("nodes", "format", "bytes", "encode (ms)", "decode (ms)"))
+    random.seed(1)
+    for n in sizes:
+        loadgrid(n)
+        grid = gridbug.state
+        for bug in grid.bugs["gridbugs"]:
+            ring = gridbug.RttRing()
+            for i in range(8):
+                ring.add(random.uniform(1, 50) if random.random() > 0.05 else None)
+            bug["latency"] = ring.summary()
+            grid.bumpgeneration(bug)
+        payload = grid.bugpayload()
+        formats = [
+            ("json", json.dumps, json.loads),
+            ("json+z", lambda p: zlib.compress(json.dumps(p).encode("utf8"), 6),
+                lambda d: json.loads(zlib.decompress(d))),
+            ("compact", gridbug.encodebugs, gridbug.decodebugs)]
+        for name, encode, decode in formats:
+            data, enctime = timed(encode, payload, rounds)
+            decoded, dectime = timed(decode, data, rounds)
+            assert len(decoded["gridbugs"]) == n
+            print("%8d %8s %12d %12.2f %12.2f" % (n, name, len(data), enctime, dectime))
+
+def serve(kind, port, n):
+    """
+    Run an API server and UDP echo listener over an n node graph - target
+    of a child process
+    """
+    threading.Thread(target=gridbug.udpecho, args=(port,), daemon=True).start()
+    resetgrid()
+    for p in makegrid(n):
+        gridbug.updategraph(p)
+    if kind == "thread":
+        gridbug.api(port)
+    else:
+        gridbug.AsyncAPI(port).run()
+
+def cputime(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+def loadclient(port, keepalive, deadline, payloads, results):
+    """
+    Send a gossip heavy mix of requests until deadline - 4 posts to
+    every /graph or /stats read
+    """
+    conn = None
+    count = 0
+    while time.time() < deadline:
+        if conn is None:
+            conn = http.client.HTTPConnection("localhost", port, timeout=10)
+        count += 1
+        start = time.perf_counter()
+        try:
+            if count % 5 == 0:
+                conn.request("GET", "/graph" if count % 10 else "/stats")
+            else:
+                conn.request("POST", "/post", random.choice(payloads),
+                    {"key": gridbug.GRIDKEY, "Content-Type": "application/json"})
+            conn.getresponse().read()
+            results.append(time.perf_counter() - start)
+        except (OSError, http.client.HTTPException):
+            results.append(None)
+            conn.close()
+            conn = None
+            continue
+        if not keepalive:
+            conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+
+def startserver(kind, nodes):
+    """
+    Start an API server in a child process and wait for it to answer
+    """
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+    server = multiprocessing.get_context("fork").Process(target=serve,
+        args=(kind, port, nodes), daemon=True)
+    server.start()
+    for i in range(100):
+        try:
+            conn = http.client.HTTPConnection("localhost", port, timeout=1)
+            conn.request("GET", "/ping")
+            conn.getresponse().read()
+            conn.close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return server, port
+
+def bench_http(sizes, nodes=100):
+    """
+    Load test the asyncio and thread API servers with concurrent clients,
+    over keep-alive connections and a new connection per request
+    """
+    if sizes is SIZES:
+        sizes = CLIENTS
+    payloads = [json.dumps(p) for p in makegrid(nodes)]
+    print("%8s %8s %11s %10s %10s %10s %8s %12s" % ("server", "clients", "connection",
+        "req/s", "p50 (ms)", "p99 (ms)", "errors", "cpu/1k (ms)"))
+    for kind in ("asyncio", "thread"):
+        for keepalive in (True, False):
+            for clients in sizes:
+                server, port = startserver(kind, nodes)
+                results = []
+                cpu = cputime(server.pid)
+                deadline = time.time() + DURATION
+                threads = [threading.Thread(target=loadclient,
+                    args=(port, keepalive, deadline, payloads, results)) for i in range(clients)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                cpu = cputime(server.pid) - cpu
+                server.kill()
+                server.join()
+                times = sorted(r for r in results if r is not None)
+                errors = len(results) - len(times)
+                if not times:
+                    print("%8s %8d %11s %10s" % (kind, clients, "", "failed"))
+                    continue
+                print("%8s %8d %11s %10.0f %10.2f %10.2f %8d %12.1f" % (kind, clients,
+                    "keep-alive" if keepalive else "close", len(times) / DURATION,
+                    times[len(times) // 2] * 1000, times[int(len(times) * 0.99)] * 1000,
+                    errors, cpu * 1e6 / len(times)))
+
+def bench_probe(sizes, nodes=100):
+    """
+    Round-trip time and client and server CPU per probe of each PROBE
+    method, run through pollnode() against a local asyncio server
+    """
+    if sizes is SIZES:
+        sizes = PROBES
+    print("%8s %8s %10s %10s %10s %12s %12s" % ("method", "probes", "p50 (us)", "p99 (us)",
+        "lost", "client (us)", "server (us)"))
+    for count in sizes:
+        for method in ("http", "tcp", "udp"):
+            server, port = startserver("asyncio", nodes)
+            gridbug.PROBE = method
+            node = {"id": "bench", "host": "127.0.0.1:%d" % port}
+            times = []
+            cpu = cputime(server.pid)
+            client = time.process_time()
+            for i in range(count):
+                alive, payload, rtt = gridbug.pollnode(node, False)
+                times.append(rtt)
+            client = time.process_time() - client
+            cpu = cputime(server.pid) - cpu
+            server.kill()
+            server.join()
+            valid = sorted(t for t in times if t is not None)
+            if not valid:
+                print("%8s %8d %10s" % (method, count, "failed"))
+                continue
+            print("%8s %8d %10.1f %10.1f %10d %12.1f %12.1f" % (method, count,
+                valid[len(valid) // 2] * 1000, valid[int(len(valid) * 0.99)] * 1000,
+                count - len(valid), client * 1e6 / count, cpu * 1e6 / count))
+
+class FaultAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport for one simulated node that counts its requests and bytes
+    and fails or delays requests over links the grid has marked
+    """
+    def __init__(self, grid, source, **kwargs):
+        requests.adapters.HTTPAdapter.__init__(self, **kwargs)
+        self.grid = grid
+        self.source = source
+
+    def send(self, request, **kwargs):
+        grid = self.grid
+        target = grid.hosts.get(urlsplit(request.url).netloc)
+        link = (self.source, target)
+        grid.requests[self.source] += 1
+        grid.sent[self.source] += len(request.body or b"")
+        if link in grid.down:
+            raise requests.ConnectionError("Link %s.%s is down (simulated)" % link)
+        if link in grid.delay:
+            time.sleep(grid.delay[link])
+        response = requests.adapters.HTTPAdapter.send(self, request, **kwargs)
+        if target is not None:
+            grid.sent[target] += len(response.content)
+        return response
+
+class SimGrid(object):
+    """
+    A grid of n gridbug nodes in one process
+
+    gridbug.py keeps its state in module globals, so every node is its own
+    copy of the module, configured from the environment like a container,
+    running the real poll, ingest, event hub and asyncio API threads on a
+    loopback port.  Each node's peer sessions use a FaultAdapter, so links
+    can be taken down or slowed and traffic is counted per node.
+    """
+    def __init__(self, n, env):
+        self.ids = ["n%d" % i for i in range(n)]
+        self.ports = []
+        for i in range(n):
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                self.ports.append(s.getsockname()[1])
+        self.hosts = {"127.0.0.1:%d" % p: i for i, p in zip(self.ids, self.ports)}
+        self.down = set()       # (source id, target id) links that fail
+        self.delay = {}         # (source id, target id) -> seconds added
+        self.requests = dict.fromkeys(self.ids, 0)
+        self.sent = dict.fromkeys(self.ids, 0)
+        self.listfile = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+        json.dump({"version": 1, "gridbugs": [{"id": i, "host": h}
+            for h, i in self.hosts.items()]}, self.listfile)
+        self.listfile.close()
+        self.env = env
+        self.nodes = []
+        self.apis = []
+        self.threads = []
+
+    def start(self):
+        """
+        Load and start every node - their startup noise is discarded
+        """
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gridbug.py")
+        with open(path) as f:
+            code = compile(f.read(), path, "exec")
+        quiet = open(os.devnull, "w")
+        with contextlib.redirect_stdout(quiet), contextlib.redirect_stderr(quiet):
+            for node_id, port in zip(self.ids, self.ports):
+                os.environ.update(self.env)
+                os.environ.update({"GRIDBUGCONF": "", "GRIDBUGLIST": self.listfile.name,
+                    "GB_ID": node_id, "GB_NODEURL": "127.0.0.1:%d" % port,
+                    "GB_APIPORT": str(port), "GB_GRIDKEY": "benchmark", "GB_SERVERNODE": "",
+                    "GB_HISTORY": ""})
+                node = types.ModuleType("gridbug_%s" % node_id)
+                node.__file__ = path
+                exec(code, node.__dict__)
+                self.wrapsessions(node, node_id)
+                node.loadbugs()
+                api = node.AsyncAPI(port)
+                for target in (api.run, node.ingestgraph, node.hub.run, node.pollgridbugs):
+                    thread = threading.Thread(target=target, daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+                self.nodes.append(node)
+                self.apis.append(api)
+            # Threads announce themselves as they start
+            time.sleep(1)
+
+    def stop(self):
+        """
+        Stop every node as its main thread would on exit
+        """
+        quiet = open(os.devnull, "w")
+        with contextlib.redirect_stderr(quiet):
+            for node, api in zip(self.nodes, self.apis):
+                node.running = False
+                api.stop()
+                node.ingest.wake()
+                node.hub.wake()
+            for thread in self.threads:
+                thread.join(GRIDPOLL * 5)
+        os.unlink(self.listfile.name)
+
+    def wrapsessions(self, node, node_id):
+        peersession = node.peersession
+        def faultsession(host):
+            session = peersession(host)
+            if not isinstance(session.get_adapter("http://"), FaultAdapter):
+                session.mount("http://", FaultAdapter(self, node_id,
+                    pool_connections=1, pool_maxsize=node.POOLSIZE))
+            return session
+        node.peersession = faultsession
+
+    def converged(self):
+        """
+        True once every node sees every link green except those down,
+        which must be red
+        """
+        want = len(self.ids) ** 2 - len(self.down)
+        for node in self.nodes:
+            edges = node.state.graph.edges
+            if sum(1 for e in list(edges.values()) if e.color == "green") != want:
+                return False
+            for link in self.down:
+                e = edges.get(link)
+                if e is None or e.color != "red":
+                    return False
+        return True
+
+    def settle(self, limit):
+        """
+        Seconds until the grid converges or None after limit seconds
+        """
+        start = time.time()
+        while time.time() - start < limit:
+            if self.converged():
+                return time.time() - start
+            time.sleep(0.25)
+        return None
+
+def simulate(n, exchange, results):
+    """
+    Start an n node grid, wait for it to converge, take down 10% of the
+    links and then heal them - target of a child process
+    """
+    poll = max(GRIDPOLL, n // 5)
+    env = {"GB_EXCHANGE": exchange, "GB_POLL": str(poll), "GB_TTL": str(poll * 10),
+        "GB_TIMEOUT": "2", "GB_PROBE_CONFIRM": "1", "GB_PROBE_BACKOFF": str(poll * 4)}
+    grid = SimGrid(n, env)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    rss = usage.ru_maxrss
+    began = time.time()
+    grid.start()
+    timings = [grid.settle(GRIDLIMIT * poll)]
+    random.seed(n)
+    # One direction per pair at most - in mesh mode a node only learns
+    # another's edges from that node, so cutting both ways leaves them gray
+    links = [random.choice([(s, t), (t, s)]) for i, s in enumerate(grid.ids) for t in grid.ids[i + 1:]]
+    grid.down.update(random.sample(links, max(1, len(links) // 5)))
+    timings.append(grid.settle(GRIDLIMIT * poll))
+    grid.down.clear()
+    timings.append(grid.settle(GRIDLIMIT * poll))
+    elapsed = time.time() - began
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results.put([poll] + timings + [(usage.ru_utime + usage.ru_stime - cpu) / elapsed / n,
+        (usage.ru_maxrss - rss) / 1024.0 / n, sum(grid.requests.values()) / elapsed / n,
+        sum(grid.sent.values()) / elapsed / n])
+    grid.stop()
+
+def bench_grid(sizes):
+    """
+    Convergence of a simulated grid in mesh and gossip mode - from start,
+    after 10% of links fail and after they heal - with CPU, peak memory,
+    requests and bytes sent per node.  All nodes share one process, so
+    times include contention between them.
+    """
+    if sizes is SIZES:
+        sizes = GRIDSIZES
+    ctx = multiprocessing.get_context("fork")
+    print("%6s %8s %8s %9s %9s %9s %12s %10s %10s %10s" % ("nodes", "exchange", "poll (s)", "start (s)",
+        "fail (s)", "heal (s)", "cpu (ms/s)", "rss (MB)", "req/s", "KB/s"))
+    for n in sizes:
+        for exchange in ("mesh", "gossip"):
+            results = ctx.Queue()
+            child = ctx.Process(target=simulate, args=(n, exchange, results))
+            child.start()
+            row = results.get()
+            child.join()
+            times = ["%9s" % "-" if t is None else "%9.1f" % t for t in row[1:4]]
+            print("%6d %8s %8d %s %12.1f %10.1f %10.1f %10.1f" % (n, exchange, row[0],
+                " ".join(times), row[4] * 1000, row[5], row[6], row[7] / 1024))
+
+def bench_buglist(sizes, churn=0.01):
+    """
+    Time to parse, validate and index an N node gridbugs.json, and to
+    apply a changed list with `churn` of the nodes added and removed to a
+    live grid whose own edges are all green
+    """
+    if sizes is SIZES:
+        sizes = BUGLISTSIZES
+    print("%8s %10s %10s %12s %12s %12s %10s" % ("nodes", "size (KB)", "parse (ms)",
+        "validate (ms)", "index (ms)", "update (ms)", "edges kept"))
+    path = os.path.join(tempfile.mkdtemp(), "gridbugs.json")
+    for n in sizes:
+        entries = [{"host": "node%d:8777" % i, "id": "node%d" % i} for i in range(n)]
+        with open(path, "w") as f:
+            json.dump({"version": 1, "gridbugs": entries}, f)
+        start = time.perf_counter()
+        with open(path) as f:
+            bugs = json.load(f)
+        parse = time.perf_counter() - start
+        start = time.perf_counter()
+        gridbug.checkbugs(bugs)
+        check = time.perf_counter() - start
+        start = time.perf_counter()
+        grid = gridbug.GridState(bugs)
+        index = time.perf_counter() - start
+        gridbug.state = grid
+        for bug in grid.bugs["gridbugs"]:
+            bug["alive"] = True
+        gridbug.updategraph(False, grid)
+        gridbug.updategraph(False, grid)
+        changes = max(1, int(n * churn))
+        changed = {"version": 2, "gridbugs": entries[changes:] +
+            [{"host": "new%d:8777" % i, "id": "new%d" % i} for i in range(changes)]}
+        quiet = open(os.devnull, "w")
+        with contextlib.redirect_stderr(quiet):
+            start = time.perf_counter()
+            gridbug.applybugs(grid, changed)
+            update = time.perf_counter() - start
+        green = sum(1 for e in grid.graph.edges.values() if e.color == "green")
+        print("%8d %10d %10.1f %12.1f %12.1f %12.1f %10d" % (n, os.path.getsize(path) / 1024,
+            parse * 1000, check * 1000, index * 1000, update * 1000, green))
+
+class AlertReceiver(BaseHTTPRequestHandler):
+    """
+    Stand-in alert webhook - mode is ok, slow (200ms per POST) or flaky
+    (every other POST answered 503)
+    """
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        with server.lock:
+            server.posts += 1
+            refuse = server.mode == "flaky" and server.posts % 2
+        if server.mode == "slow":
+            time.sleep(0.2)
+        if refuse:
+            self.send_response(503)
+        else:
+            with server.lock:
+                server.received += len(json.loads(body)["alerts"])
+            self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def bench_alerts(sizes, hold=0.2):
+    """
+    Cost to the ingest thread of reporting edge transitions, and alerts
+    delivered to a local webhook that is up, slow, flaky or down when
+    half the edges flap back within the hold time and half go red
+    """
+    if sizes is SIZES:
+        sizes = ALERTSIZES
+    print("%6s %8s %12s %10s %12s %8s %8s %8s %8s %10s" % ("mode", "edges", "transitions",
+        "us/change", "suppressed", "sent", "dropped", "failed", "posts", "secs"))
+    quiet = open(os.devnull, "w")
+    with contextlib.redirect_stderr(quiet):
+        for n in sizes:
+            for mode in ("ok", "slow", "flaky", "down"):
+                receiver = ThreadingHTTPServer(("127.0.0.1", 0), AlertReceiver)
+                receiver.mode = mode
+                receiver.lock = threading.Lock()
+                receiver.posts = receiver.received = 0
+                url = "http://127.0.0.1:%d/alert" % receiver.server_address[1]
+                if mode == "down":
+                    receiver.server_close()
+                else:
+                    threading.Thread(target=receiver.serve_forever, daemon=True).start()
+                for key in gridbug.serverstats:
+                    if key.startswith("alerts_"):
+                        gridbug.serverstats[key] = 0
+                alerts = gridbug.AlertDispatcher(url, hold=hold, backoff=0.1)
+                thread = threading.Thread(target=alerts.run, daemon=True)
+                thread.start()
+                edges = [gridbug.Edge("node0", "node%d" % i) for i in range(1, n + 1)]
+                changes = 0
+                start = time.perf_counter()
+                for i, e in enumerate(edges):
+                    for color in (("red", "green", "red", "green") if i % 2 else ("red",)):
+                        e.color = color
+                        alerts.transition(e)
+                        changes += 1
+                cost = time.perf_counter() - start
+                stats = gridbug.serverstats
+                deadline = time.time() + 60
+                while time.time() < deadline and stats['alerts_suppressed'] + stats['alerts_sent'] + \
+                        stats['alerts_dropped'] + stats['alerts_failed'] < n:
+                    time.sleep(0.01)
+                took = time.perf_counter() - start
+                alerts.close()
+                thread.join()
+                if mode != "down":
+                    receiver.shutdown()
+                    receiver.server_close()
+                    assert receiver.received == stats['alerts_sent']
+                print("%6s %8d %12d %10.2f %12d %8d %8d %8d %8d %10.2f" % (mode, n, changes,
+                    cost * 1e6 / changes, stats['alerts_suppressed'], stats['alerts_sent'],
+                    stats['alerts_dropped'], stats['alerts_failed'], receiver.posts, took))
+
+BENCHMARKS = {"ingest": bench_ingest, "gossip": bench_gossip, "http": bench_http,
+    "wire": bench_wire, "probe": bench_probe, "grid": bench_grid,
+    "partitions": bench_partitions, "alerts": bench_alerts,
+    "buglist": bench_buglist}
+
+if __name__ == "__main__":
+    name = sys.argv[1] if len(sys.argv) > 1 else "ingest"
+    if name not in BENCHMARKS:
+        print("Unknown benchmark %s - choose from: %s" % (name, ", ".join(BENCHMARKS)))
+        sys.exit(1)
+    sizes = SIZES
+    if len(sys.argv) > 2:
+        sizes = [int(x) for x in sys.argv[2].split(",")]
+    BENCHMARKS[name](sizes)
@@ -10,10 +10,15 @@
  Command line: python gen.py [host] [id]
       [host] and [id] are optional but will be added as a node if provided
 
+ Bulk import: python gen.py --csv [file] [--out gridbugs.json]
+      Reads id,host rows from file (or stdin if file is - or missing)
+      without prompting.  A header row naming the id and host columns
+      is optional, as are blank lines and lines starting with #.
+
 """
 # Modules
 from __future__ import print_function
-import json, sys
+import csv, json, sys
 
 # Backward compatibility for python2
 try:
@@ -24,6 +29,49 @@ except NameError:
 BUGSFILE = "gridbugs.json"
 bugs = {"version": 1, "gridbugs": []}
 
+def readcsv(f):
+    """
+    Read id,host rows into bug entries - exits on a bad row or duplicate ID
+    """
+    entries = []
+    ids = set()
+    columns = (0, 1)
+    lines = (l for l in f if l.strip() and not l.lstrip().startswith("#"))
+    for number, row in enumerate(csv.reader(lines), 1):
+        row = [c.strip() for c in row]
+        if number == 1 and "id" in [c.lower() for c in row] and "host" in [c.lower() for c in row]:
+            header = [c.lower() for c in row]
+            columns = (header.index("id"), header.index("host"))
+            continue
+        if len(row) <= max(columns) or not row[columns[0]] or not row[columns[1]]:
+            sys.stderr.write("ERROR: Row %d needs an id and a host: %s\n" % (number, ",".join(row)))
+            sys.exit(1)
+        id, host = row[columns[0]], row[columns[1]]
+        if id in ids:
+            sys.stderr.write("ERROR: Duplicate ID %s in row %d - IDs must be unique\n" % (id, number))
+            sys.exit(1)
+        ids.add(id)
+        entries.append({"host": host, "id": id})
+    return entries
+
+if len(sys.argv) >= 2 and sys.argv[1] == "--csv":
+    # Bulk import - no prompts
+    args = sys.argv[2:]
+    if "--out" in args:
+        i = args.index("--out")
+        BUGSFILE = args[i + 1]
+        del args[i:i + 2]
+    source = args[0] if args else "-"
+    if source == "-":
+        bugs["gridbugs"] = readcsv(sys.stdin)
+    else:
+        with open(source) as f:
+            bugs["gridbugs"] = readcsv(f)
+    with open(BUGSFILE, 'w') as f:
+        json.dump(bugs, f, indent=4)
+    sys.stderr.write("Wrote %d nodes to %s\n" % (len(bugs["gridbugs"]), BUGSFILE))
+    sys.exit(0)
+
 if len(sys.argv) >= 3:
     # Add command line node entry
     host = sys.argv[1]
@@ -30,22 +30,56 @@
         ENABLE = yes
         PORT = 8777
         MAXPAYLOAD = 40000
+        MAXINFLATE = 1048576
+        KEEPALIVE = 30
+        SERVER = asyncio
+        CONCURRENCY = 64
+        UDPECHO = yes
+        WORKERS = 0
 
         [BUGS]
         POLL = 10
         TTL = 30
         TIMEOUT = 10
+        CONCURRENCY = 8
+        PROBE = http
+        PROBEPOLL = 10
+        CONFIRM = 2
+        BACKOFF = 300
+        JITTER = 0.1
+        POOLSIZE = 2
+        POOLMAX = 256
+        POOLIDLE = 60
+        SAMPLES = 64
+        AVAILABILITY = yes
+        WIRE = compact
+        EXCHANGE = mesh
+        FANOUT = 3
+        CACHE = gridbugs.cache.json
+        RELOAD = 60
 
         [ALERT]
         # Notify connectivity issues
         ENABLE = yes
+        URL =
+        HOLD = 30
+        BATCH = 100
+        QUEUE = 1000
+        RETRIES = 3
+        BACKOFF = 2
+
+        [HISTORY]
+        # Directory for the edge transition log (blank to disable)
+        PATH = history
+        RECORDS = 16384
+        SEGMENTS = 8
 
     ENVIRONMENTAL (overrides above, * required if no config file):
         GRIDBUGCONF = Path to gridbug.conf config file
         GRIDBUGLIST = Path to gridbugs.json node list
       * BUGLISTURL = URL to gridbugs.json (overrides config)
         GB_DEBUG = Set to debug mode (yes/no)
-        GB_ROLE = node or server (defaults node)
+        GB_ROLE = node or server - an aggregator of leaf bug lists (defaults node)
       * GB_ID = Node ID
       * GB_NODEURL = The URL address to this node (e.g. 10.10.10.10:8777)
         GB_CONSOLE = HTML file for console
@@ -53,46 +87,116 @@
       * GB_GRIDKEY = Private key for grid (overrides above)
         GB_IPSERVICE = Service that provide your public IP
         GB_APIPORT = TCP Port to Listen (defaults 8777)
-        GB_MAXPAYLOAD = Maximum allowed POST payload to accept
+        GB_MAXPAYLOAD = Maximum allowed POST payload to accept (compressed bug lists may use MAXINFLATE)
         GB_POLL = Time in seconds to wait between tests
         GB_TTL = Time in seconds to identify dead node
         GB_TIMEOUT = Time in seconds to wait for response
+        GB_POLL_CONCURRENCY = Maximum number of nodes polled at once
+        GB_PROBE = Probe method: http (GET /ping), tcp (connect only) or udp (echo)
+        GB_PROBEPOLL = Seconds between probes of a live node (0 uses GB_POLL)
+        GB_UDPECHO = Answer UDP echo probes on the API port (yes/no)
+        GB_PROBE_CONFIRM = Seconds before re-probing a node that just changed state
+        GB_PROBE_BACKOFF = Longest wait in seconds between probes of a dead node
+        GB_PROBE_JITTER = Random spread of probe intervals as a fraction (0-1)
+        GB_KEEPALIVE = Seconds to hold idle keep-alive API connections open
+        GB_APISERVER = API server: asyncio (event loop) or thread (thread per connection)
+        GB_API_CONCURRENCY = Maximum requests processed at once by the asyncio server
+        GB_WORKERS = Aggregator processes sharing the API port for GB_ROLE=server (0 for one per CPU)
+        GB_POOLSIZE = Keep-alive connections held per peer host
+        GB_POOLMAX = Maximum number of peer hosts with pooled connections
+        GB_POOLIDLE = Seconds before an idle peer connection pool is closed
+        GB_SAMPLES = Number of round-trip samples kept per edge
+        GB_AVAILABILITY = Keep 1m, 1h and 24h availability rollups per edge (yes/no)
+        GB_WIRE = Bug list encoding offered to peers: compact or json
+        GB_MAXINFLATE = Maximum size a compressed bug list may inflate to
+        GB_EXCHANGE = Bug list exchange: mesh (every node), gossip (FANOUT random peers) or server (GB_SERVERNODE only)
+        GB_FANOUT = Number of peers to gossip with each poll cycle
+        GB_BUGLISTCACHE = Last good list from BUGLISTURL, loaded when it can not be fetched
+        GB_BUGLISTRELOAD = Seconds between checks of the bug list for added and removed nodes (0 to disable)
+        GB_ALERT = Send alerts for edges that change color (yes/no)
+        GB_ALERTURL = Webhook that alerts are POSTed to as JSON (blank to disable)
+        GB_ALERTHOLD = Seconds an edge must hold its new color before it is alerted
+        GB_ALERTBATCH = Most alerts sent in one POST
+        GB_ALERTQUEUE = Most alerts waiting to be sent - the oldest are dropped
+        GB_ALERTRETRIES = Times a failed POST is retried before its alerts are dropped
+        GB_ALERTBACKOFF = Seconds before the first retry, doubled for each one after
+        GB_HISTORY = Directory for the edge transition log (blank to disable)
+        GB_HISTORYRECORDS = Records per history log segment
+        GB_HISTORYSEGMENTS = Number of history log segments to retain
 
     The API service of gridbug has the following functions:
         /           - GridBug Console - displays graph of nodes      
         /text       - Human friendly display of current conditions
-        /bugs       - List of gridbug nodes
+        /bugs       - List of gridbug nodes (?since=GEN&epoch=EPOCH for changes only)
+        /gossip     - Anti-entropy exchange of bug lists between nodes (POST)
         /stats      - Internal gridbug metrics
-        /graph      - Internal graph of connectivity (JSON)
+        /metrics    - Stats, queue depths and latency histograms for Prometheus
+        /graph      - Internal graph of connectivity (JSON, ?availability=1h adds uptime)
+        /shard      - Graph of one aggregator worker, merged into /graph (key header)
         /clear      - Reload gridbugs and rebuild graph
         /ping       - Simple OK response
         /time       - Local timestamps and uptime
         /raw        - Raw graph DB
+        /latency    - Round-trip time percentiles and loss per edge
+        /history    - Edge transitions (?edge=SRC.TGT&from=TS&to=TS)
+        /availability - Uptime per edge over 1m, 1h and 24h (?window=1h&edge=SRC.TGT)
+        /partitions - Groups of nodes that all reach each other over green edges
+        /reach      - Green path between two nodes (?from=ID&to=ID)
+        /events     - Server-Sent Events stream of graph snapshot and diffs
+        /debug/profile - Sample every thread (?seconds=N&top=N, key header)
+        /debug/memory  - Diff tracemalloc snapshots (?reset=1, ?stop=1, key header)
 
 """
 # Modules
 from __future__ import print_function
-import threading
 import time
+BOOTSTART = time.time()     # Startup phases are timed from here (before imports)
+import threading
+import asyncio
+import heapq
+import bisect
+import math
+import mmap
+import struct
+import gzip
+import hashlib
+import zlib
+import io
+import selectors
+import socket
+import random
+import collections
+import tracemalloc
+import multiprocessing
+import signal
+from array import array
+import concurrent.futures
 import logging
 import json
 import requests
+import requests.adapters
 import resource
 import datetime
+import email.utils
+import http
+import http.client
 import sys
 import os
+from urllib.parse import urlsplit, parse_qs
 from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 from socketserver import ThreadingMixIn 
 import configparser
 
 # Built Settings
-BUILD = "0.1.0"
+BUILD = "0.2.0"
 
 # Defaults
 DEBUGMODE = False
 CONFIGFILE = os.getenv("GRIDBUGCONF", "gridbug.conf")
 GRIDBUGLIST = os.getenv("GRIDBUGLIST", "gridbugs.json")
 BUGLISTURL = os.getenv("BUGLISTURL", "") 
+BUGLISTCACHE = "gridbugs.cache.json"    # Last good list from BUGLISTURL, used when it can not be fetched
+BUGLISTRELOAD = 60       # Seconds between checks of the bug list for changes (0 disables)
 URL = ""
 CONFIGMSG = ""
 ID = ""
@@ -107,7 +211,42 @@ APIPORT = 8777
 GBPOLL = 10
 TTL = 60
 TIMEOUT = 10
+POLLCONCURRENCY = 8      # Maximum number of nodes polled in parallel
+PROBE = "http"           # Probe method: http (GET /ping), tcp (connect) or udp (echo)
+PROBEPOLL = 0            # Seconds between probes of a live node (0 uses GBPOLL)
+UDPECHO = True           # Answer UDP echo probes on APIPORT
+PROBECONFIRM = 2         # Seconds before re-probing a node that just changed state
+PROBEBACKOFF = 300       # Longest wait between probes of a dead node (seconds)
+PROBEJITTER = 0.1        # Random spread of probe intervals (fraction of interval)
 MAXPAYLOAD = 10000       # Reject payload if above this size (40K)
+MAXINFLATE = 1048576     # Reject compressed payload if it inflates above this size
+WIRE = "compact"         # Bug list encoding offered to peers: compact or json
+EXCHANGE = "mesh"        # Bug list exchange: mesh (every node), gossip (FANOUT peers) or server (SERVERNODE only)
+FANOUT = 3               # Random peers gossiped with per poll cycle
+KEEPALIVE = 30           # Seconds to keep idle API client connections open
+APISERVER = "asyncio"    # API server: asyncio (event loop) or thread (thread per connection)
+APICONCURRENCY = 64      # Requests processed at once by the asyncio API server
+WORKERS = 0              # Aggregator processes for ROLE=server (0 for one per CPU)
+POOLSIZE = 2             # Keep-alive connections per peer host
+POOLMAX = 256            # Maximum peer hosts with pooled connections
+POOLIDLE = 60            # Seconds before idle peer pool is closed
+SAMPLES = 64             # Round-trip samples kept per edge
+AVAILABILITY = True      # Keep availability rollups per edge
+LATENCYCHANGE = 0.2      # Relative p50 change (or 0.05 loss) gossiped to peers
+ALERT = True             # Send alerts for edges that change color
+ALERTURL = ""            # Webhook alerts are POSTed to (blank disables)
+ALERTHOLD = 30           # Seconds an edge must keep its new color to be alerted
+ALERTBATCH = 100         # Most alerts per POST
+ALERTQUEUE = 1000        # Most alerts waiting to be sent (oldest dropped)
+ALERTRETRIES = 3         # Retries of a failed POST before its alerts are dropped
+ALERTBACKOFF = 2         # Seconds before the first retry (doubles, up to 60)
+ALERTFLAPS = 10          # Holds a flapping edge can go unreported
+HISTORY = ""             # Directory for edge transition log (blank disables)
+HISTORYRECORDS = 16384   # Records per history segment (96 bytes each)
+HISTORYSEGMENTS = 8      # History segments retained
+GZIPMIN = 512            # Smallest cached response worth compressing
+SSEBUFFER = 1048576      # Drop event subscribers this many bytes behind
+SSEPING = 15             # Seconds between event stream keepalives
 
 # Load config from Configuration File
 config = configparser.ConfigParser(allow_no_value=True)
@@ -125,10 +264,46 @@ if os.path.exists(CONFIGFILE):
     API = config["API"]["ENABLE"].lower() == "yes"
     APIPORT = int(config["API"]["PORT"])
     MAXPAYLOAD = int(config["API"]["MAXPAYLOAD"])
+    MAXINFLATE = int(config["API"].get("MAXINFLATE", MAXINFLATE))
+    KEEPALIVE = int(config["API"].get("KEEPALIVE", KEEPALIVE))
+    APISERVER = config["API"].get("SERVER", APISERVER)
+    APICONCURRENCY = int(config["API"].get("CONCURRENCY", APICONCURRENCY))
+    UDPECHO = config["API"].get("UDPECHO", "yes").lower() == "yes"
+    WORKERS = int(config["API"].get("WORKERS", WORKERS))
     # GridBugs
     GBPOLL = int(config["BUGS"]["POLL"])
     TTL = int(config["BUGS"]["TTL"])
     TIMEOUT = int(config["BUGS"]["TIMEOUT"])
+    POLLCONCURRENCY = int(config["BUGS"].get("CONCURRENCY", POLLCONCURRENCY))
+    PROBE = config["BUGS"].get("PROBE", PROBE)
+    PROBEPOLL = float(config["BUGS"].get("PROBEPOLL", PROBEPOLL))
+    PROBECONFIRM = float(config["BUGS"].get("CONFIRM", PROBECONFIRM))
+    PROBEBACKOFF = float(config["BUGS"].get("BACKOFF", PROBEBACKOFF))
+    PROBEJITTER = float(config["BUGS"].get("JITTER", PROBEJITTER))
+    POOLSIZE = int(config["BUGS"].get("POOLSIZE", POOLSIZE))
+    POOLMAX = int(config["BUGS"].get("POOLMAX", POOLMAX))
+    POOLIDLE = int(config["BUGS"].get("POOLIDLE", POOLIDLE))
+    SAMPLES = int(config["BUGS"].get("SAMPLES", SAMPLES))
+    AVAILABILITY = config["BUGS"].get("AVAILABILITY", "yes").lower() == "yes"
+    WIRE = config["BUGS"].get("WIRE", WIRE)
+    EXCHANGE = config["BUGS"].get("EXCHANGE", EXCHANGE)
+    FANOUT = int(config["BUGS"].get("FANOUT", FANOUT))
+    BUGLISTCACHE = config["BUGS"].get("CACHE", BUGLISTCACHE)
+    BUGLISTRELOAD = float(config["BUGS"].get("RELOAD", BUGLISTRELOAD))
+    # Alerts
+    if "ALERT" in config:
+        ALERT = config["ALERT"].get("ENABLE", "yes").lower() == "yes"
+        ALERTURL = config["ALERT"].get("URL", ALERTURL) or ""
+        ALERTHOLD = float(config["ALERT"].get("HOLD", ALERTHOLD))
+        ALERTBATCH = int(config["ALERT"].get("BATCH", ALERTBATCH))
+        ALERTQUEUE = int(config["ALERT"].get("QUEUE", ALERTQUEUE))
+        ALERTRETRIES = int(config["ALERT"].get("RETRIES", ALERTRETRIES))
+        ALERTBACKOFF = float(config["ALERT"].get("BACKOFF", ALERTBACKOFF))
+    # History
+    if "HISTORY" in config:
+        HISTORY = config["HISTORY"].get("PATH", HISTORY)
+        HISTORYRECORDS = int(config["HISTORY"].get("RECORDS", HISTORYRECORDS))
+        HISTORYSEGMENTS = int(config["HISTORY"].get("SEGMENTS", HISTORYSEGMENTS))
     # For debug
     CONFIGMSG = "Used config file %s" % CONFIGFILE
 else:
@@ -146,11 +321,43 @@ CONSOLE = os.getenv("GB_CONSOLE", CONSOLE)
 SERVERNODE = os.getenv("GB_SERVERNODE", SERVERNODE) 
 GRIDKEY = os.getenv("GB_GRIDKEY", GRIDKEY) 
 IPSERVICE = os.getenv("GB_IPSERVICE", IPSERVICE) 
-APIPORT = os.getenv("GB_APIPORT", APIPORT) 
-MAXPAYLOAD = os.getenv("GB_MAXPAYLOAD", MAXPAYLOAD) 
-GBPOLL = os.getenv("GB_POLL", GBPOLL) 
-TTL = os.getenv("GB_TTL", TTL) 
-TIMEOUT = os.getenv("GB_TIMEOUT", TIMEOUT) 
+APIPORT = int(os.getenv("GB_APIPORT", APIPORT))
+MAXPAYLOAD = int(os.getenv("GB_MAXPAYLOAD", MAXPAYLOAD))
+MAXINFLATE = int(os.getenv("GB_MAXINFLATE", MAXINFLATE))
+WIRE = os.getenv("GB_WIRE", WIRE).lower()
+EXCHANGE = os.getenv("GB_EXCHANGE", EXCHANGE).lower()
+FANOUT = max(1, int(os.getenv("GB_FANOUT", FANOUT)))
+GBPOLL = int(os.getenv("GB_POLL", GBPOLL))
+TTL = int(os.getenv("GB_TTL", TTL))
+TIMEOUT = int(os.getenv("GB_TIMEOUT", TIMEOUT))
+POLLCONCURRENCY = max(1, int(os.getenv("GB_POLL_CONCURRENCY", POLLCONCURRENCY)))
+PROBE = os.getenv("GB_PROBE", PROBE).lower()
+PROBEPOLL = float(os.getenv("GB_PROBEPOLL", PROBEPOLL)) or GBPOLL
+UDPECHO = os.getenv("GB_UDPECHO", "yes" if UDPECHO else "no").lower() == "yes"
+PROBECONFIRM = float(os.getenv("GB_PROBE_CONFIRM", PROBECONFIRM))
+PROBEBACKOFF = float(os.getenv("GB_PROBE_BACKOFF", PROBEBACKOFF))
+PROBEJITTER = min(1.0, max(0.0, float(os.getenv("GB_PROBE_JITTER", PROBEJITTER))))
+KEEPALIVE = int(os.getenv("GB_KEEPALIVE", KEEPALIVE))
+APISERVER = os.getenv("GB_APISERVER", APISERVER).lower()
+APICONCURRENCY = max(1, int(os.getenv("GB_API_CONCURRENCY", APICONCURRENCY)))
+WORKERS = max(0, int(os.getenv("GB_WORKERS", WORKERS)))
+POOLSIZE = max(1, int(os.getenv("GB_POOLSIZE", POOLSIZE)))
+POOLMAX = max(1, int(os.getenv("GB_POOLMAX", POOLMAX)))
+POOLIDLE = int(os.getenv("GB_POOLIDLE", POOLIDLE))
+SAMPLES = max(1, int(os.getenv("GB_SAMPLES", SAMPLES)))
+AVAILABILITY = os.getenv("GB_AVAILABILITY", "yes" if AVAILABILITY else "no").lower() == "yes"
+BUGLISTCACHE = os.getenv("GB_BUGLISTCACHE", BUGLISTCACHE)
+BUGLISTRELOAD = max(0.0, float(os.getenv("GB_BUGLISTRELOAD", BUGLISTRELOAD)))
+ALERT = os.getenv("GB_ALERT", "yes" if ALERT else "no").lower() == "yes"
+ALERTURL = os.getenv("GB_ALERTURL", ALERTURL)
+ALERTHOLD = max(0.0, float(os.getenv("GB_ALERTHOLD", ALERTHOLD)))
+ALERTBATCH = max(1, int(os.getenv("GB_ALERTBATCH", ALERTBATCH)))
+ALERTQUEUE = max(1, int(os.getenv("GB_ALERTQUEUE", ALERTQUEUE)))
+ALERTRETRIES = max(0, int(os.getenv("GB_ALERTRETRIES", ALERTRETRIES)))
+ALERTBACKOFF = max(0.1, float(os.getenv("GB_ALERTBACKOFF", ALERTBACKOFF)))
+HISTORY = os.getenv("GB_HISTORY", HISTORY)
+HISTORYRECORDS = max(1, int(os.getenv("GB_HISTORYRECORDS", HISTORYRECORDS)))
+HISTORYSEGMENTS = max(1, int(os.getenv("GB_HISTORYSEGMENTS", HISTORYSEGMENTS)))
 
 # Logging
 log = logging.getLogger(__name__)
@@ -160,12 +367,6 @@ if DEBUGMODE:
     log.debug("GridBug [%s]\n" % BUILD)
     log.debug(CONFIGMSG)
 
-# Autodiscover public address
-if NODEURL.lower() == "autodiscover":
-    ip = requests.get(IPSERVICE).content.decode('utf8')
-    NODEURL = "%s:%s" % (ip, APIPORT)
-    log.debug("Autodiscover NODEURL: %s" % NODEURL)
-
 # Validate we have what we need to start
 if ID == "" or NODEURL == "" or GRIDKEY == "" or (GRIDBUGLIST == "" and BUGLISTURL == ""):
     # Missing config files
@@ -186,442 +387,4099 @@ serverstats['posts'] = 0
 serverstats['errors'] = 0
 serverstats['timeout'] = 0
 serverstats['poll'] = 0
+serverstats['probe_mode'] = PROBE
+serverstats['probe_inflight'] = 0            # Probes and exchanges running
+serverstats['probe_late_ms'] = 0             # How far behind its deadline the last probe started
+serverstats['probe_late_max_ms'] = 0
+serverstats['probe_confirms'] = 0            # Quick re-probes after a node changed state
+serverstats['probe_backoff'] = 0             # Dead nodes probed less often
+serverstats['poll_cycle'] = 0                # Seconds of poll work done in the last GBPOLL cycle
+serverstats['poll_cycle_max'] = 0            # Most poll work seen in a cycle (seconds)
+serverstats['udp_echoes'] = 0                # UDP echo probes answered
+serverstats['udp_ignored'] = 0               # Datagrams that were not echo probes
+serverstats['poll_concurrency'] = POLLCONCURRENCY
+serverstats['pool_requests'] = 0             # Requests sent to peers over pooled connections
+serverstats['pool_connects'] = 0             # Connections opened to peers
+serverstats['pool_reused'] = 0               # Requests sent over a connection already open
+serverstats['pool_evictions'] = 0            # Peer sessions closed (idle or over POOLMAX)
+serverstats['pool_sessions'] = 0
+serverstats['gossip_full'] = 0               # Full bug lists sent or served
+serverstats['gossip_delta'] = 0              # Delta bug lists sent or served
+serverstats['gossip_resync'] = 0             # Deltas rejected for a full resync
+serverstats['gossip_stale'] = 0              # Bug lists older than the one applied (ignored)
+serverstats['gossip_invalid'] = 0            # Gossiped bug lists with bad header fields (ignored)
+serverstats['gossip_bytes_out'] = 0
+serverstats['gossip_bytes_in'] = 0
+serverstats['gossip_compact'] = 0            # Bug lists sent or received in the wire format
+serverstats['gossip_exchange'] = EXCHANGE
+serverstats['gossip_exchanges'] = 0          # Anti-entropy exchanges started with peers
+serverstats['gossip_updates_in'] = 0         # Bug lists received in exchanges
+serverstats['gossip_updates_out'] = 0        # Bug lists sent in exchanges
+serverstats['gossip_lag_ms'] = {}            # Age of bug lists when applied (origin clock)
+serverstats['gossip_hops'] = {}              # Exchanges bug lists took to reach us
+serverstats['ingest_queue'] = 0              # Nodes with a bug list waiting to be applied
+serverstats['ingest_queue_max'] = 0
+serverstats['ingest_coalesced'] = 0          # Bug lists merged into one already queued
+serverstats['ingest_applied'] = 0
+serverstats['ingest_failed'] = 0             # Bug lists or queued calls that raised on the ingest thread
+serverstats['ingest_batches'] = 0
+serverstats['ingest_latency_ms'] = 0         # Oldest wait from queued to applied in last batch
+serverstats['ingest_latency_max_ms'] = 0
+serverstats['expired'] = 0                   # Edges grayed out after TTL
+serverstats['expiry_pending'] = 0            # Edges waiting on the expiry timer
+serverstats['transitions'] = 0               # Edge color changes
+serverstats['partitions'] = 0                # Strongly connected groups of nodes over green edges
+serverstats['cache_hits'] = 0                # Responses served pre-encoded
+serverstats['cache_misses'] = 0              # Responses rendered and cached
+serverstats['cache_304'] = 0                 # Conditional requests answered 304
+serverstats['sse_subscribers'] = 0           # Open /events streams
+serverstats['sse_events'] = 0                # Events published
+serverstats['sse_dropped'] = 0               # Subscribers dropped for falling behind
+serverstats['posts_rejected'] = 0            # Posts not ingested (invalid, heavy or bad key)
+serverstats['reloads'] = 0                   # Bug list snapshots published
+serverstats['buglist_updates'] = 0           # Changed bug lists applied without a reload
+serverstats['buglist_added'] = 0             # Nodes added by those updates
+serverstats['buglist_removed'] = 0           # Nodes removed by those updates
+serverstats['buglist_rejected'] = 0          # Changed bug lists that failed validation
+serverstats['reload_ms'] = 0                 # Time to build and publish the last one
+serverstats['reload_max_ms'] = 0
+serverstats['alerts_pending'] = 0            # Edges that changed color and are waiting out ALERTHOLD
+serverstats['alerts_queued'] = 0             # Alerts waiting to be sent
+serverstats['alerts_suppressed'] = 0         # Changes that reverted within ALERTHOLD (not sent)
+serverstats['alerts_sent'] = 0
+serverstats['alerts_batches'] = 0            # POSTs that delivered alerts
+serverstats['alerts_retries'] = 0
+serverstats['alerts_failed'] = 0             # Alerts dropped after ALERTRETRIES
+serverstats['alerts_dropped'] = 0            # Alerts dropped because ALERTQUEUE was full
+serverstats['shard'] = 0                     # Aggregator worker that served this request
+serverstats['shard_forwarded'] = 0           # Posts passed on to the worker that owns their node
+serverstats['shard_fetches'] = 0             # Graphs fetched from other workers to merge /graph
+serverstats['boot'] = {}                     # ms from start to each startup phase and list source
 serverstats['uri'] = {}
 serverstats['ts'] = int(time.time())         # Timestamp for Now
 serverstats['start'] = int(time.time())      # Timestamp for Start 
 serverstats['clear'] = int(time.time())      # Timestamp of lLast Stats Clear
 serverstats['uptime'] = ""
 
-# Global Variables
-running = True
-bugs = {}
-graph = {"nodes": [], "edges": []}
-clearbugs = False
+# Graph Store
+def edgecolor(alive):
+    """
+    Function to map a reported alive state to an edge color
+    """
+    if alive is True:
+        return "green"
+    elif alive is False:
+        return "red"
+    return "gray"
 
-# Add bugs to dict
-def addbug(hostname, host_id):
-    global bugs
+class Edge(object):
     """
-    Function to add a grid bug if not already in dict
+    Directional link from a source gridbug to a target gridbug
     """
-    for b in bugs["gridbugs"]:
-        if b["id"] == host_id:
-            return False
-    bugs["gridbugs"].append({"host": hostname, "id": host_id})
-    log.debug("GRAPH: Added bug %s %s" % (host_id, hostname))
-    return True
+    __slots__ = ("id", "source", "target", "alive", "color", "ts", "reported",
+                 "queued", "latency", "rollup")
 
-# Graph Functions
-def updategraph(payload=False):
+    def __init__(self, source, target, alive=None):
+        self.id = "%s.%s" % (source, target)
+        self.source = source
+        self.target = target
+        self.alive = alive
+        self.color = "gray"
+        self.ts = None
+        self.reported = alive   # Last state reported by source (not served)
+        self.queued = False     # Edge has an entry in the expiry heap
+        self.latency = None     # Latency summary reported by source
+        self.rollup = None      # Rollup from its first color change
+
+    def refresh(self, alive, currentts):
+        self.ts = currentts
+        self.reported = alive
+        self.color = edgecolor(alive)
+
+    def todict(self):
+        e = {"id": self.id, "source": self.source, "target": self.target,
+             "alive": self.alive, "color": self.color}
+        if self.ts is not None:
+            e["ts"] = self.ts
+        if self.latency is not None:
+            e["latency"] = self.latency
+        return e
+
+class GraphStore(object):
     """
-    Function to update graph data
+    Graph of gridbug nodes and edges indexed by id
+
+    Nodes and edges are dicts kept in insertion order so todict() renders
+    the same document the API has always served for /raw and /graph.
+
+    Refreshed edges are kept in a min-heap keyed on when they pass TTL.
+    Each edge has at most one heap entry: refreshing an edge only updates
+    its ts and the entry is pushed back with the new deadline when it
+    comes due, so expiry is O(log N) per edge per TTL.
+
+    Once published the graph is only written by the ingest thread.
     """
-    global bugs, graph
-    currentts = time.time()
-    sourcehost = ""
-    try:
-        if payload:
-            # Update based on received measurements
-            source = payload["node_id"]
-            if "node_host" in payload:
-                sourcehost = payload["node_host"]
-        else:
-            # Update based on our measurements
-            source = ID
-            payload = bugs
-        for n in payload["gridbugs"]:
-            alive = None
-            target = n["id"]
-            targethost = n["host"]
-            if "alive" in n:
-                alive = n["alive"]
-            # Add any new nodes to bugs database for polling
-            if sourcehost != "":
-                addbug(sourcehost, source)
-            addbug(targethost, target)
-            # Update graph
-            id = "%s.%s" % (source,target)
-            if source not in graph["nodes"]:
-                graph["nodes"].append(source)
-            if target not in graph["nodes"]:
-                graph["nodes"].append(target)
-            found = False
-            # Update edges if they are from an authorized source
-            for e in graph["edges"]:
-                if e["id"] == id and e["source"] == source:
-                    e["ts"] = currentts
-                    if alive is True:
-                        e["color"] = "green"
-                    elif alive is False:
-                        e["color"] = "red"
-                    else:
-                        e["color"] = "gray"
-                    found = True
-                else:
-                    if "ts" in e and (e["ts"] + TTL < currentts):
-                        # Edge has aged out
-                        e["color"] = "gray"
-            if not found:
-                graph["edges"].append({"id": id, "source": source, "target": target, "alive": alive, "color": "gray"})
+    __slots__ = ("nodes", "edges", "out", "expiry", "created", "generation",
+                 "newnodes", "changed", "partitions")
+
+    def __init__(self):
+        self.nodes = {}     # node id -> None (ordered set)
+        self.edges = {}     # (source, target) -> Edge
+        self.out = {}       # source -> {target: Edge}
+        self.expiry = []    # heap of (deadline, edge id, (source, target))
+        self.created = time.time()
+        self.generation = 0 # Bumped whenever nodes or edge colors change
+        self.newnodes = []  # Nodes added since the last published diff
+        self.changed = {}   # Edges added or changed since the last diff
+        self.partitions = Partitions()  # Components over green edges
+
+    def version(self):
+        """
+        Return a key that changes whenever the rendered graph would
+
+        The generation only moves when nodes come or go or an edge changes
+        color.  Latency summaries and report times change on almost every
+        report, so they are picked up once a poll cycle instead.
+        """
+        return (self.created, self.generation, int(time.time() // GBPOLL))
+
+    def addnode(self, node_id):
+        if node_id not in self.nodes:
+            self.nodes[node_id] = None
+            self.partitions.addnode(node_id)
+            with changelock:
+                self.newnodes.append(node_id)
+
+    def getedge(self, source, target, alive=None):
+        """
+        Return the edge from source to target, creating it if needed
+        """
+        e = self.edges.get((source, target))
+        if e is None:
+            self.addnode(source)
+            self.addnode(target)
+            e = self.edges[(source, target)] = Edge(source, target, alive)
+            self.out.setdefault(source, {})[target] = e
+            self.generation += 1
+            self.markchanged(e)
+        return e
+
+    def removenodes(self, node_ids):
+        """
+        Drop nodes and every edge to or from them in one pass over the
+        edges - their expiry heap entries are skipped when they come due
+        """
+        node_ids = {n for n in node_ids if n in self.nodes}
+        if not node_ids:
+            return
+        for node_id in node_ids:
+            del self.nodes[node_id]
+            self.out.pop(node_id, None)
+        for key in [k for k in self.edges if k[0] in node_ids or k[1] in node_ids]:
+            del self.edges[key]
+            self.out.get(key[0], {}).pop(key[1], None)
+        with changelock:
+            self.newnodes = [n for n in self.newnodes if n not in node_ids]
+            self.changed = {k: e for k, e in self.changed.items()
+                            if k[0] not in node_ids and k[1] not in node_ids}
+        self.partitions.removenodes(node_ids)
+        self.generation += 1
+        if alerts is not None:
+            alerts.forget({e.id for e in self.edges.values()})
+
+    def markchanged(self, e):
+        with changelock:
+            self.changed[(e.source, e.target)] = e
+
+    def takechanges(self):
+        """
+        Return and reset the nodes and edges changed since the last call
+        """
+        with changelock:
+            nodes, self.newnodes = self.newnodes, []
+            edges, self.changed = self.changed, {}
+        return nodes, list(edges.values())
+
+    def refresh(self, e, alive, currentts):
+        """
+        Record a fresh report for an edge and arm its expiry timer
+        """
+        old = e.color
+        e.refresh(alive, currentts)
+        if e.color != old:
+            edgetransition(self, e, old, currentts)
+        if not e.queued:
+            e.queued = True
+            heapq.heappush(self.expiry, (currentts + TTL, e.id, (e.source, e.target)))
+
+    def touch(self, source, currentts):
+        """
+        Refresh every edge from source with its last reported state
+        """
+        for e in self.out.get(source, {}).values():
+            self.refresh(e, e.reported, currentts)
+
+    def expire(self, currentts):
+        """
+        Gray out edges that have passed TTL
+
+        Returns seconds until the next edge is due or None if none are.
+        """
+        heap = self.expiry
+        while heap and heap[0][0] <= currentts:
+            deadline, eid, key = heapq.heappop(heap)
+            e = self.edges.get(key)
+            if e is None:
+                continue
+            if e.ts + TTL > currentts:
+                # Refreshed since it was queued - wait for the new deadline
+                heapq.heappush(heap, (e.ts + TTL, eid, key))
+                continue
+            e.queued = False
+            if e.color != "gray":
+                old = e.color
+                e.color = "gray"
+                serverstats['expired'] += 1
+                log.debug("GRAPH: Edge %s expired" % eid)
+                edgetransition(self, e, old, currentts)
+        serverstats['expiry_pending'] = len(heap)
+        if heap:
+            return heap[0][0] - currentts
+        return None
+
+    def todict(self):
+        return {"nodes": list(self.nodes),
+                "edges": [e.todict() for e in list(self.edges.values())]}
+
+# Partitions
+def strongcomponents(nodes, out):
+    """
+    Function to find the strongly connected components of the subgraph
+    induced by nodes (a set) - iterative Tarjan, returns a list of sets
+    """
+    index = {}
+    low = {}
+    stack = []
+    onstack = set()
+    found = []
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        onstack.add(root)
+        work = [(root, iter(out.get(root, ())))]
+        while work:
+            node, targets = work[-1]
+            for target in targets:
+                if target not in nodes:
+                    continue
+                if target not in index:
+                    index[target] = low[target] = len(index)
+                    stack.append(target)
+                    onstack.add(target)
+                    work.append((target, iter(out.get(target, ()))))
+                    break
+                if target in onstack:
+                    low[node] = min(low[node], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        onstack.discard(member)
+                        component.add(member)
+                        if member == node:
+                            break
+                    found.append(component)
+    return found
+
+class Partitions(object):
+    """
+    Strongly connected components of the graph over green edges, kept up
+    to date as edges change color
+
+    A green edge inside a component changes nothing, and neither does an
+    edge between components turning red or gray.  The other two cases
+    are queued and resolved together, usually once per ingest batch:
+    an edge lost inside a component is ignored if it came back or its
+    source still reaches its target, and otherwise re-runs Tarjan on
+    just that component, since components can only split along their
+    own edges; a new edge between components merges the nodes that lie
+    on a cycle through it (reachable from its target and reaching its
+    source).  A healthy grid is one component, so most updates are cheap.
+    """
+    __slots__ = ("out", "into", "comp", "members", "nextid", "dirty", "pending", "lock")
+
+    def __init__(self):
+        self.out = {}       # node -> set of targets over green edges
+        self.into = {}      # node -> set of sources over green edges
+        self.comp = {}      # node -> component id
+        self.members = {}   # component id -> set of nodes
+        self.nextid = 0
+        self.dirty = {}     # component id -> internal edges it lost
+        self.pending = []   # green edges added between components
+        self.lock = threading.Lock()
+
+    def newcomponent(self, nodes):
+        cid = self.nextid
+        self.nextid += 1
+        self.members[cid] = nodes
+        for n in nodes:
+            self.comp[n] = cid
+
+    def addnode(self, node_id):
+        with self.lock:
+            if node_id not in self.comp:
+                self.newcomponent({node_id})
+
+    def edge(self, source, target, green):
+        """
+        Record an edge turning green (or no longer green)
+        """
+        if source == target:
+            return
+        self.addnode(source)
+        self.addnode(target)
+        with self.lock:
+            if green:
+                self.out.setdefault(source, set()).add(target)
+                self.into.setdefault(target, set()).add(source)
+                if self.comp[source] != self.comp[target]:
+                    self.pending.append((source, target))
+            else:
+                self.out.get(source, set()).discard(target)
+                self.into.get(target, set()).discard(source)
+                if self.comp[source] == self.comp[target]:
+                    self.dirty.setdefault(self.comp[source], []).append((source, target))
+
+    def removenodes(self, node_ids):
+        """
+        Drop nodes and their green edges
+        """
+        for node_id in node_ids:
+            for target in list(self.out.get(node_id, ())):
+                self.edge(node_id, target, False)
+            for source in list(self.into.get(node_id, ())):
+                self.edge(source, node_id, False)
+        self.resolve()
+        with self.lock:
+            for node_id in node_ids:
+                self.out.pop(node_id, None)
+                self.into.pop(node_id, None)
+                cid = self.comp.pop(node_id, None)
+                if cid is not None:
+                    self.members[cid].discard(node_id)
+                    if not self.members[cid]:
+                        del self.members[cid]
+
+    def reach(self, start, adjacency, within=None, goal=None):
+        """
+        Return the nodes reachable from start over adjacency (out or into),
+        stopping early once goal is found
+        """
+        seen = {start}
+        queue = [start]
+        for node in queue:
+            for n in adjacency.get(node, ()):
+                if n not in seen and (within is None or n in within):
+                    seen.add(n)
+                    if n == goal:
+                        return seen
+                    queue.append(n)
+        return seen
+
+    def connected(self, nodes, lost):
+        """
+        Return True if nodes, strongly connected before the lost edges
+        went, still are - each lost edge must be bypassed by a path
+        """
+        for source, target in lost:
+            if target in self.out.get(source, ()):
+                continue
+            if target not in self.reach(source, self.out, nodes, target):
+                return False
         return True
-    except:
-        sys.stderr.write("UPDATEGRAPH: Invalid payload - ignored\n")
-        return False
 
-# Threads
-def pollgridbugs():
+    def resolve(self):
+        """
+        Apply queued changes - returns True if any component changed
+        """
+        with self.lock:
+            if not self.dirty and not self.pending:
+                return False
+            changed = False
+            for cid, lost in self.dirty.items():
+                nodes = self.members.get(cid)
+                if nodes is None or self.connected(nodes, lost):
+                    continue
+                del self.members[cid]
+                changed = True
+                for component in strongcomponents(nodes, self.out):
+                    self.newcomponent(component)
+            self.dirty = {}
+            for source, target in self.pending:
+                if target not in self.out.get(source, ()) or self.comp[source] == self.comp[target]:
+                    continue
+                forward = self.reach(target, self.out)
+                if source not in forward:
+                    continue
+                cycle = self.reach(source, self.into, forward)
+                for cid in {self.comp[n] for n in cycle}:
+                    del self.members[cid]
+                self.newcomponent(cycle)
+                changed = True
+            self.pending = []
+            return changed
+
+    def components(self):
+        """
+        Return the components as sorted lists, largest first
+        """
+        self.resolve()
+        with self.lock:
+            return sorted((sorted(m) for m in self.members.values()), key=lambda m: (-len(m), m))
+
+    def summary(self):
+        """
+        Return the components with how many nodes outside each one it can
+        reach and be reached from over the component graph
+        """
+        self.resolve()
+        with self.lock:
+            comp = self.comp
+            down = {cid: set() for cid in self.members}
+            up = {cid: set() for cid in self.members}
+            for source, targets in self.out.items():
+                for target in targets:
+                    if comp[source] != comp[target]:
+                        down[comp[source]].add(comp[target])
+                        up[comp[target]].add(comp[source])
+            result = []
+            for cid, nodes in self.members.items():
+                reaches = self.reach(cid, down) - {cid}
+                reached = self.reach(cid, up) - {cid}
+                result.append({"size": len(nodes), "nodes": sorted(nodes),
+                               "reaches": sum(len(self.members[c]) for c in reaches),
+                               "reached_by": sum(len(self.members[c]) for c in reached)})
+        result.sort(key=lambda c: (-c["size"], c["nodes"]))
+        return {"partitions": len(result), "nodes": len(comp),
+                "largest": result[0]["size"] if result else 0, "components": result}
+
+    def path(self, source, target):
+        """
+        Return the shortest path of green edges from source to target or None
+        """
+        with self.lock:
+            parents = {source: None}
+            queue = [source]
+            for node in queue:
+                if node == target:
+                    path = []
+                    while node is not None:
+                        path.append(node)
+                        node = parents[node]
+                    return path[::-1]
+                for n in self.out.get(node, ()):
+                    if n not in parents:
+                        parents[n] = node
+                        queue.append(n)
+        return None
+
+    def reachable(self, node, backward=False):
+        """
+        Return the nodes node can reach (or that reach node if backward)
+        """
+        with self.lock:
+            return self.reach(node, self.into if backward else self.out) - {node}
+
+# Latency
+class RttRing(object):
     """
-    Thread to poll for current conditions and update graph
+    Fixed size ring buffer of probe round-trip times in milliseconds
+
+    Lost probes are stored as NaN so loss and percentiles come from the
+    same window and memory stays at SAMPLES doubles per edge.
     """
-    global running, serverstats, URL, bugs, clearbugs
-    sys.stderr.write(" + pollgridbugs thread\n")
-    nextupdate = time.time()
+    __slots__ = ("samples", "pos", "count")
 
-    # Time Loop to update current conditions data
-    while(running):
-        currentts = time.time()
+    def __init__(self, size=None):
+        self.samples = array('d', bytes(8 * (size or SAMPLES)))
+        self.pos = 0
+        self.count = 0
 
-        # If clearbugs is in action - wait
-        if clearbugs:
-            nextupdate = currentts + GBPOLL
-            continue
+    def add(self, rtt):
+        """
+        Record a round-trip time in milliseconds or None for a lost probe
+        """
+        self.samples[self.pos] = float('nan') if rtt is None else rtt
+        self.pos = (self.pos + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
 
-        # Is it time for an update?
-        if currentts >= nextupdate:
-            nextupdate = currentts + GBPOLL
+    def summary(self):
+        """
+        Return p50/p95/p99 (ms), loss (0-1) and sample count for the window
+        """
+        window = self.samples[:self.count] if self.count < len(self.samples) else self.samples
+        valid = sorted(x for x in window if not math.isnan(x))
+        result = {"p50": None, "p95": None, "p99": None,
+                  "loss": round(1 - len(valid) / self.count, 3) if self.count else 0.0,
+                  "n": self.count}
+        if valid:
+            for name, p in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+                rank = max(0, min(len(valid) - 1, int(math.ceil(p * len(valid))) - 1))
+                result[name] = round(valid[rank], 3)
+        return result
 
-            for node in bugs['gridbugs']:
-                URL = "http://%s/ping" % node['host']
-                log.debug("Ping URL = %s\n" % URL)
-                serverstats['poll'] += 1
-                try:
-                    response = requests.get(URL, timeout=TIMEOUT)
-                    if not running:
-                        return
-                    if response.status_code == 200: 
-                        log.debug("Got response from grid %s %s" % (node['id'], node['host']))
-                        node['alive'] = True 
-                        # Attempt to send payload to update node
-                        try:
-                            headers = {'key': GRIDKEY}
-                            sname = "http://%s/post" % node['host']
-                            r = requests.post(sname, json=bugs, headers=headers)
-                            log.debug("Sent graph to node %s %s" % (node['id'], node['host']))
-                            # print("Sent graph to node %s %s" % (node['id'], node['host']))
-                        except:
-                            #print("Unable to send graph to node %s" % node['host'])
-                            log.debug("Unable to send graph to node %s" % node['host'])
-                        # Attempt to poll node for any graph updates
-                        try:
-                            if not running:
-                                return
-                            sname = "http://%s/bugs" % node['host']
-                            r = requests.get(sname, timeout=TIMEOUT)
-                            payload = r.json()
-                            log.debug("GET: %r" % payload)
-                            updategraph(payload)
-                        except:
-                            log.debug("Unable to update graph from node %s" % node['host'])
- 
-                    else:
-                        # no response
-                        log.debug("Got %d response from grid %s %s" % 
-                            (response.status_code, node['id'], node['host'])) 
-                        node['alive'] = False 
-                except:
-                    # no response 
-                    log.debug("No response from grid %s %s" % (node['id'], node['host']))   
-                    node['alive'] = False 
-                    pass
+def latencychanged(old, new):
+    """
+    Function to decide if a latency summary moved enough to gossip
+    """
+    if old is None or abs(old["loss"] - new["loss"]) >= 0.05:
+        return True
+    if old["p50"] is None or new["p50"] is None:
+        return old["p50"] != new["p50"]
+    return abs(new["p50"] - old["p50"]) > LATENCYCHANGE * max(old["p50"], 0.1)
 
-            # Update graph based on discovery
-            updategraph()
+# Availability
+ROLLUPWINDOWS = (("1m", 10, 6), ("1h", 300, 12), ("24h", 3600, 24))  # name, bucket seconds, buckets
+ROLLUPFIELDS = 4    # times up, times down, seconds green, seconds red
+ROLLUPNAMES = [name for name, width, n in ROLLUPWINDOWS]
+ROLLUPEMPTY = array('f', bytes(4 * ROLLUPFIELDS))
 
-            # Send in update to server node
-            try:
-                if not running:
-                    return
-                headers = {'key': GRIDKEY}
-                sname = "http://%s/post" % SERVERNODE
-                r = requests.post(sname, json=bugs, headers=headers, timeout=TIMEOUT)
-                log.debug(f"SENT: Status Code: {r.status_code}, Response: {r.json()}")
-            except:
-                log.debug("Unable to update server %s" % SERVERNODE)
+class Rollup(object):
+    """
+    Availability of an edge over the last minute, hour and day
 
-        time.sleep(5)
-    sys.stderr.write('\r ! pollgridbugs Exit\n')
+    Each window is a ring of fixed-width buckets holding how often the
+    edge went up (green) and down (red) and the seconds it spent green
+    and red, all in one float array, so an edge costs the same memory
+    however long it lives.  It is only updated when the edge changes
+    color, so refreshes cost nothing.  Changes add to the current 10
+    second bucket, which is downsampled into each window at the next
+    change after it closes, clearing buckets time has moved past.  Time
+    in the current color is added when it is read and gray time (no
+    reports) is whatever is left of the window.  Only the ingest thread
+    updates it.
+    """
+    __slots__ = ("buckets", "heads", "color", "since", "first", "until",
+                 "up", "down", "green", "red")
 
-class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
-    daemon_threads = True
-    pass
+    def __init__(self):
+        self.buckets = array('f', bytes(4 * ROLLUPFIELDS * sum(n for name, w, n in ROLLUPWINDOWS)))
+        self.heads = [None] * len(ROLLUPWINDOWS)     # newest bucket number of each window
+        self.color = None
+        self.since = None   # when color was last credited
+        self.first = None   # first update
+        self.until = None   # end of the current bucket
+        self.up = self.down = 0         # current bucket
+        self.green = self.red = 0.0
 
-class handler(BaseHTTPRequestHandler):
-    def log_message(self, format, *args):
-        if DEBUGMODE:
-            sys.stderr.write("%s - - [%s] %s\n" %
-                         (self.address_string(),
-                          self.log_date_time_string(),
-                          format%args))
-        else:
-            pass
+    def roll(self, t):
+        """
+        Close the current bucket into every window, clear the buckets
+        time has moved past and start the one holding time t, crediting
+        any whole buckets passed on the way
+        """
+        start = t - t % ROLLUPWINDOWS[0][1]
+        buckets = self.buckets
+        heads = self.heads
+        closed = None
+        if self.until is not None:
+            self.credit(self.until)
+            closed = self.until - ROLLUPWINDOWS[0][1]
+        field = {"green": 2, "red": 3}.get(self.color)
+        base = 0
+        for k, (name, width, n) in enumerate(ROLLUPWINDOWS):
+            if closed is not None:
+                # The closed bucket lies in the newest bucket of every window
+                slot = base + (int(closed // width) % n) * ROLLUPFIELDS
+                buckets[slot] += self.up
+                buckets[slot + 1] += self.down
+                buckets[slot + 2] += self.green
+                buckets[slot + 3] += self.red
+            now = int(t // width)
+            head = heads[k]
+            if head is None or now > head:
+                for b in range(now - n + 1 if head is None else max(head + 1, now - n + 1), now + 1):
+                    slot = base + (b % n) * ROLLUPFIELDS
+                    buckets[slot:slot + ROLLUPFIELDS] = ROLLUPEMPTY
+                heads[k] = now
+            if field is not None and start > self.since:
+                # No updates for whole buckets - the color held throughout
+                s = max(self.since, (now - n + 1) * width)
+                while s < start:
+                    b = int(s // width)
+                    e = min(start, (b + 1) * width)
+                    buckets[base + (b % n) * ROLLUPFIELDS + field] += e - s
+                    s = e
+            base += n * ROLLUPFIELDS
+        if self.since is not None:
+            self.since = max(self.since, start)
+        self.up = self.down = 0
+        self.green = self.red = 0.0
+        self.until = start + ROLLUPWINDOWS[0][1]
 
-    def address_string(self):
-        # replace function to avoid lookup delays
-        host, hostport = self.client_address[:2]
-        return host
+    def credit(self, t):
+        """
+        Credit the time since the last credit to the color then held
+        """
+        if self.since is not None and t > self.since:
+            if self.color == "green":
+                self.green += t - self.since
+            elif self.color == "red":
+                self.red += t - self.since
+            self.since = t
 
-    def do_POST(self):
-        global  URL, clearbugs, MAXPAYLOAD
-        self.send_response(200)
-        message = "Error"
-        contenttype = 'application/json'
-        if self.path == '/post' and not clearbugs:
-            message = '{"status": "OK"}'   
-            content_len = int(self.headers.get('content-length', 0))
-            if content_len > MAXPAYLOAD:
-                message = "Error: Received Heavy Payload - Ignoring"
-            else:
-                post_body = self.rfile.read(content_len)
-                try:
-                    post_json = json.loads(post_body)
-                    key = self.headers.get('key', '')
-                    log.debug("POST %d bytes from %s (key = %s) json: %r" % (content_len, post_json["node_id"], key, post_json))
-                    if key != GRIDKEY:
-                        log.debug("- Unauthorized Payload from %s" % post_json["node_id"])
-                    else:
-                        log.debug("+ Authorized Payload from %s" % post_json["node_id"])
-                        updategraph(post_json)
-                except:
-                    log.debug("Error: Invalid Payload")
-                    message = "Error: Invalid Payload"
-        elif self.path == '/post':
-            # clear bug mode
-            message = "I'm busy clearing bugs"
-        else:
-            # Error
-            message = "Error: Unsupported Request"
+    def update(self, color, t, count=True):
+        """
+        Credit the time since the last update to the color then held and
+        switch to color, counting the edge going up (green) or down (red)
+        """
+        if self.until is None or t >= self.until:
+            self.roll(t)
+        elif t < self.until - ROLLUPWINDOWS[0][1]:
+            # Older than the current bucket - only possible if the clock steps back
+            return
+        self.credit(t)
+        if self.first is None:
+            self.first = self.since = t
+        if count and color != self.color:
+            if color == "green":
+                self.up += 1
+            elif color == "red":
+                self.down += 1
+        self.color = color
+
+    def summary(self, now, window=None):
+        """
+        Return the counts, seconds in each state and availability (green
+        time over green and red time) of each window, or just one
+        """
+        result = {}
+        base = 0
+        buckets = self.buckets
+        current = self.until - ROLLUPWINDOWS[0][1] if self.until is not None else None
+        for k, (name, width, n) in enumerate(ROLLUPWINDOWS):
+            head = self.heads[k]
+            if window is not None and name != window:
+                base += n * ROLLUPFIELDS
+                continue
+            nowbucket = int(now // width)
+            start = (nowbucket - n + 1) * width
+            totals = [0.0] * ROLLUPFIELDS
+            if head is not None:
+                for b in range(max(head, nowbucket) - n + 1, head + 1):
+                    slot = base + (b % n) * ROLLUPFIELDS
+                    for f in range(ROLLUPFIELDS):
+                        totals[f] += buckets[slot + f]
+                if current >= start:
+                    totals[0] += self.up
+                    totals[1] += self.down
+                    totals[2] += self.green
+                    totals[3] += self.red
+                if self.color in ("green", "red") and now > self.since:
+                    totals[2 if self.color == "green" else 3] += now - max(self.since, start)
+            span = max(0.0, now - max(start, self.first)) if self.first is not None else 0.0
+            known = totals[2] + totals[3]
+            result[name] = {"up": int(totals[0]), "down": int(totals[1]),
+                "green_s": round(totals[2], 1), "red_s": round(totals[3], 1),
+                "gray_s": round(max(0.0, span - known), 1),
+                "availability": round(totals[2] / known, 5) if known else None}
+            base += n * ROLLUPFIELDS
+        return result
+
+# Metrics
+METRICTYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICBUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)     # seconds
+# Stats that can go down - the rest are exported as counters
+STATGAUGES = ("probe_inflight", "probe_late_ms", "probe_late_max_ms", "probe_backoff",
+              "poll_cycle", "poll_cycle_max",
+              "poll_concurrency", "pool_sessions", "ingest_queue", "ingest_queue_max",
+              "ingest_latency_ms", "ingest_latency_max_ms", "expiry_pending",
+              "sse_subscribers", "reload_ms", "reload_max_ms", "partitions",
+              "alerts_pending", "alerts_queued")
+
+def metriclabel(value):
+    """
+    Function to escape a Prometheus label value
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Histogram(object):
+    """
+    Prometheus histogram of durations in seconds with one series per
+    value of an optional label
+
+    Observing is a bisect and two increments under a lock, cheap enough
+    to leave on in the request, poll and ingest paths.
+    """
+    __slots__ = ("name", "help", "label", "buckets", "series", "lock")
+
+    def __init__(self, name, help, label=None, buckets=METRICBUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.series = {}    # label value -> [count per bucket..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, value=""):
+        """
+        Record a duration in seconds under a label value
+        """
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            counts = self.series.get(value)
+            if counts is None:
+                counts = self.series[value] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += seconds
+
+    def render(self, lines):
+        """
+        Append the histogram in text exposition format to lines
+        """
+        lines.append("# HELP %s %s" % (self.name, self.help))
+        lines.append("# TYPE %s histogram" % self.name)
+        with self.lock:
+            series = sorted((k, list(v)) for k, v in self.series.items())
+        for value, counts in series:
+            label = '%s="%s"' % (self.label, metriclabel(value)) if self.label else ""
+            total = 0
+            for bound, n in zip(self.buckets + (None,), counts):
+                total += n
+                le = 'le="%s"' % ("+Inf" if bound is None else "%g" % bound)
+                lines.append("%s_bucket{%s} %d" % (self.name, ",".join(filter(None, (label, le))), total))
+            label = "{%s}" % label if label else ""
+            lines.append("%s_sum%s %r" % (self.name, label, counts[-1]))
+            lines.append("%s_count%s %d" % (self.name, label, total))
+
+def metric(lines, name, kind, help, samples):
+    """
+    Function to append a counter or gauge given as (labels, value) samples
+    in text exposition format to lines
+    """
+    if help:
+        lines.append("# HELP gridbug_%s %s" % (name, help))
+    lines.append("# TYPE gridbug_%s %s" % (name, kind))
+    for labels, value in samples:
+        labels = ",".join('%s="%s"' % (k, metriclabel(v)) for k, v in labels)
+        lines.append("gridbug_%s%s %r" % (name, "{%s}" % labels if labels else "", value))
+
+# History
+class HistoryLog(object):
+    """
+    Append-only memory-mapped log of edge state transitions
+
+    The log is a directory of fixed size segment files.  Each segment has
+    a 32 byte header (magic, record size, capacity, count, first ts) and
+    then fixed-width 96 byte records appended in time order:
 
-        # Counts 
-        if "Error" in message:
-            log.debug("POST Path %s = %s" % (self.path, message))
-            serverstats['errors'] = serverstats['errors'] + 1
+        ts (double), rtt ms (float, NaN if unknown), state (int8: 1 green,
+        0 red, -1 gray), source and target (IDSIZE bytes utf8, NUL padded)
+
+    Records are found by binary search on ts so queries only touch the
+    pages they need.  When a segment fills a new one is started and the
+    oldest segments beyond HISTORYSEGMENTS are deleted.
+    """
+    MAGIC = b"GBHIST01"
+    IDSIZE = 40     # Longest node id in bytes - checkbugs() rejects longer ones
+    HEADER = struct.Struct("<8sIIId4x")
+    RECORD = struct.Struct("<dfb3x%ds%ds" % (IDSIZE, IDSIZE))
+    STATES = {"green": 1, "red": 0, "gray": -1}
+    COLORS = {1: "green", 0: "red", -1: "gray"}
+
+    def __init__(self, path, records=None, segments=None):
+        self.path = path
+        self.records = records or HISTORYRECORDS
+        self.segments = segments or HISTORYSEGMENTS
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+        self.count = 0
+        os.makedirs(path, exist_ok=True)
+        names = self.segmentfiles()
+        if names:
+            self.openappend(names[-1])
         else:
-            if self.path in serverstats["uri"]:
-                serverstats["uri"][self.path] += 1
-            else:
-                serverstats["uri"][self.path] = 1
-        serverstats['posts'] = serverstats['posts'] + 1
+            self.rotate(time.time())
 
-        # Send headers and payload
-        self.send_header('Content-type',contenttype)
-        self.send_header('Content-Length', str(len(message)))
-        self.end_headers()
-        self.wfile.write(bytes(message, "utf8"))
+    def segmentfiles(self):
+        return sorted(n for n in os.listdir(self.path)
+                      if n.startswith("gridbug-") and n.endswith(".hist"))
 
-    def do_GET(self):
-        global URL, CONSOLE, bugs, graph, clearbugs, ROLE, BUILD, ID
-        self.send_response(200)
-        message = "Error"
-        contenttype = 'application/json'
-        result = {}  # placeholder
-        if self.path == '/ping' or self.path == '/stop':
-            message = '{"status": "OK"}'
-        elif self.path == '/favicon.ico':
-            contenttype = 'image/x-icon'
-            message = 'data:image/x-icon;base64,iVBORw0KGgoAAAANSUhEUgAAABAAAAAQEAYAAABPYyMiAAAABmJLR0T///////8JWPfcAAAACXBIWXMAAABIAAAASABGyWs+AAAAF0lEQVRIx2NgGAWjYBSMglEwCkbBSAcACBAAAeaR9cIAAAAASUVORK5CYII='
-        elif self.path == '/text':
-            # Display friendly intro
-            contenttype = 'text/html'
-            message = '<html>\n<head><meta http-equiv="refresh" content="5" />\n'
-            message += '<style>p, td, th { font-family: Helvetica, Arial, sans-serif; font-size: 10px;}</style>\n' 
-            message += '<style>h1 { font-family: Helvetica, Arial, sans-serif; font-size: 20px;}</style>\n' 
-            message += '</head>\n<body>\n<h1>GridBug %s v%s - ID %s</h1>\n\n' % (ROLE.title(), BUILD, ID)
-            if len(bugs['gridbugs']) < 1:
-                message = message + "<p>Error: No gridbug data available</p>"
-            else:
-                message = message + '<table>\n<tr><th align ="right">GridBug ID</th><th align ="right">Alive</th></tr>'
-                for i in bugs['gridbugs']:
-                    if 'alive' in i:
-                        message = message + '<tr><td align ="right">%s</td><td align ="right">%s</td></tr>\n' % (i['id'],i['alive'])
-                message = message + "</table>\n"
-            message = message + '\n<p>Page refresh: %s</p>\n</body>\n</html>\n' % (
-                str(datetime.datetime.fromtimestamp(time.time())))
-        elif self.path == '/stats':
-            # Give Internal Stats
-            serverstats['ts'] = int(time.time())
-            serverstats['mem'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
-            delta = serverstats['ts'] - serverstats['start']
-            serverstats['uptime'] = str(datetime.timedelta(seconds=delta))
-            message = json.dumps(serverstats)
-        elif self.path == '/bugs' or self.path == '/gridbugs.json':
-            message = json.dumps(bugs)
-        elif self.path == '/raw':
-            message = json.dumps(graph)
-        elif self.path == '/graph':
-            nodes = []
-            edges = []
-            for n in graph["nodes"]:
-                nodes.append({"data": {"id": n}})
-            for e in graph["edges"]:
-                edges.append({"data": e })
-            output = {"nodes": nodes, "edges": edges}
-            message = json.dumps(output)
-        elif self.path == '/' or self.path == '/gridbug.html':
-            contenttype = 'text/html'
-            try:
-                with open(CONSOLE, 'r') as f:
-                    message = f.read()
-                    f.close()
-            except:
-                message = "Error: Unable to open gridbug.html"
-        elif self.path == '/time':
-            ts = time.time()
-            result["local_time"] = str(datetime.datetime.fromtimestamp(ts))
-            result["ts"] = ts
-            result["utc"] = str(datetime.datetime.utcfromtimestamp(ts)) 
-            delta = ts - serverstats['start']
-            result['uptime'] = str(datetime.timedelta(seconds=delta))
-            message = json.dumps(result)
-        elif self.path == '/clear':
-            contenttype = 'text/html'
-            log.debug("Clearing and reloading bugslist")
+    def openappend(self, name):
+        self.file = open(os.path.join(self.path, name), "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, size, capacity, self.count, firstts = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC or size != self.RECORD.size:
+            raise ValueError("%s is not a gridbug history segment" % name)
+        self.capacity = capacity
+
+    def rotate(self, currentts):
+        """
+        Start a new segment and drop the oldest beyond the retention limit
+        """
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+        ms = int(currentts * 1000)
+        while os.path.exists(os.path.join(self.path, "gridbug-%015d.hist" % ms)):
+            ms += 1
+        name = "gridbug-%015d.hist" % ms
+        size = self.HEADER.size + self.records * self.RECORD.size
+        with open(os.path.join(self.path, name), "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.RECORD.size, self.records, 0, currentts))
+            f.truncate(size)
+        self.openappend(name)
+        for old in self.segmentfiles()[:-self.segments]:
+            os.remove(os.path.join(self.path, old))
+            log.debug("HISTORY: Removed segment %s" % old)
+
+    def append(self, currentts, source, target, color, rtt=None):
+        with self.lock:
+            if self.count >= self.capacity:
+                self.rotate(currentts)
+            offset = self.HEADER.size + self.count * self.RECORD.size
+            self.RECORD.pack_into(self.map, offset, currentts,
+                float('nan') if rtt is None else rtt, self.STATES.get(color, -1),
+                source.encode("utf8"), target.encode("utf8"))
+            self.count += 1
+            struct.pack_into("<I", self.map, 16, self.count)
+
+    def unpack(self, buf, index):
+        ts, rtt, state, source, target = self.RECORD.unpack_from(buf,
+            self.HEADER.size + index * self.RECORD.size)
+        return {"ts": ts, "source": source.rstrip(b"\0").decode("utf8", "replace"),
+                "target": target.rstrip(b"\0").decode("utf8", "replace"),
+                "color": self.COLORS.get(state, "gray"),
+                "rtt": None if math.isnan(rtt) else round(rtt, 2)}
+
+    def edgekeys(self, edge):
+        """
+        Return the packed source and target fields an edge id can match -
+        ids may contain dots so every split is tried
+        """
+        keys = set()
+        size = self.IDSIZE
+        for i, c in enumerate(edge):
+            if c == ".":
+                source, target = edge[:i].encode("utf8"), edge[i + 1:].encode("utf8")
+                if len(source) <= size and len(target) <= size:
+                    keys.add(source.ljust(size, b"\0") + target.ljust(size, b"\0"))
+        return keys
+
+    def scan(self, start, end, edge=None, limit=10000):
+        """
+        Return transitions with start <= ts <= end, optionally for one edge
+
+        The lock is only held to list the segments - they are read through
+        their own read-only maps so appends carry on meanwhile.
+        """
+        result = []
+        with self.lock:
+            names = self.segmentfiles()
+        keys = self.edgekeys(edge) if edge is not None else None
+        ids = self.RECORD.size - 2 * self.IDSIZE    # offset of source in a record
+        for i, name in enumerate(names):
+            if i + 1 < len(names) and int(names[i + 1][8:23]) / 1000 < start:
+                continue    # Segment ends before the window
+            if int(name[8:23]) / 1000 > end:
+                break
             try:
-                clearbugs = True
-                time.sleep(1)
-                bugs = {}
-                graph = {"nodes": [], "edges": []}
-                loadbugs()
-                clearbugs = False
-                message = "Bugs Cleared\n"
-            except:
-                clearbugs = False
-                message = "ERROR: Unable to Clear Bugs\n"
-        else:
-            # Error
-            message = "Error: Unsupported Request\n"
+                f = open(os.path.join(self.path, name), "rb")
+            except FileNotFoundError:
+                continue    # Rotated out since it was listed
+            with f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Records are written before the count so every one counted is whole
+            count = self.HEADER.unpack_from(buf, 0)[3]
+            # Binary search for the first record at or after start
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if struct.unpack_from("<d", buf, self.HEADER.size + mid * self.RECORD.size)[0] < start:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if keys is None:
+                indexes = range(lo, count)
+            else:
+                # Jump between matches of the packed ids instead of
+                # stepping through every record
+                indexes = []
+                first = self.HEADER.size + lo * self.RECORD.size + ids
+                last = self.HEADER.size + count * self.RECORD.size
+                for key in keys:
+                    pos = buf.find(key, first, last)
+                    while pos >= 0:
+                        index, rest = divmod(pos - self.HEADER.size - ids, self.RECORD.size)
+                        if rest == 0:
+                            indexes.append(index)
+                        pos = buf.find(key, pos + 1, last)
+                indexes.sort()
+            for index in indexes:
+                offset = self.HEADER.size + index * self.RECORD.size
+                if struct.unpack_from("<d", buf, offset)[0] > end:
+                    break
+                result.append(self.unpack(buf, index))
+                if len(result) >= limit:
+                    break
+            buf.close()
+            if len(result) >= limit:
+                break
+        return result
+
+    def tail(self, records):
+        """
+        Return the latest record for each edge among the last records
+        """
+        latest = {}
+        with self.lock:
+            count = self.count
+            for index in range(count - 1, max(count - records, 0) - 1, -1):
+                r = self.unpack(self.map, index)
+                latest.setdefault((r["source"], r["target"]), r)
+        return list(latest.values())
 
-        # Counts 
-        if "Error" in message:
-            log.debug("GET Path %s = %s" % (self.path, message))
-            serverstats['errors'] = serverstats['errors'] + 1
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.file.close()
+                self.map = None
+
+def edgetransition(graph, e, old, currentts):
+    """
+    Function called whenever an edge of graph changes color
+    """
+    serverstats['transitions'] += 1
+    graph.generation += 1
+    graph.markchanged(e)
+    if (old == "green") != (e.color == "green"):
+        graph.partitions.edge(e.source, e.target, e.color == "green")
+    if AVAILABILITY:
+        if e.rollup is None:
+            e.rollup = Rollup()
+        e.rollup.update(e.color, currentts)
+    if alerts is not None:
+        alerts.transition(e)
+    if history is not None:
+        rtt = None
+        if e.latency and e.latency.get("p50") is not None:
+            rtt = e.latency["p50"]
+        try:
+            history.append(currentts, e.source, e.target, e.color, rtt)
+        except Exception as err:
+            log.debug("HISTORY: Unable to record %s - %s" % (e.id, err))
+
+def warmgraph(graph):
+    """
+    Function to restore the last known state of each edge from the tail
+    of the history log - edges older than TTL expire straight away
+    """
+    restored = 0
+    for r in history.tail(history.records):
+        e = graph.getedge(r["source"], r["target"])
+        if e.ts is not None:
+            continue
+        e.reported = {"green": True, "red": False}.get(r["color"])
+        e.refresh(e.reported, r["ts"])
+        e.color = r["color"]
+        if e.color == "green":
+            graph.partitions.edge(e.source, e.target, True)
+        if AVAILABILITY:
+            # Availability counts from now - we were not watching before
+            e.rollup = Rollup()
+            e.rollup.update(e.color, time.time(), False)
+        if r["rtt"] is not None:
+            e.latency = {"p50": r["rtt"], "p95": None, "p99": None, "loss": 0.0, "n": 0}
+        e.queued = True
+        heapq.heappush(graph.expiry, (r["ts"] + TTL, e.id, (e.source, e.target)))
+        restored += 1
+    graph.generation += 1
+    graph.takechanges()
+    sys.stderr.write(" + Warmed graph with %d edges from history\n" % restored)
+
+# Response Cache
+class CachedResponse(object):
+    """
+    Encoded response body with its ETag and lazily built gzip variant
+    """
+    __slots__ = ("version", "body", "etag", "gzipped")
+
+    def __init__(self, version, body):
+        self.version = version
+        self.body = body
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+        self.gzipped = None
+
+    def gzip(self):
+        if self.gzipped is None:
+            self.gzipped = gzip.compress(self.body, 6)
+        return self.gzipped
+
+class ResponseCache(object):
+    """
+    API responses rendered once per version of the data behind them
+
+    Repeated requests for data that has not changed cost a dict lookup
+    and conditional requests with a matching ETag get a 304.
+    """
+    def __init__(self):
+        self.entries = {}   # path -> CachedResponse
+
+    def get(self, path, version, render):
+        entry = self.entries.get(path)
+        if entry is None or entry.version != version:
+            bumpstat('cache_misses')
+            body = render()
+            if isinstance(body, str):
+                body = body.encode("utf8")
+            entry = self.entries[path] = CachedResponse(version, body)
         else:
-            if self.path in serverstats["uri"]:
-                serverstats["uri"][self.path] += 1
-            else:
-                serverstats["uri"][self.path] = 1
-        serverstats['gets'] = serverstats['gets'] + 1
+            bumpstat('cache_hits')
+        return entry
 
-        # Send headers and payload
-        self.send_header('Content-type',contenttype)
-        self.send_header('Content-Length', str(len(message)))
-        self.end_headers()
-        self.wfile.write(bytes(message, "utf8"))
+def edgeelement(e, window=None, now=None):
+    """
+    Function to render an edge as a cytoscape element - with window set
+    it carries its availability over that rollup window
+    """
+    data = e.todict()
+    # Refreshed on every report - leaving it out keeps the body (and ETag)
+    # the same until something visible changes
+    data.pop("ts", None)
+    if e.latency and e.latency["p50"] is not None:
+        data["weight"] = e.latency["p50"]
+    if window is not None and e.rollup is not None:
+        data["availability"] = e.rollup.summary(now, window)[window]["availability"]
+    return {"data": data}
 
-def api(port):
+def rendergraph(graph, window=None):
     """
-    API Server - Thread to listen for commands on port 
+    Function to render a graph as cytoscape elements for the console
     """
-    sys.stderr.write(" + apiServer thread - Listening on http://localhost:%d\n" % port)
+    now = time.time()
+    nodes = []
+    edges = []
+    # Snapshot first - the ingest thread adds nodes and edges meanwhile
+    for n in list(graph.nodes):
+        nodes.append({"data": {"id": n}})
+    for e in list(graph.edges.values()):
+        edges.append(edgeelement(e, window, now))
+    return json.dumps({"nodes": nodes, "edges": edges})
 
-    with ThreadingHTTPServer(('', port), handler) as server:
-        try:
-            # server.serve_forever()
-            while running:
-                server.handle_request()
-        except:
-            print(' CANCEL \n')
-    sys.stderr.write('\r ! apiServer Exit\n')
+def renderavailability(graph, window=None, edge=None):
+    """
+    Function to list the availability rollups of every edge (or one)
+    """
+    now = time.time()
+    result = []
+    for e in list(graph.edges.values()):
+        if e.rollup is None or (edge is not None and e.id != edge):
+            continue
+        entry = {"id": e.id, "source": e.source, "target": e.target, "color": e.color}
+        entry.update(e.rollup.summary(now, window))
+        result.append(entry)
+    return result
 
-def loadbugs():
-    # Load the bugs
-    global bugs, graph, BUGLISTURL, GRIDBUGLIST, BUGLISTURL, NODEURL, ID, ROLE, BUILD
-    if BUGLISTURL == "":
-        # Load from local file
-        try:
-            with open(GRIDBUGLIST, 'r') as f:
-                bugs = json.load(f)
-                f.close()
-                sys.stderr.write(" + Loaded [%s]: %d bugs loaded (version %d)\n" 
-                    % (GRIDBUGLIST, len(bugs['gridbugs']), bugs['version']))
-        except:
-            sys.stderr.write(" ! ERROR: Unable to load grid bug list - tried %s\n" % GRIDBUGLIST)
-            sys.exit()
-    else:
-        # Load from URL
+# Server-Sent Events
+class EventHub(object):
+    """
+    Fan out graph changes to Server-Sent Event subscribers
+
+    The request handler writes the stream headers and hands its socket
+    over to the hub, so a subscriber does not hold a request
+    thread.  The eventhub thread writes queued events to all subscribers
+    with a selector and drops any that fall SSEBUFFER bytes behind.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}   # socket -> bytearray of unsent output
+        self.wakeup = socket.socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(False)
+
+    def subscribe(self, sock, snapshot):
+        """
+        Add a subscriber socket - snapshot() renders its first event and
+        is called under the hub lock so no diff can be missed
+        """
+        sock.setblocking(False)
+        with self.lock:
+            self.subscribers[sock] = bytearray(snapshot())
+        self.wake()
+
+    def publish(self, event, data):
+        message = ("event: %s\ndata: %s\n\n" % (event, data)).encode("utf8")
+        with self.lock:
+            for buf in self.subscribers.values():
+                buf += message
+            bumpstat('sse_events')
+        self.wake()
+
+    def wake(self):
         try:
-            r = requests.get(BUGLISTURL)
-            bugs = r.json()
-            sys.stderr.write(" + Loaded [%s]: %d bugs loaded (version %d)\n" 
-                % (BUGLISTURL, len(bugs['gridbugs']), bugs['version']))
-        except:
-            sys.stderr.write(" ! ERROR: Unable to load grid bug list - tried %s\n" % BUGLISTURL)
-            sys.exit()
+            self.wakeup[1].send(b"x")
+        except (BlockingIOError, OSError):
+            pass
 
-    # Validate bugs DB
-    nodes = []
-    for n in bugs['gridbugs']:
-        if n["id"] in nodes:
-            sys.stderr.write(" ! ERROR: Found duplicates in grid bug list - IDs must be unique\n")
-            sys.exit()
-        nodes.append(n["id"])
-        if n["id"] == ID:
-            NODEURL = n["host"]    # Self Hostname of Grid Node
-        print(n)
-    if ID not in nodes:
-        # We need to add ourself
-        sys.stderr.write(" * NOTICE: Adding myself to the grid bug list (%s, %s)\n" % (ID, NODEURL))
-        addbug(NODEURL, ID)
+    def owns(self, sock):
+        return sock in self.subscribers
 
-    # Add local identity to DB
-    bugs['node_id'] = ID
-    bugs['node_role'] = ROLE
-    bugs['node_build'] = BUILD
-    bugs['node_host'] = NODEURL
+    def drop(self, sel, sock):
+        with self.lock:
+            self.subscribers.pop(sock, None)
+        try:
+            sel.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
 
-# MAIN Thread
-if __name__ == "__main__":
-    # Create threads
-    thread_pollgridbugs = threading.Thread(target=pollgridbugs)
-    thread_api = threading.Thread(target=api, args=(APIPORT,))
-    
-    # Print header
-    sys.stderr.write("GridBug %s [%s] - Node ID: %s\n" % (ROLE.title(), BUILD, ID))
-    sys.stderr.write("* Validating Configuration [%s]\n" % CONFIGFILE)
-    sys.stderr.write(" + GridBug - Debug: %s, Activate API: %s, API Port: %s\n" 
-        % (DEBUGMODE, API, APIPORT))
-    sys.stderr.write(" + GridKey: [%s]\n" % GRIDKEY)
+    def run(self):
+        """
+        Thread to write queued events to subscribers
+        """
+        sys.stderr.write(" + eventhub thread\n")
+        sel = selectors.DefaultSelector()
+        sel.register(self.wakeup[0], selectors.EVENT_READ)
+        nextping = time.time() + SSEPING
+        while running:
+            # Watch every subscriber for hangup and those with output to send
+            with self.lock:
+                wanted = {sock: selectors.EVENT_READ | (selectors.EVENT_WRITE if buf else 0)
+                          for sock, buf in self.subscribers.items()}
+                serverstats['sse_subscribers'] = len(wanted)
+            for sock, events in wanted.items():
+                try:
+                    if sel.get_key(sock).events != events:
+                        sel.modify(sock, events)
+                except KeyError:
+                    sel.register(sock, events)
+            for key, mask in sel.select(timeout=max(0, min(5, nextping - time.time()))):
+                sock = key.fileobj
+                if sock is self.wakeup[0]:
+                    try:
+                        while sock.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                try:
+                    if mask & selectors.EVENT_READ and not sock.recv(4096):
+                        self.drop(sel, sock)
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        with self.lock:
+                            buf = self.subscribers.get(sock)
+                            if buf is None:
+                                continue
+                            del buf[:sock.send(buf)]
+                            behind = len(buf)
+                        if behind > SSEBUFFER:
+                            serverstats['sse_dropped'] += 1
+                            self.drop(sel, sock)
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError:
+                    self.drop(sel, sock)
+            if time.time() >= nextping:
+                nextping = time.time() + SSEPING
+                with self.lock:
+                    for buf in self.subscribers.values():
+                        buf += b": keepalive\n\n"
+        for sock in list(self.subscribers):
+            self.drop(sel, sock)
+        sys.stderr.write('\r ! eventhub Exit\n')
 
-    # Data Validation and Warnings
-    if NODEURL.startswith("http:") or NODEURL.startswith("https:"):
-        NODEURL = NODEURL.replace("http://","")
-        NODEURL = NODEURL.replace("https://","")
-        sys.stderr.write(" * NOTICE: Removed http prefix from NODEURL %s.\n" % NODEURL)
-    if SERVERNODE.startswith("http:") or SERVERNODE.startswith("https:"):
-        SERVERNODE = SERVERNODE.replace("http://","")
-        SERVERNODE = SERVERNODE.replace("https://","")
-        sys.stderr.write(" * NOTICE: Removed http prefix from SERVERNODE %s.\n" % SERVERNODE)
-    if NODEURL.startswith("localhost") or NODEURL.startswith("example.com"):
-        sys.stderr.write(" ! WARNING: Setting my NODEURL to %s may not be what you want.\n" % NODEURL)
+def snapshotevent():
+    """
+    Function to render the snapshot event that opens an event stream
+    """
+    merged = responses.entries.get('/graph') if shardports else None
+    if merged is not None:
+        # Aggregator worker - the last merged graph, kept fresh by shardevents
+        return b"event: snapshot\ndata: " + merged.body + b"\n\n"
+    return ("event: snapshot\ndata: %s\n\n" % rendergraph(state.graph)).encode("utf8")
 
-    # Load bugs
-    loadbugs()
+def publishchanges():
+    """
+    Function to send nodes and edges changed since the last call to
+    event subscribers as a diff
+    """
+    nodes, edges = state.graph.takechanges()
+    if nodes or edges:
+        hub.publish("diff", json.dumps({"nodes": [{"data": {"id": n}} for n in nodes],
+                                        "edges": [edgeelement(e) for e in edges]}))
 
-    # Start threads
-    sys.stderr.write("\nGridBug %s [%s] - Running Node ID: %s on %s\n" % (ROLE.title(), BUILD, ID, NODEURL))
-    sys.stderr.write("* Starting threads\n")
-    thread_pollgridbugs.start()
-    thread_api.start()
-    sys.stderr.flush()
+# Alerts
+class AlertDispatcher(object):
+    """
+    Debounce edge color changes into alerts and POST them to a webhook
+
+    The ingest thread reports every transition with transition(), which
+    only records the edge's latest color under a lock.  The alerts thread
+    turns an edge into an alert once it has held a color other than the
+    last one alerted for hold seconds, so a link that flaps and recovers
+    is never sent, and one that keeps flapping is sent (as flapping)
+    after ALERTFLAPS holds.  Alerts wait in a queue of at most limit (the oldest are
+    dropped) and are sent in batches, with failed batches retried after
+    backoff seconds, doubling each time, before they are dropped.
+    """
+    def __init__(self, url, hold=ALERTHOLD, batch=ALERTBATCH, limit=ALERTQUEUE,
+                 retries=ALERTRETRIES, backoff=ALERTBACKOFF):
+        self.url = url
+        self.hold = hold
+        self.batch = batch
+        self.limit = limit
+        self.retries = retries
+        self.backoff = backoff
+        self.cond = threading.Condition()
+        self.pending = {}   # edge id -> [source, target, color, ts, changed, first, changes]
+        self.alerted = {}   # edge id -> last color alerted (edges start green)
+        self.queue = collections.deque()
+        self.closed = False
+
+    def transition(self, e):
+        """
+        Record that edge e has changed color
+        """
+        now = time.monotonic()
+        with self.cond:
+            entry = self.pending.get(e.id)
+            if entry is None:
+                self.pending[e.id] = [e.source, e.target, e.color, time.time(), now, now, 1]
+                serverstats['alerts_pending'] = len(self.pending)
+                self.cond.notify()
+            else:
+                entry[2:5] = [e.color, time.time(), now]
+                entry[6] += 1
+
+    def forget(self, keep):
+        """
+        Drop what is held for edges whose ids are not in keep - they have
+        left the graph, so an edge that comes back starts green again
+        """
+        with self.cond:
+            for eid in [k for k in self.alerted if k not in keep]:
+                del self.alerted[eid]
+            for eid in [k for k in self.pending if k not in keep]:
+                del self.pending[eid]
+            serverstats['alerts_pending'] = len(self.pending)
+
+    def promote(self, now):
+        """
+        Queue alerts for edges that have held their color for hold seconds
+        and return the seconds until the next one is due (None if none)
+        """
+        due = None
+        for eid in list(self.pending):
+            source, target, color, ts, changed, first, changes = self.pending[eid]
+            ready = max(changed + self.hold - now, 0)
+            if ready and now - first < self.hold * ALERTFLAPS:
+                due = ready if due is None else min(due, ready)
+                continue
+            del self.pending[eid]
+            previous = self.alerted.get(eid, "green")
+            flapping = ready > 0
+            if color == previous and not flapping:
+                serverstats['alerts_suppressed'] += 1
+                continue
+            self.alerted[eid] = color
+            if len(self.queue) >= self.limit:
+                self.queue.popleft()
+                serverstats['alerts_dropped'] += 1
+            self.queue.append({"edge": eid, "source": source, "target": target, "color": color,
+                "previous": previous, "ts": ts, "changes": changes, "flapping": flapping})
+        serverstats['alerts_pending'] = len(self.pending)
+        serverstats['alerts_queued'] = len(self.queue)
+        return due
+
+    def deliver(self, batch):
+        """
+        POST a batch of alerts - returns True if the webhook took it,
+        False to retry and None if it was refused
+        """
+        message = {"node_id": ID, "node_host": NODEURL, "ts": time.time(), "alerts": batch}
+        try:
+            r = posturl(self.url, json=message, timeout=TIMEOUT)
+        except Exception as err:
+            log.debug("ALERT: Unable to reach %s - %s" % (self.url, err))
+            return False
+        if r.status_code < 300:
+            return True
+        log.debug("ALERT: %s answered %d" % (self.url, r.status_code))
+        if r.status_code >= 500 or r.status_code in (408, 429):
+            return False
+        return None
+
+    def run(self):
+        """
+        Thread to turn held transitions into alerts and send them
+        """
+        sys.stderr.write(" + alerts thread\n")
+        batch = None
+        tries = 0
+        retryat = 0
+        while running and not self.closed:
+            with self.cond:
+                now = time.monotonic()
+                wait = self.promote(now)
+                if batch is None and self.queue:
+                    batch = [self.queue.popleft() for i in range(min(self.batch, len(self.queue)))]
+                    serverstats['alerts_queued'] = len(self.queue)
+                if batch is None or now < retryat:
+                    if batch is not None:
+                        wait = retryat - now if wait is None else min(wait, retryat - now)
+                    self.cond.wait(5 if wait is None else min(wait, 5))
+                    continue
+            result = self.deliver(batch)
+            if result:
+                serverstats['alerts_sent'] += len(batch)
+                serverstats['alerts_batches'] += 1
+            elif result is False and tries < self.retries:
+                serverstats['alerts_retries'] += 1
+                retryat = time.monotonic() + min(60, self.backoff * 2 ** tries)
+                tries += 1
+                continue
+            else:
+                serverstats['alerts_failed'] += len(batch)
+            batch = None
+            tries = 0
+            retryat = 0
+        sys.stderr.write('\r ! alerts Exit\n')
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+def renderstats():
+    """
+    Function to render internal stats
+    """
+    serverstats['ts'] = int(time.time())
+    serverstats['mem'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    delta = serverstats['ts'] - serverstats['start']
+    serverstats['uptime'] = str(datetime.timedelta(seconds=delta))
+    poolstats()
+    for name, ring in (('gossip_lag_ms', gossiplag), ('gossip_hops', gossiphops)):
+        if ring.count:
+            summary = ring.summary()
+            serverstats[name] = {k: summary[k] for k in ("p50", "p95", "p99", "n")}
+    return json.dumps(serverstats)
+
+def rendermetrics():
+    """
+    Function to render stats, graph size, queue depths and latency
+    histograms in the Prometheus text format
+    """
+    grid = state
+    graph = grid.graph
+    lines = []
+    info = (("version", BUILD), ("node_id", ID), ("role", ROLE), ("probe", PROBE),
+            ("exchange", EXCHANGE))
+    if shardports:
+        # Which aggregator worker answered - an identifier, not a count
+        info += (("shard", serverstats['shard']),)
+    metric(lines, "info", "gauge", "GridBug build and settings", [(info, 1)])
+    metric(lines, "start_time_seconds", "gauge", "Time the node started",
+        [((), serverstats['start'])])
+    metric(lines, "boot_ms", "gauge", "Milliseconds from start to each startup phase",
+        [((("phase", k[:-3]),), v) for k, v in serverstats['boot'].items() if k.endswith("_ms")])
+    metric(lines, "maxrss_bytes", "gauge", "Peak resident memory",
+        [((), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)])
+    poolstats()
+    for key, value in list(serverstats.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or key in ('ts', 'start', 'clear', 'mem', 'shard'):
+            continue
+        if key in STATGAUGES:
+            metric(lines, key, "gauge", None, [((), value)])
+        else:
+            metric(lines, key + "_total", "counter", None, [((), value)])
+    colors = {"green": 0, "red": 0, "gray": 0}
+    for e in list(graph.edges.values()):
+        colors[e.color] = colors.get(e.color, 0) + 1
+    metric(lines, "graph_nodes", "gauge", "Nodes in the graph", [((), len(graph.nodes))])
+    metric(lines, "graph_edges", "gauge", "Edges in the graph by color",
+        [((("color", c),), n) for c, n in colors.items()])
+    metric(lines, "bugs", "gauge", "Nodes in the bug list", [((), len(grid.bugs['gridbugs']))])
+    with hub.lock:
+        buffered = sum(len(buf) for buf in hub.subscribers.values())
+    metric(lines, "queue_depth", "gauge", "Work waiting in each queue",
+        [((("queue", "ingest"),), len(ingest.pending)),
+         ((("queue", "probe"),), serverstats['probe_inflight']),
+         ((("queue", "expiry"),), len(graph.expiry)),
+         ((("queue", "events_bytes"),), buffered),
+         ((("queue", "alerts"),), serverstats['alerts_queued'])])
+    for histogram in (requestseconds, pollseconds, ingestseconds, probeseconds):
+        histogram.render(lines)
+    return "\n".join(lines) + "\n"
+
+def bumpstat(name, n=1):
+    """
+    Function to add n to a counter that more than one thread updates
+    """
+    with statslock:
+        serverstats[name] += n
+
+def countrequest(kind, route, error, started):
+    """
+    Function to count a handled request ('gets' or 'posts') and time it
+    from started (perf_counter) for /metrics
+    """
+    with statslock:
+        if error:
+            serverstats['errors'] += 1
+        else:
+            serverstats["uri"][route] = serverstats["uri"].get(route, 0) + 1
+        serverstats[kind] += 1
+    if started is not None:
+        requestseconds.observe(time.perf_counter() - started, route)
+
+def readconsole():
+    with open(CONSOLE, 'rb') as f:
+        return f.read()
+
+# Ingest Queue
+def mergepayload(old, new):
+    """
+    Function to combine two bug lists from the same node - new is applied
+    on top of old so the result covers both
+    """
+    if (new.get("epoch") == old.get("epoch") and None not in (new.get("generation"), old.get("generation"))
+            and new["generation"] < old["generation"]):
+        # Arrived out of order - a pull can return after a later push
+        old, new = new, old
+    if "since" not in new:
+        return new
+    merged = dict(new)
+    if "since" in old:
+        merged["since"] = old["since"]
+    else:
+        del merged["since"]
+    entries = {b["id"]: b for b in old["gridbugs"]}
+    for b in new["gridbugs"]:
+        entries[b["id"]] = b
+    merged["gridbugs"] = list(entries.values())
+    return merged
+
+class IngestQueue(object):
+    """
+    Bug lists waiting to be applied to the graph by the ingest thread
+
+    Payloads are keyed by the node that sent them, so the queue never
+    holds more than one per node.  A payload for a node that already has
+    one waiting is merged into it and a burst of posts costs one update.
+    Our own poll results are queued under the key None.  Other changes to
+    the published graph are queued as calls to run after the batch.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = {}   # node id -> [payload, GridState, time queued]
+        self.accepted = {}  # node id -> (epoch, generation) queued and not yet applied
+        self.grid = None    # GridState accepted is for
+        self.calls = []     # (function, args) to run on the ingest thread
+
+    def put(self, payload, grid):
+        """
+        Queue a bug list for grid (False for our own measurements)
+
+        Returns False when payload is a delta that does not follow on from
+        what we hold or have queued for its node so it needs a full resync.
+        Raises ValueError if its header fields are not of the right types.
+        """
+        source = None
+        if payload:
+            checkpayload(payload)
+            source = payload["node_id"]
+        with self.cond:
+            queued = self.pending.get(source)
+            if queued is not None and queued[1] is not grid:
+                # Queued for a state that has since been replaced
+                queued = None
+            if payload:
+                # Deltas must follow on from what is applied or on its way
+                epoch = payload.get("epoch")
+                if grid is not self.grid:
+                    self.accepted = {}
+                    self.grid = grid
+                last = self.accepted.get(source) or grid.peerstate.get(source)
+                if "since" in payload:
+                    if last is None or last[0] != epoch or payload["since"] > last[1]:
+                        bumpstat('gossip_resync')
+                        log.debug("Delta from %s does not follow %r - resync" % (source, last))
+                        return False
+                generation = payload.get("generation")
+                if generation is not None:
+                    if last and last[0] == epoch:
+                        generation = max(generation, last[1])
+                    self.accepted[source] = (epoch, generation)
+            if queued is None:
+                self.pending[source] = [payload, grid, time.time()]
+            else:
+                if payload:
+                    queued[0] = mergepayload(queued[0], payload)
+                serverstats['ingest_coalesced'] += 1
+            depth = len(self.pending)
+            serverstats['ingest_queue'] = depth
+            serverstats['ingest_queue_max'] = max(depth, serverstats['ingest_queue_max'])
+            self.cond.notify()
+        return True
+
+    def take(self, timeout):
+        """
+        Wait up to timeout seconds for queued bug lists and take them all
+        """
+        with self.cond:
+            if not self.pending and not self.calls:
+                self.cond.wait(timeout)
+            batch, self.pending = self.pending, {}
+            serverstats['ingest_queue'] = 0
+        return batch
+
+    def call(self, func, *args):
+        """
+        Queue func(*args) to run on the ingest thread
+        """
+        with self.cond:
+            self.calls.append((func, args))
+            self.cond.notify()
+
+    def takecalls(self):
+        with self.cond:
+            calls, self.calls = self.calls, []
+        return calls
+
+    def settle(self, grid):
+        """
+        Forget what was accepted once it has been applied - grid.peerstate
+        holds it from then on, and nodes removed since are dropped with it
+        """
+        with self.cond:
+            if grid is not self.grid:
+                self.accepted = {}
+                self.grid = grid
+            elif len(self.accepted) > len(self.pending):
+                self.accepted = {k: v for k, v in self.accepted.items() if k in self.pending}
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify()
+
+# Grid State
+class RelayedBugs(object):
+    """
+    The latest bug list we hold from another node, kept to gossip on to
+    peers that are behind on it
+    """
+    __slots__ = ("header", "entries", "seen")
+
+    def __init__(self):
+        self.header = None
+        self.entries = {}   # bug id -> entry as the node reported it
+        self.seen = 0       # when it last advanced
+
+    def update(self, payload, generation):
+        """
+        Apply a bug list from the node, or relayed for it, that brings it
+        up to generation
+
+        Entries are updated before the header so a reader that sees the
+        new generation also sees the entries it covers.
+        """
+        if "since" in payload:
+            self.entries.update((b["id"], b) for b in payload["gridbugs"])
+        else:
+            self.entries = {b["id"]: b for b in payload["gridbugs"]}
+        header = {k: v for k, v in payload.items() if k not in ("gridbugs", "since")}
+        header["generation"] = generation
+        header["hops"] = payload.get("hops", 0) + 1
+        self.header = header
+        self.seen = time.time()
+
+    def payload(self, since=None):
+        """
+        Build the bug list to relay - only entries changed after since if set
+        """
+        payload = dict(self.header)
+        entries = list(self.entries.values())
+        if since is None:
+            payload["gridbugs"] = entries
+        else:
+            payload["since"] = since
+            payload["gridbugs"] = [b for b in entries if b.get("gen", 0) > since]
+        return payload
+
+class GridState(object):
+    """
+    Snapshot of the grid: the versioned bug list, its index, the graph and
+    what we know of our peers
+
+    A reload builds a new GridState off to the side and publishes it by
+    replacing the global state in one assignment.  Threads take a
+    reference to state once per request or poll cycle and work on that,
+    so a reload never blocks them and a cycle that straddles one finishes
+    against the snapshot it started with.
+    """
+    __slots__ = ("bugs", "bugindex", "listed", "removed", "graph", "peerstate", "pushstate",
+                 "latency", "relay")
+
+    def __init__(self, bugs):
+        # Version the bug list - a new epoch tells peers to resync
+        bugs['epoch'] = int(time.time() * 1000)
+        bugs['generation'] = 1
+        for n in bugs['gridbugs']:
+            n['gen'] = 1
+        self.bugs = bugs
+        self.bugindex = {n["id"]: n for n in bugs['gridbugs']}
+        self.listed = set(self.bugindex)    # ids from the bug list file or URL
+        self.removed = set()    # ids dropped from the list that gossip may not add back
+        self.graph = GraphStore()
+        self.peerstate = {}     # node id -> (epoch, generation) last ingested from it
+        self.pushstate = {}     # host -> (epoch, generation) of ours it has acknowledged
+        self.latency = {}       # bug id -> RttRing of our probes to it
+        self.relay = {}         # node id -> RelayedBugs gossiped on to peers
+
+    def addbug(self, hostname, host_id):
+        """
+        Add a grid bug if not already in the list or removed from it
+        """
+        if host_id in self.bugindex or host_id in self.removed:
+            return False
+        bug = {"host": hostname, "id": host_id}
+        self.bumpgeneration(bug)
+        self.bugs["gridbugs"].append(bug)
+        self.bugindex[host_id] = bug
+        log.debug("GRAPH: Added bug %s %s" % (host_id, hostname))
+        return True
+
+    def removebugs(self, host_ids):
+        """
+        Drop grid bugs and what we know of them
+
+        Deltas can only carry changed entries, so the bug list starts a new
+        epoch and peers take it in full on their next exchange.
+        """
+        host_ids = set(host_ids)
+        # Peers that have not reloaded yet still gossip them
+        self.removed |= host_ids
+        with genlock:
+            self.bugs["gridbugs"] = [b for b in self.bugs["gridbugs"] if b["id"] not in host_ids]
+            self.bugs["epoch"] = max(int(time.time() * 1000), self.bugs["epoch"] + 1)
+            self.bugs["generation"] += 1
+        for host_id in host_ids:
+            self.bugindex.pop(host_id, None)
+            self.latency.pop(host_id, None)
+            self.peerstate.pop(host_id, None)
+            self.relay.pop(host_id, None)
+            log.debug("GRAPH: Removed bug %s" % host_id)
+
+    def bumpgeneration(self, bug):
+        """
+        Stamp a changed bug entry with a new generation
+
+        The entry is stamped before the generation is published so a reader
+        that sees the new generation also sees the entry as changed.
+        """
+        with genlock:
+            gen = self.bugs["generation"] + 1
+            bug["gen"] = gen
+            self.bugs["generation"] = gen
+
+    def setalive(self, bug, alive):
+        """
+        Record a probe result, bumping the generation on change
+        """
+        if bug.get("alive") != alive:
+            bug["alive"] = alive
+            self.bumpgeneration(bug)
+
+    def recordrtt(self, bug, rtt):
+        """
+        Add a probe result to the ring for a bug and update the summary
+        gossiped in its entry when it has changed enough
+        """
+        ring = self.latency.get(bug["id"])
+        if ring is None:
+            ring = self.latency[bug["id"]] = RttRing()
+        ring.add(rtt)
+        if rtt is not None:
+            probeseconds.observe(rtt / 1000, bug["id"])
+        summary = ring.summary()
+        if latencychanged(bug.get("latency"), summary):
+            bug["latency"] = summary
+            self.bumpgeneration(bug)
+
+    def bugpayload(self, since=None):
+        """
+        Build the bug list to gossip
+
+        With since set, only entries changed after that generation are sent.
+        """
+        bugs = self.bugs
+        payload = {k: v for k, v in bugs.items() if k != "gridbugs"}
+        if since is None:
+            payload["gridbugs"] = list(bugs["gridbugs"])
+        else:
+            payload["since"] = since
+            payload["gridbugs"] = [b for b in bugs["gridbugs"] if b.get("gen", 0) > since]
+        return payload
+
+    def heartbeat(self):
+        """
+        Advance the generation once a gossip cycle, even if nothing changed,
+        so nodes that only hear of us through relays know we are current
+        """
+        with genlock:
+            self.bugs["updated"] = round(time.time(), 3)
+            self.bugs["generation"] += 1
+
+    def digest(self):
+        """
+        Return the version of every bug list we hold and still relay as
+        node id -> [epoch, generation]
+
+        Bug lists that have not advanced within TTL are left out - their
+        node has stopped heartbeating and should age out of the grid.
+        """
+        bugs = self.bugs
+        result = {ID: [bugs.get("epoch"), bugs["generation"]]}
+        cutoff = time.time() - TTL
+        for origin, relayed in list(self.relay.items()):
+            header = relayed.header
+            if relayed.seen >= cutoff and origin not in result:
+                result[origin] = [header["epoch"], header["generation"]]
+        return result
+
+    def gossipupdates(self, digest, peer):
+        """
+        Return the bug lists a peer is missing or behind on according to
+        its digest - changes only where it holds the same epoch as we do
+        """
+        updates = []
+        for origin, version in self.digest().items():
+            known = digest.get(origin)
+            if origin == peer or (known is not None and list(known) >= version):
+                continue
+            since = None
+            if known is not None and known[0] == version[0]:
+                since = known[1]
+            if origin == ID:
+                updates.append(self.bugpayload(since))
+            else:
+                updates.append(self.relay[origin].payload(since))
+        return updates
+
+# Global Variables
+running = True
+state = GridState({"version": 1, "gridbugs": []})   # replaced by loadbugs()
+reloadlock = threading.Lock()
+ingest = IngestQueue()
+genlock = threading.Lock()
+history = None              # HistoryLog when HISTORY is set
+alerts = None               # AlertDispatcher when ALERT and ALERTURL are set
+buglistversion = None       # mtime and size (file) or ETag, Last-Modified and digest (URL) last read
+responses = ResponseCache()
+changelock = threading.Lock()
+hub = EventHub()
+gossiplag = RttRing(256)    # ms from a bug list's heartbeat to applying it
+gossiphops = RttRing(256)   # exchanges it took to reach us
+SHARD = 0                   # Aggregator worker number of this process
+shardports = []             # Loopback API port of each aggregator worker
+shardversions = None        # Shared array of each worker's graph version
+shardgraphs = {}            # Worker -> (version, graph) fetched for /graph
+mergedparts = [None, None, set()]   # merged graph, its Partitions and green edges
+mergelock = threading.Lock()
+statslock = threading.Lock()    # counters bumped from more than one thread
+requestseconds = Histogram("gridbug_request_seconds", "Time to handle an API request", "route")
+pollseconds = Histogram("gridbug_poll_seconds",
+    "Time to probe and swap bug lists with a node, gossip or update the server", "job")
+ingestseconds = Histogram("gridbug_ingest_seconds", "Time for updategraph() to apply a bug list")
+probeseconds = Histogram("gridbug_probe_rtt_seconds", "Probe round-trip time to each peer", "peer")
+
+# Wire Format
+WIRETYPE = "application/x-gridbug"
+WIREMAGIC = b"GBW1"
+WIREHEAD = struct.Struct("<4sIII")      # magic, header size, string table size, entries
+WIRESTATS = ("p50", "p95", "p99", "loss")
+WIRESCALE = (1000, 1000, 1000, 1000)    # latency summaries are rounded to these
+WIRENONE = (0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFF)
+WIREALIVE = {True: 1, False: 0, None: -1}
+GOSSIPTYPE = "application/x-gridbug-gossip"    # zlib compressed JSON exchange
+NODEHEADER = "X-GridBug-Node"   # Sender of a posted bug list, so it can be routed unread
+
+def packcolumn(typecode, values):
+    """
+    Function to pack a column of integers little endian, one byte plane
+    after another - the high bytes are mostly equal and compress well
+    """
+    col = array(typecode, values)
+    if sys.byteorder != "little":
+        col.byteswap()
+    raw = col.tobytes()
+    return b"".join(raw[i::col.itemsize] for i in range(col.itemsize))
+
+def unpackcolumn(typecode, body, offset, count):
+    """
+    Function to read a column written by packcolumn() - returns the
+    column and the offset after it
+    """
+    col = array(typecode)
+    size = col.itemsize
+    end = offset + count * size
+    if end > len(body):
+        raise ValueError("Truncated gridbug payload")
+    raw = bytearray(count * size)
+    for i in range(size):
+        raw[i::size] = body[offset + i * count:offset + (i + 1) * count]
+    col.frombytes(bytes(raw))
+    if sys.byteorder != "little":
+        col.byteswap()
+    return col, end
+
+def encodebugs(payload):
+    """
+    Function to pack a bug list into the compact wire format
+
+    Every field but gridbugs goes in a small JSON header.  Each id and
+    host is stored once in a string table and the entries are stored as
+    columns of integers: string indexes, alive, gen and, for entries that
+    have one, the latency summary in the fixed point precision it is
+    rounded to.  The whole body is zlib compressed.
+    """
+    strings = {}
+    ids, hosts, alive, gens, flags = [], [], [], [], []
+    stats = ([], [], [], [], [])
+    for b in payload["gridbugs"]:
+        ids.append(strings.setdefault(b["id"], len(strings)))
+        hosts.append(strings.setdefault(b["host"], len(strings)))
+        alive.append(WIREALIVE.get(b.get("alive", -2), -2))
+        gens.append(b.get("gen", 0))
+        summary = b.get("latency")
+        flags.append(1 if summary else 0)
+        if summary:
+            for k, none, scale, col in zip(WIRESTATS, WIRENONE, WIRESCALE, stats):
+                value = summary.get(k)
+                col.append(none if value is None else int(round(value * scale)))
+            stats[4].append(min(summary.get("n") or 0, 0xFFFF))
+    header = json.dumps({k: v for k, v in payload.items() if k != "gridbugs"}).encode("utf8")
+    table = json.dumps(list(strings)).encode("utf8")
+    parts = [WIREHEAD.pack(WIREMAGIC, len(header), len(table), len(ids)), header, table,
+             packcolumn("I", ids), packcolumn("I", hosts), packcolumn("b", alive),
+             packcolumn("Q", gens), packcolumn("B", flags)]
+    for typecode, col in zip("IIIHH", stats):
+        parts.append(packcolumn(typecode, col))
+    return zlib.compress(b"".join(parts), 6)
+
+def inflate(data):
+    """
+    Function to decompress a zlib body - raises ValueError if it is
+    malformed, truncated or inflates beyond MAXINFLATE bytes
+    """
+    inflater = zlib.decompressobj()
+    try:
+        body = inflater.decompress(data, MAXINFLATE)
+    except zlib.error as err:
+        raise ValueError(str(err))
+    if inflater.unconsumed_tail:
+        raise ValueError("Payload inflates beyond %d bytes" % MAXINFLATE)
+    if not inflater.eof:
+        raise ValueError("Truncated gridbug payload")
+    return body
+
+def decodebugs(data):
+    """
+    Function to unpack a bug list in the compact wire format - raises
+    ValueError if it is malformed or inflates beyond MAXINFLATE bytes
+    """
+    body = inflate(data)
+    try:
+        magic, hsize, tsize, count = WIREHEAD.unpack_from(body)
+        if magic != WIREMAGIC:
+            raise ValueError("Not a gridbug payload")
+        offset = WIREHEAD.size
+        payload = json.loads(body[offset:offset + hsize])
+        offset += hsize
+        strings = json.loads(body[offset:offset + tsize])
+        offset += tsize
+        ids, offset = unpackcolumn("I", body, offset, count)
+        hosts, offset = unpackcolumn("I", body, offset, count)
+        alive, offset = unpackcolumn("b", body, offset, count)
+        gens, offset = unpackcolumn("Q", body, offset, count)
+        flags, offset = unpackcolumn("B", body, offset, count)
+        timed = flags.count(1)
+        stats = []
+        for typecode, none, scale in zip("IIIH", WIRENONE, WIRESCALE):
+            col, offset = unpackcolumn(typecode, body, offset, timed)
+            stats.append([None if v == none else round(v / scale, 3) for v in col])
+        col, offset = unpackcolumn("H", body, offset, timed)
+        stats.append(col)
+        summaries = iter([dict(zip(WIRESTATS + ("n",), row)) for row in zip(*stats)])
+        states = (None, False, True)
+        entries = []
+        for bid, host, up, gen, timed in zip(ids, hosts, alive, gens, flags):
+            b = {"host": strings[host], "id": strings[bid]}
+            if gen:
+                b["gen"] = gen
+            if up != -2:
+                b["alive"] = states[up + 1]
+            if timed:
+                b["latency"] = next(summaries)
+            entries.append(b)
+    except (struct.error, IndexError, TypeError) as err:
+        raise ValueError("Invalid gridbug payload: %s" % err)
+    payload["gridbugs"] = entries
+    return payload
+
+def checkpayload(payload):
+    """
+    Function to check the header fields of a bug list before it is queued
+    - raises ValueError if any is missing or of the wrong type, as they
+    are compared with what we hold and must never stop the ingest thread
+    """
+    def number(value, kinds=(int,)):
+        return isinstance(value, kinds) and not isinstance(value, bool)
+    if not isinstance(payload, dict) or not isinstance(payload.get("node_id"), str) \
+            or not isinstance(payload.get("gridbugs"), list):
+        raise ValueError("Invalid gridbug payload")
+    for key in ("epoch", "generation"):
+        if payload.get(key) is not None and not number(payload[key]):
+            raise ValueError("Invalid %s in gridbug payload" % key)
+    if "since" in payload and not number(payload["since"]):
+        raise ValueError("Invalid since in gridbug payload")
+    if "updated" in payload and not number(payload["updated"], (int, float)):
+        raise ValueError("Invalid updated in gridbug payload")
+    if "hops" in payload and not number(payload["hops"]):
+        raise ValueError("Invalid hops in gridbug payload")
+
+def payloadlimit(headers):
+    """
+    Function to return the largest POST body to read - compressed bodies
+    are already held to MAXINFLATE once inflated so they may use it all
+    """
+    if headers.get('Content-Type') in (WIRETYPE, GOSSIPTYPE):
+        return max(MAXPAYLOAD, MAXINFLATE)
+    return MAXPAYLOAD
+
+def readpayload(body, contenttype):
+    """
+    Function to decode a bug list sent as JSON or in the wire format
+    """
+    if contenttype and contenttype.split(";")[0].strip() == WIRETYPE:
+        bumpstat('gossip_compact')
+        return decodebugs(body)
+    return json.loads(body)
+
+def encodegossip(message):
+    """
+    Function to encode an anti-entropy message - digests and relayed bug
+    lists repeat the same ids and compress well
+    """
+    return zlib.compress(json.dumps(message).encode("utf8"), 6)
+
+def decodegossip(data):
+    """
+    Function to decode an anti-entropy message - raises ValueError if it
+    is malformed or inflates beyond MAXINFLATE bytes
+    """
+    message = json.loads(inflate(data))
+    if not isinstance(message, dict) or not isinstance(message.get("updates", []), list):
+        raise ValueError("Invalid gossip message")
+    return message
+
+# HTTP client pool - one keep-alive session per peer host
+sessions = {}
+sessionlock = threading.Lock()
+poolclosed = [0, 0]         # requests and connections of sessions since closed
+wireformats = {}            # host -> True if it accepts WIRETYPE posts
+
+def peersession(host):
+    """
+    Function to return the keep-alive session for a peer host
+
+    Sessions hold up to POOLSIZE persistent connections to their host.
+    When POOLMAX hosts are pooled the least recently used one is closed.
+    """
+    now = time.time()
+    with sessionlock:
+        entry = sessions.get(host)
+        if entry:
+            entry[1] = now
+            return entry[0]
+        if len(sessions) >= POOLMAX:
+            lru = min(sessions, key=lambda h: sessions[h][1])
+            closesession(sessions.pop(lru)[0])
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POOLSIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        sessions[host] = [session, now]
+        serverstats['pool_sessions'] = len(sessions)
+        return session
+
+def poolcounts(session):
+    """
+    Function to return the requests sent and connections opened by a
+    session's urllib3 pools
+    """
+    sent = opened = 0
+    pools = session.get_adapter("http://").poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            sent += pool.num_requests
+            opened += pool.num_connections
+    return sent, opened
+
+def closesession(session):
+    """
+    Function to close an evicted peer session, keeping its counts - call
+    with sessionlock held
+    """
+    sent, opened = poolcounts(session)
+    poolclosed[0] += sent
+    poolclosed[1] += opened
+    session.close()
+    bumpstat('pool_evictions')
+
+def poolstats():
+    """
+    Function to update the connection reuse stats from urllib3's pools
+    """
+    with sessionlock:
+        sent, opened = poolclosed
+        for session, used in sessions.values():
+            counts = poolcounts(session)
+            sent += counts[0]
+            opened += counts[1]
+    serverstats['pool_requests'] = sent
+    serverstats['pool_connects'] = opened
+    serverstats['pool_reused'] = max(0, sent - opened)
+
+def evictsessions():
+    """
+    Function to close peer sessions that have been idle for POOLIDLE seconds
+    """
+    cutoff = time.time() - POOLIDLE
+    with sessionlock:
+        for host in [h for h in sessions if sessions[h][1] < cutoff]:
+            closesession(sessions.pop(host)[0])
+            log.debug("POOL: Closed idle session for %s" % host)
+        serverstats['pool_sessions'] = len(sessions)
+
+def geturl(url, **kwargs):
+    """
+    Function to GET a URL using the pooled session for its host
+    """
+    return peersession(urlsplit(url).netloc).get(url, **kwargs)
+
+def posturl(url, **kwargs):
+    """
+    Function to POST to a URL using the pooled session for its host
+    """
+    return peersession(urlsplit(url).netloc).post(url, **kwargs)
+
+def ingestpayload(payload, grid=None):
+    """
+    Function to apply a bug list received from another node to grid
+    (the current state by default) - called by the ingest thread
+
+    Returns False when payload is a delta that does not follow on from
+    the last bug list ingested from that node so it needs a full resync.
+    """
+    if grid is None:
+        grid = state
+    peerstate = grid.peerstate
+    source = payload["node_id"]
+    epoch = payload.get("epoch")
+    generation = payload.get("generation")
+    last = peerstate.get(source)
+    if "since" in payload:
+        if last is None or last[0] != epoch or payload["since"] > last[1]:
+            bumpstat('gossip_resync')
+            log.debug("Delta from %s does not follow %r - resync" % (source, last))
+            return False
+    if last is not None and generation is not None and last[0] == epoch and generation < last[1]:
+        # Applying it would roll entries back to states we have replaced
+        serverstats['gossip_stale'] += 1
+        log.debug("Bug list from %s is older than %r - ignored" % (source, last))
+        return True
+    if not updategraph(payload, grid):
+        return False
+    if generation is not None:
+        if last and last[0] == epoch:
+            generation = max(generation, last[1])
+        if "updated" in payload and (last is None or tuple(last) < (epoch, generation)):
+            # Convergence - how stale and how far travelled new state is
+            gossiplag.add(max(0, time.time() - payload["updated"]) * 1000)
+            gossiphops.add(payload.get("hops", 0) + 1)
+        peerstate[source] = (epoch, generation)
+        if EXCHANGE == "gossip" and source != ID:
+            # Keep it to relay - a delta needs the full list it applies to
+            relayed = grid.relay.get(source)
+            if relayed is None and "since" not in payload:
+                relayed = grid.relay[source] = RelayedBugs()
+            if relayed is not None:
+                relayed.update(payload, generation)
+    return True
+
+# Graph Functions
+def updategraph(payload=False, grid=None):
+    """
+    Function to update graph data of grid (the current state by default)
+
+    A delta payload (with "since") only lists changed entries so every
+    other edge from its source is refreshed with its last reported state.
+    """
+    if grid is None:
+        grid = state
+    graph = grid.graph
+    started = time.perf_counter()
+    currentts = time.time()
+    sourcehost = ""
+    try:
+        if payload:
+            # Update based on received measurements
+            source = payload["node_id"]
+            if "node_host" in payload:
+                sourcehost = payload["node_host"]
+        else:
+            # Update based on our measurements
+            source = ID
+            payload = grid.bugs
+        entries = payload["gridbugs"]
+        if source in grid.removed:
+            # Dropped from our bug list - its reports are stale
+            return True
+        if "since" in payload:
+            graph.touch(source, currentts)
+        if entries:
+            # Add any new nodes to bugs database for polling
+            if sourcehost != "":
+                grid.addbug(sourcehost, source)
+        for n in entries:
+            alive = None
+            target = n["id"]
+            targethost = n["host"]
+            if target in grid.removed:
+                continue
+            if "alive" in n:
+                alive = n["alive"]
+            grid.addbug(targethost, target)
+            # Update edges if they are from an authorized source
+            e = graph.edges.get((source, target))
+            if e is None:
+                e = graph.getedge(source, target, alive)
+            else:
+                graph.refresh(e, alive, currentts)
+            if "latency" in n and n["latency"] != e.latency:
+                e.latency = n["latency"]
+                graph.markchanged(e)
+        ingestseconds.observe(time.perf_counter() - started)
+        return True
+    except:
+        sys.stderr.write("UPDATEGRAPH: Invalid payload - ignored\n")
+        return False
+
+# Polling
+def pushbugs(host):
+    """
+    Function to send our bug list to a node
+
+    Only changes since the generation the node last acknowledged are sent.
+    If the node can not apply them it asks for a resync and gets it all.
+    """
+    grid = state
+    pushstate = grid.pushstate
+    compact = WIRE == "compact" and wireformats.get(host, False)
+    headers = {'key': GRIDKEY, 'Content-Type': WIRETYPE if compact else 'application/json',
+               NODEHEADER: ID}
+    sname = "http://%s/post" % host
+    acked = pushstate.get(host)
+    since = None
+    if acked and acked[0] == grid.bugs.get("epoch"):
+        since = acked[1]
+    while True:
+        payload = grid.bugpayload(since)
+        data = encodebugs(payload) if compact else json.dumps(payload)
+        r = posturl(sname, data=data, headers=headers, timeout=TIMEOUT)
+        bumpstat('gossip_bytes_out', len(data))
+        serverstats['gossip_full' if since is None else 'gossip_delta'] += 1
+        if compact:
+            bumpstat('gossip_compact')
+        # Nodes that can read the wire format say so in every reply
+        wireformats[host] = WIRETYPE in r.headers.get('Accept-Post', '')
+        try:
+            reply = r.json()
+        except ValueError:
+            reply = {}
+        if reply.get("status") == "RESYNC" and since is not None:
+            pushstate.pop(host, None)
+            since = None
+            continue
+        if reply.get("generation") is not None:
+            pushstate[host] = (payload.get("epoch"), reply["generation"])
+        return r
+
+def pullbugs(node):
+    """
+    Function to fetch a node's bug list - only its changes if we have
+    already ingested a full list from it
+    """
+    params = {}
+    last = state.peerstate.get(node['id'])
+    if last:
+        params = {"since": last[1], "epoch": last[0]}
+    sname = "http://%s/bugs" % node['host']
+    headers = {}
+    if WIRE == "compact":
+        headers['Accept'] = "%s, application/json;q=0.5" % WIRETYPE
+    r = geturl(sname, params=params, headers=headers, timeout=TIMEOUT)
+    bumpstat('gossip_bytes_in', len(r.content))
+    return readpayload(r.content, r.headers.get('Content-Type'))
+
+# Probes
+UDPMAGIC = b"GBE1"
+UDPSIZE = len(UDPMAGIC) + 8             # magic and a random token
+addresses = {}              # host -> (expires, [(family, address)]) resolved for probes
+swaps = {}                  # host -> time bug lists were last swapped with it
+
+def resolve(host):
+    """
+    Function to resolve a node host:port for the socket probes - every
+    address, cached for POOLIDLE seconds so a probe does not wait on DNS
+    """
+    now = time.time()
+    entry = addresses.get(host)
+    if entry is None or entry[0] < now:
+        name, sep, port = host.rpartition(":")
+        if not sep or not port.isdigit():
+            name, port = host, 80
+        found = []
+        for info in socket.getaddrinfo(name.strip("[]"), int(port), 0, socket.SOCK_STREAM):
+            if (info[0], info[4]) not in found:
+                found.append((info[0], info[4]))
+        entry = addresses[host] = (now + POOLIDLE, found)
+    return entry[1]
+
+def probeaddresses(host, probe):
+    """
+    Function to run a socket probe against each address of host in turn
+    until one answers - the one that did is tried first next time, so a
+    dual-stack host only pays for a dead family once per lookup
+    """
+    found = resolve(host)
+    error = OSError("No address for %s" % host)
+    for family, address in list(found):
+        try:
+            rtt = probe(family, address)
+        except OSError as err:
+            error = err
+            continue
+        if found[0] != (family, address):
+            found.remove((family, address))
+            found.insert(0, (family, address))
+        return rtt
+    raise error
+
+def connecttime(family, address):
+    """
+    Function to time a TCP connect to one address in milliseconds
+    """
+    with socket.socket(family, socket.SOCK_STREAM) as s:
+        s.settimeout(TIMEOUT)
+        start = time.perf_counter_ns()
+        s.connect(address)
+        return (time.perf_counter_ns() - start) / 1e6
+
+def echotime(family, address):
+    """
+    Function to time a UDP echo from one address in milliseconds
+    """
+    token = UDPMAGIC + os.urandom(UDPSIZE - len(UDPMAGIC))
+    with socket.socket(family, socket.SOCK_DGRAM) as s:
+        s.settimeout(TIMEOUT)
+        s.connect(address)
+        start = time.perf_counter_ns()
+        s.send(token)
+        while s.recv(64) != token:
+            pass
+        return (time.perf_counter_ns() - start) / 1e6
+
+def tcpprobe(host):
+    """
+    Function to time a TCP connect to a node's API port - returns the
+    round-trip time in milliseconds or raises OSError
+    """
+    return probeaddresses(host, connecttime)
+
+def udpprobe(host):
+    """
+    Function to time a UDP echo from a node's API port - returns the
+    round-trip time in milliseconds or raises OSError
+    """
+    return probeaddresses(host, echotime)
+
+def pollnode(node, swap=True):
+    """
+    Function to probe a single gridbug node and swap graph data with it -
+    or with swap False, as when gossiping, only probe it
+
+    The node is probed with PROBE: GET /ping, a TCP connect or a UDP echo.
+    The socket probes are cheap enough to run every PROBEPOLL seconds so
+    bug lists are only swapped with a node once every GBPOLL seconds.
+
+    Runs inside the poll worker pool so it must not touch the graph.
+    Returns (alive, payload, rtt) where payload is the bug list pulled
+    from the node or None if it could not be fetched and rtt is the probe
+    round-trip time in milliseconds or None if it failed.
+    """
+    alive = False
+    payload = None
+    rtt = None
+    if not running:
+        return alive, payload, rtt
+    host = node['host']
+    try:
+        if PROBE == "udp":
+            rtt = udpprobe(host)
+        elif PROBE == "tcp":
+            rtt = tcpprobe(host)
+        else:
+            url = "http://%s/ping" % host
+            log.debug("Ping URL = %s\n" % url)
+            start = time.perf_counter_ns()
+            response = geturl(url, timeout=TIMEOUT)
+            if response.status_code == 200:
+                rtt = (time.perf_counter_ns() - start) / 1e6
+            else:
+                # no response
+                log.debug("Got %d response from grid %s %s" %
+                    (response.status_code, node['id'], host))
+    except:
+        # no response
+        log.debug("No response from grid %s %s" % (node['id'], host))
+    if rtt is None:
+        return alive, payload, rtt
+    log.debug("Got response from grid %s %s in %0.3fms" % (node['id'], host, rtt))
+    alive = True
+    now = time.time()
+    if not swap or now - swaps.get(host, 0) < GBPOLL - PROBEPOLL / 2:
+        return alive, payload, rtt
+    swaps[host] = now
+    # Attempt to send payload to update node
+    try:
+        pushbugs(host)
+        log.debug("Sent graph to node %s %s" % (node['id'], host))
+    except:
+        log.debug("Unable to send graph to node %s" % host)
+    # Attempt to poll node for any graph updates
+    try:
+        if not running:
+            return alive, payload, rtt
+        payload = pullbugs(node)
+        log.debug("GET: %r" % payload)
+    except:
+        log.debug("Unable to update graph from node %s" % host)
+    return alive, payload, rtt
+
+def gossipreceive(updates, grid):
+    """
+    Function to queue the bug lists received in an exchange that are
+    newer than the ones we hold
+    """
+    bumpstat('gossip_updates_in', len(updates))
+    for payload in updates:
+        try:
+            checkpayload(payload)
+        except ValueError as err:
+            log.debug("Gossiped bug list ignored - %s" % err)
+            bumpstat('gossip_invalid')
+            continue
+        origin = payload["node_id"]
+        last = grid.peerstate.get(origin)
+        if origin == ID or (last is not None and
+                tuple(last) >= (payload["epoch"], payload["generation"])):
+            continue
+        ingest.put(payload, grid)
+
+def gossipreply(message, grid):
+    """
+    Function to answer an anti-entropy message from a peer - queues the
+    bug lists it sent and, if it sent its digest, returns ours with the
+    bug lists it is behind on
+    """
+    gossipreceive(message.get("updates", []), grid)
+    reply = {"status": "OK", "node_id": ID}
+    if "digest" in message:
+        reply["digest"] = grid.digest()
+        reply["updates"] = grid.gossipupdates(message["digest"], message["node_id"])
+        bumpstat('gossip_updates_out', len(reply["updates"]))
+    return reply
+
+def exchangebugs(node, grid):
+    """
+    Function to run a push-pull anti-entropy exchange with a node
+
+    We send our digest, the node replies with the bug lists we are behind
+    on and its own digest, and we send back the ones it is behind on,
+    trimmed to fit in MAXPAYLOAD - the rest go in a later exchange.  Nodes
+    that do not gossip get a direct push and pull instead.  Runs inside
+    the poll worker pool so it must not touch the graph.
+    """
+    sname = "http://%s/gossip" % node['host']
+    headers = {'key': GRIDKEY, 'Content-Type': GOSSIPTYPE}
+    bumpstat('gossip_exchanges')
+    data = encodegossip({"node_id": ID, "digest": grid.digest()})
+    r = posturl(sname, data=data, headers=headers, timeout=TIMEOUT)
+    bumpstat('gossip_bytes_out', len(data))
+    bumpstat('gossip_bytes_in', len(r.content))
+    if r.headers.get('Content-Type') != GOSSIPTYPE:
+        log.debug("No gossip from %s - swapping bug lists directly" % node['host'])
+        pushbugs(node['host'])
+        ingest.put(pullbugs(node), grid)
+        return
+    reply = decodegossip(r.content)
+    gossipreceive(reply.get("updates", []), grid)
+    updates = grid.gossipupdates(reply.get("digest", {}), reply.get("node_id"))
+    if not updates:
+        return
+    data = encodegossip({"node_id": ID, "updates": updates})
+    while len(data) > MAXPAYLOAD and len(updates) > 1:
+        updates = updates[:len(updates) // 2]
+        data = encodegossip({"node_id": ID, "updates": updates})
+    posturl(sname, data=data, headers=headers, timeout=TIMEOUT)
+    bumpstat('gossip_bytes_out', len(data))
+    bumpstat('gossip_updates_out', len(updates))
+
+# Debug
+PROFILEMAX = 60             # Longest profile in seconds
+PROFILEINTERVAL = 0.005     # Seconds between stack samples
+debuglock = threading.Lock()    # one profile or snapshot at a time
+tracebase = None            # tracemalloc snapshot allocations are compared to
+
+def threadcpu(ident):
+    """
+    Function to return the CPU seconds used by a thread or None where
+    per-thread clocks are not available
+    """
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+def profilethreads(seconds, top=25):
+    """
+    Function to sample the stack of every other thread for seconds and
+    return the functions seen most often
+
+    cProfile only follows the thread that starts it, so this samples
+    sys._current_frames() instead and covers the poll, ingest and API
+    threads at once.  A thread is only counted when its CPU clock moved
+    since the last sample, so threads blocked in select or a lock do not
+    bury the busy ones.  "own" counts samples with the function on top
+    of the stack and "total" samples with it anywhere on the stack.
+    """
+    me = threading.get_ident()
+    names = {}
+    clocks = {}
+    threads = collections.Counter()
+    own = collections.Counter()
+    total = collections.Counter()
+    samples = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if ident not in names:
+                names.update((t.ident, t.name) for t in threading.enumerate())
+            cpu = threadcpu(ident)
+            if cpu is not None:
+                last = clocks.get(ident)
+                clocks[ident] = cpu
+                if last is None or cpu == last:
+                    continue
+            threads[names.get(ident, str(ident))] += 1
+            code = frame.f_code
+            own[(code.co_filename, code.co_firstlineno, code.co_name)] += 1
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_filename, code.co_firstlineno, code.co_name)
+                if key not in seen:
+                    seen.add(key)
+                    total[key] += 1
+                frame = frame.f_back
+        samples += 1
+        time.sleep(PROFILEINTERVAL)
+    elapsed = time.perf_counter() - started
+    return {"seconds": round(elapsed, 3), "samples": samples,
+            "interval_ms": PROFILEINTERVAL * 1000,
+            "threads": dict(threads.most_common()),
+            "functions": [{"function": name, "file": os.path.basename(filename), "line": line,
+                           "own": own[(filename, line, name)], "total": n}
+                          for (filename, line, name), n in
+                          sorted(total.items(), key=lambda i: (-own[i[0]], -i[1]))[:top]]}
+
+def tracememory(query):
+    """
+    Function to start tracing allocations and diff snapshots - the first
+    call starts tracemalloc and takes a baseline, later calls report the
+    lines that allocated most since it.  ?reset=1 takes a new baseline,
+    ?stop=1 stops tracing, ?frames=N keeps N frames per allocation and
+    ?group=lineno|filename|traceback picks how they are totalled.
+    """
+    global tracebase
+    top = int(query.get("top", ["25"])[0])
+    group = query.get("group", ["lineno"])[0]
+    if group not in ("lineno", "filename", "traceback"):
+        raise ValueError("Unknown group %s" % group)
+    if query.get("stop", ["0"])[0] == "1":
+        tracemalloc.stop()
+        tracebase = None
+        return {"tracing": False}
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(max(1, int(query.get("frames", ["1"])[0])))
+        tracebase = None
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>")))
+    current, peak = tracemalloc.get_traced_memory()
+    result = {"tracing": True, "frames": tracemalloc.get_traceback_limit(),
+              "traced_kb": current // 1024, "peak_kb": peak // 1024}
+    if tracebase is None or query.get("reset", ["0"])[0] == "1":
+        tracebase = (time.time(), snapshot)
+        result["baseline"] = tracebase[0]
+        return result
+    result["baseline"] = tracebase[0]
+    result["top"] = [{"where": [str(f) for f in stat.traceback] if group == "traceback"
+                              else str(stat.traceback[0]),
+                      "size_kb": round(stat.size / 1024, 1), "size_diff_kb": round(stat.size_diff / 1024, 1),
+                      "count": stat.count, "count_diff": stat.count_diff}
+                     for stat in snapshot.compare_to(tracebase[1], group)[:top]]
+    return result
+
+def apidebug(path, query, headers):
+    """
+    Function to run a /debug request - they can be slow so the asyncio
+    server runs them on an executor thread
+    """
+    if headers.get('key', '') != GRIDKEY:
+        return "Error: Unauthorized Debug Request\n"
+    if not debuglock.acquire(blocking=False):
+        return "Error: Debug Request Already Running\n"
+    try:
+        if path == '/debug/profile':
+            seconds = min(PROFILEMAX, float(query.get("seconds", ["10"])[0]))
+            return json.dumps(profilethreads(seconds, int(query.get("top", ["25"])[0])))
+        return json.dumps(tracememory(query))
+    except ValueError as err:
+        return "Error: Invalid Debug Request - %s\n" % err
+    finally:
+        debuglock.release()
+
+# Aggregator
+def shardfor(headers, body=None):
+    """
+    Function to pick the aggregator worker that owns a posted bug list -
+    by the sender header, or by reading body if there is none.  Returns
+    None if it can not tell.
+    """
+    source = headers.get(NODEHEADER)
+    if source is None:
+        if body is None:
+            return None
+        source = readpayload(body, headers.get('Content-Type'))["node_id"]
+    return zlib.crc32(str(source).encode("utf8")) % len(shardports)
+
+def forwardpost(shard, path, headers, body):
+    """
+    Function to pass a post on to the worker that owns its node - that
+    worker holds the node's last generation so it must be the one to
+    accept a delta or ask for a resync.  Returns (contenttype, message).
+    """
+    forward = {'key': headers.get('key', ''), 'Content-Type': headers.get('Content-Type', '')}
+    if headers.get(NODEHEADER) is not None:
+        forward[NODEHEADER] = headers.get(NODEHEADER)
+    try:
+        r = posturl("http://127.0.0.1:%d%s" % (shardports[shard], path), data=body,
+            headers=forward, timeout=TIMEOUT)
+        bumpstat('shard_forwarded')
+        return r.headers.get('Content-Type', 'application/json'), r.content
+    except Exception as err:
+        log.debug("Unable to forward post to shard %d - %s" % (shard, err))
+        return 'application/json', "Error: Shard %d Unavailable" % shard
+
+def rendermerged(window=None):
+    """
+    Function to render the graph of every aggregator worker as one - each
+    owns the edges from its nodes so the graphs never overlap.  A worker
+    that can not be reached is shown as last fetched.  With window set
+    edges carry their availability and every worker is asked afresh.
+    """
+    nodes = {}
+    edges = []
+    now = time.time()
+    for shard, port in enumerate(shardports):
+        if shard == SHARD:
+            graph = state.graph
+            nodes.update((n, None) for n in list(graph.nodes))
+            edges.extend(edgeelement(e, window, now) for e in list(graph.edges.values()))
+            continue
+        if window is not None:
+            try:
+                r = geturl("http://127.0.0.1:%d/shard?availability=%s" % (port, window),
+                    headers={'key': GRIDKEY}, timeout=TIMEOUT)
+                fetched = (None, r.json())
+                bumpstat('shard_fetches')
+            except Exception as err:
+                log.debug("Unable to fetch graph of shard %d - %s" % (shard, err))
+                continue
+            nodes.update((n["data"]["id"], None) for n in fetched[1]["nodes"])
+            edges.extend(fetched[1]["edges"])
+            continue
+        version = shardversions[shard]
+        fetched = shardgraphs.get(shard)
+        if fetched is None or fetched[0] != version:
+            try:
+                r = geturl("http://127.0.0.1:%d/shard" % port, headers={'key': GRIDKEY}, timeout=TIMEOUT)
+                fetched = shardgraphs[shard] = (version, r.json())
+                bumpstat('shard_fetches')
+            except Exception as err:
+                log.debug("Unable to fetch graph of shard %d - %s" % (shard, err))
+        if fetched is not None:
+            nodes.update((n["data"]["id"], None) for n in fetched[1]["nodes"])
+            edges.extend(fetched[1]["edges"])
+    return json.dumps({"nodes": [{"data": {"id": n}} for n in nodes], "edges": edges})
+
+def mergedgraph():
+    """
+    Function to return the merged graph as a CachedResponse - rendered
+    again only when a worker's graph has changed.  It fetches from other
+    workers so it must not run on the event loop.
+    """
+    return responses.get('/graph', tuple(shardversions), rendermerged)
+
+def mergedavailability(window=None, edge=None):
+    """
+    Function to list the availability of the edges of every aggregator
+    worker - each answers for the edges from its own nodes
+    """
+    result = renderavailability(state.graph, window, edge)
+    params = {"local": "1"}
+    if window is not None:
+        params["window"] = window
+    if edge is not None:
+        params["edge"] = edge
+    for shard, port in enumerate(shardports):
+        if shard == SHARD:
+            continue
+        try:
+            r = geturl("http://127.0.0.1:%d/availability" % port, params=params, timeout=TIMEOUT)
+            result.extend(r.json())
+            bumpstat('shard_fetches')
+        except Exception as err:
+            log.debug("Unable to fetch availability of shard %d - %s" % (shard, err))
+    return result
+
+def mergedpartitions():
+    """
+    Function to return the Partitions of the merged graph and its version
+    - edges that changed color since the last merge are applied to it
+    """
+    cached = mergedgraph()
+    with mergelock:
+        if mergedparts[0] is not cached:
+            parts = mergedparts[1] or Partitions()
+            green = set()
+            for element in json.loads(cached.body)["edges"]:
+                e = element["data"]
+                parts.addnode(e["source"])
+                parts.addnode(e["target"])
+                if e["color"] == "green":
+                    green.add((e["source"], e["target"]))
+            for source, target in green - mergedparts[2]:
+                parts.edge(source, target, True)
+            for source, target in mergedparts[2] - green:
+                parts.edge(source, target, False)
+            mergedparts[:] = [cached, parts, green]
+        return mergedparts[1], cached.version
+
+def shardevents():
+    """
+    Thread to send event subscribers of an aggregator worker the merged
+    graph as a snapshot when any worker's graph has changed - at most
+    once every GBPOLL seconds.  Diffs only cover this worker's nodes.
+    """
+    sys.stderr.write(" + shardevents thread\n")
+    last = None
+    while running:
+        time.sleep(GBPOLL)
+        if not hub.subscribers or tuple(shardversions) == last:
+            continue
+        last = tuple(shardversions)
+        hub.publish("snapshot", mergedgraph().body.decode("utf8"))
+    sys.stderr.write('\r ! shardevents Exit\n')
+
+def serveshard(shard, sock, started):
+    """
+    Function to run an aggregator worker process - it answers the API on
+    APIPORT alongside the other workers (SO_REUSEPORT) and on its own
+    loopback socket, and ingests bug lists from the nodes it owns.
+    Startup phases are timed from started.
+    """
+    global SHARD, BOOTSTART, hub, history, alerts, running
+    SHARD = shard
+    BOOTSTART = started
+    serverstats['shard'] = shard
+    hub = EventHub()    # the one inherited shares its wakeup socket
+    if HISTORY:
+        try:
+            history = HistoryLog(os.path.join(HISTORY, "shard%d" % shard))
+        except Exception as err:
+            sys.stderr.write(" ! WARNING: Unable to open history log %s - %s\n" % (HISTORY, err))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    parent = os.getppid()
+    asyncapi = AsyncAPI(APIPORT, sock)
+    threads = [threading.Thread(target=asyncapi.run, name="api"),
+               threading.Thread(target=ingestgraph, name="ingest"),
+               threading.Thread(target=hub.run, name="eventhub"),
+               threading.Thread(target=shardevents, name="shardevents", daemon=True)]
+    if ALERT and ALERTURL:
+        # Each worker alerts on the edges of the nodes it owns
+        alerts = AlertDispatcher(ALERTURL)
+        threads.append(threading.Thread(target=alerts.run, name="alerts"))
+    for thread in threads:
+        thread.start()
+    try:
+        boot()
+        sys.stderr.write(" + Shard %d ready in %0.1fms on port %d\n" % (shard,
+            serverstats['boot']['ready_ms'], shardports[shard]))
+        if BUGLISTRELOAD:
+            threading.Thread(target=watchbugs, name="watchbugs").start()
+        while os.getppid() == parent:
+            # Do not outlive the aggregator
+            time.sleep(2)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    running = False
+    asyncapi.stop()
+    if history is not None:
+        history.close()
+
+def aggregator():
+    """
+    Function to run ROLE=server - forks WORKERS processes that share the
+    API port and restarts any that exit
+
+    Each worker owns the nodes whose id hashes to it and is the only one
+    to ingest their bug lists, so ingest runs on every CPU without locks
+    between processes.  A post that lands on another worker is passed on
+    over loopback.  Every worker serves /graph merged from all of them.
+    """
+    global shardversions, running
+    count = WORKERS or os.cpu_count() or 1
+    socks = []
+    for shard in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(128)
+        socks.append(sock)
+        shardports.append(sock.getsockname()[1])
+    shardversions = multiprocessing.RawArray('q', count)
+    ctx = multiprocessing.get_context("fork")
+    workers = [None] * count
+    echo = None
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    sys.stderr.write(" + Aggregator: %d workers on port %d\n" % (count, APIPORT))
+    try:
+        while True:
+            for shard, worker in enumerate(workers):
+                if worker is None or not worker.is_alive():
+                    started = BOOTSTART
+                    if worker is not None:
+                        sys.stderr.write(" ! Shard %d exited (%s) - restarting\n" % (shard, worker.exitcode))
+                        started = time.time()
+                    workers[shard] = ctx.Process(target=serveshard, args=(shard, socks[shard], started),
+                        name="shard%d" % shard)
+                    workers[shard].start()
+            if UDPECHO and echo is None:
+                # Started after the workers so they do not hold its socket
+                echo = threading.Thread(target=udpecho, args=(APIPORT,), name="udpecho")
+                echo.start()
+            time.sleep(2)
+    except (KeyboardInterrupt, SystemExit):
+        running = False
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join(TIMEOUT)
+
+# Threads
+def ingestgraph():
+    """
+    Thread to apply queued bug lists to the graph in batches and gray out
+    edges as soon as they have not been refreshed within TTL - the only
+    thread that writes to the published graph
+    """
+    sys.stderr.write(" + ingest thread\n")
+    wait = None
+    published = None
+    while running:
+        # Sleep until something is queued or the next edge is due
+        batch = ingest.take(5 if wait is None else min(wait, 5))
+        if batch:
+            grid = state
+            oldest = time.time()
+            for payload, queuedgrid, queued in batch.values():
+                if queuedgrid is not grid:
+                    # Queued before a reload
+                    continue
+                oldest = min(oldest, queued)
+                try:
+                    if payload:
+                        ingestpayload(payload, grid)
+                    else:
+                        updategraph(False, grid)
+                except Exception as err:
+                    # Never let one bug list stop the graph's only writer
+                    serverstats['ingest_failed'] += 1
+                    sys.stderr.write("INGEST: Invalid payload - ignored (%s)\n" % err)
+            took = round((time.time() - oldest) * 1000, 1)
+            serverstats['ingest_applied'] += len(batch)
+            serverstats['ingest_batches'] += 1
+            serverstats['ingest_latency_ms'] = took
+            serverstats['ingest_latency_max_ms'] = max(took, serverstats['ingest_latency_max_ms'])
+        for func, args in ingest.takecalls():
+            try:
+                func(*args)
+            except Exception as err:
+                serverstats['ingest_failed'] += 1
+                sys.stderr.write("INGEST: %s failed - %s\n" % (func.__name__, err))
+        ingest.settle(state)
+        wait = state.graph.expire(time.time())
+        if state.graph.partitions.resolve():
+            serverstats['partitions'] = len(state.graph.partitions.members)
+        publishchanges()
+        if shardversions is not None and state.graph.version() != published:
+            # Tell the other aggregator workers our graph has changed
+            published = state.graph.version()
+            shardversions[SHARD] += 1
+    sys.stderr.write('\r ! ingest Exit\n')
+
+def udpecho(port):
+    """
+    Thread to answer UDP echo probes on port
+
+    Only datagrams of exactly UDPSIZE bytes that start with UDPMAGIC are
+    answered, with the same bytes, so a reply is never larger than the
+    request and the port can not be used to amplify traffic.
+    """
+    # One socket per address family, like the API server, so IPv6-only
+    # peers can be echoed too
+    sel = selectors.DefaultSelector()
+    error = None
+    try:
+        infos = socket.getaddrinfo(None, port, 0, socket.SOCK_DGRAM, 0, socket.AI_PASSIVE)
+    except OSError as err:
+        infos, error = [], err
+    for family, kind, proto, name, address in infos:
+        try:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+        except OSError as err:
+            error = err
+            continue
+        try:
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.bind(address)
+        except OSError as err:
+            sock.close()
+            error = err
+            continue
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ)
+    if not sel.get_map():
+        sys.stderr.write(" ! WARNING: Unable to listen for UDP probes on port %d - %s\n" % (port, error))
+        return
+    sys.stderr.write(" + udpecho thread - Listening on udp port %d\n" % port)
+    while running:
+        for key, mask in sel.select(timeout=1):
+            sock = key.fileobj
+            try:
+                data, address = sock.recvfrom(64)
+            except OSError:
+                # Nothing left or an ICMP error from an earlier reply
+                continue
+            if len(data) == UDPSIZE and data.startswith(UDPMAGIC):
+                try:
+                    sock.sendto(data, address)
+                    serverstats['udp_echoes'] += 1
+                except OSError:
+                    pass
+            else:
+                serverstats['udp_ignored'] += 1
+    for key in list(sel.get_map().values()):
+        key.fileobj.close()
+    sel.close()
+    sys.stderr.write('\r ! udpecho Exit\n')
+
+class ProbeScheduler(object):
+    """
+    Per-node probe deadlines kept in a min-heap
+
+    A live node is probed every PROBEPOLL seconds.  A node that just changed
+    state is probed again after PROBECONFIRM seconds to confirm it, and a
+    node that stays dead waits twice as long after each failure, up to
+    PROBEBACKOFF seconds, so it stops costing a TIMEOUT every cycle.
+    Every interval is spread by PROBEJITTER so nodes started together do
+    not probe the grid in lockstep.  Only the poll thread uses it.
+    """
+    def __init__(self):
+        self.heap = []          # (deadline, node id) of nodes waiting for a probe
+        self.failures = {}      # node id -> consecutive failed probes of every node scheduled
+        self.backoff = set()    # node ids probed less often
+        self.grid = None
+        self.synced = None      # (bugs, epoch) of grid when last synced
+
+    def sync(self, grid, currentts):
+        """
+        Schedule nodes that are new to the grid, spread over the first
+        jitter window
+        """
+        synced = (len(grid.bugindex), grid.bugs.get("epoch"))
+        if grid is self.grid and synced == self.synced:
+            return
+        self.grid = grid
+        self.synced = synced
+        for node_id in list(grid.bugindex):
+            if node_id not in self.failures:
+                self.failures[node_id] = 0
+                heapq.heappush(self.heap,
+                    (currentts + random.uniform(0, PROBEJITTER * PROBEPOLL), node_id))
+
+    def pop(self, currentts, grid):
+        """
+        Take the next node due for a probe - returns (node, seconds late)
+        or None if no node is due
+        """
+        while self.heap and self.heap[0][0] <= currentts:
+            deadline, node_id = heapq.heappop(self.heap)
+            node = grid.bugindex.get(node_id)
+            if node is None:
+                # Dropped by a reload
+                self.forget(node_id)
+                continue
+            return node, currentts - deadline
+        return None
+
+    def wait(self, currentts):
+        """
+        Return seconds until the next probe is due or None if none is waiting
+        """
+        if not self.heap:
+            return None
+        return self.heap[0][0] - currentts
+
+    def done(self, node_id, alive, flipped, currentts):
+        """
+        Schedule the next probe of a node from the result of the last one
+        """
+        failures = 0 if alive else self.failures.get(node_id, 0) + 1
+        self.failures[node_id] = failures
+        if flipped:
+            interval = PROBECONFIRM
+            serverstats['probe_confirms'] += 1
+        elif failures > 1:
+            interval = min(PROBEPOLL * 2 ** min(failures - 2, 16), PROBEBACKOFF)
+        else:
+            interval = PROBEPOLL
+        if failures > 1:
+            self.backoff.add(node_id)
+        else:
+            self.backoff.discard(node_id)
+        serverstats['probe_backoff'] = len(self.backoff)
+        interval *= random.uniform(1 - PROBEJITTER, 1 + PROBEJITTER)
+        heapq.heappush(self.heap, (currentts + interval, node_id))
+
+    def forget(self, node_id):
+        self.failures.pop(node_id, None)
+        self.backoff.discard(node_id)
+
+def timedjob(job, func, *args):
+    """
+    Function to run poll work on a pool worker and time it for /metrics -
+    returns (result, seconds taken)
+    """
+    started = time.perf_counter()
+    try:
+        result = func(*args)
+    finally:
+        elapsed = time.perf_counter() - started
+        pollseconds.observe(elapsed, job)
+    return result, elapsed
+
+def pollgridbugs():
+    """
+    Thread to poll for current conditions and update graph
+
+    Each node is probed on its own schedule (see ProbeScheduler) by a pool
+    of POLLCONCURRENCY workers and results are applied as probes finish,
+    with state changes queued for the graph straight away.  Once every
+    GBPOLL seconds our measurements are queued for the graph and sent to
+    the server node.
+
+    With EXCHANGE set to gossip every node is still probed but bug lists
+    are only exchanged with FANOUT random live peers, which relay what
+    they hold on, so a cycle costs O(N) requests instead of O(N^2) across
+    the grid and changes reach every node in O(log N) cycles.  With
+    EXCHANGE set to server bug lists only go to SERVERNODE.
+    """
+    sys.stderr.write(" + pollgridbugs thread (concurrency %d)\n" % POLLCONCURRENCY)
+    nextupdate = time.time()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=POLLCONCURRENCY,
+        thread_name_prefix="pollnode")
+    scheduler = ProbeScheduler()
+    inflight = {}   # future -> node probed or description of other work
+    swap = EXCHANGE == "mesh"
+    work = 0.0      # seconds of poll work finished this cycle
+
+    # Time Loop to update current conditions data
+    while(running):
+        currentts = time.time()
+        grid = state
+        scheduler.sync(grid, currentts)
+
+        # Start the probes that are due while workers are free
+        while len(inflight) < POLLCONCURRENCY:
+            due = scheduler.pop(currentts, grid)
+            if due is None:
+                break
+            node, late = due
+            late = round(late * 1000, 1)
+            serverstats['probe_late_ms'] = late
+            serverstats['probe_late_max_ms'] = max(late, serverstats['probe_late_max_ms'])
+            inflight[pool.submit(timedjob, "probe", pollnode, node, swap)] = node
+
+        # Is it time for an update?
+        if currentts >= nextupdate:
+            nextupdate = currentts + GBPOLL
+            # What a serial poller would have spent on the cycle just ended
+            serverstats['poll_cycle'] = round(work, 3)
+            serverstats['poll_cycle_max'] = max(serverstats['poll_cycle'], serverstats['poll_cycle_max'])
+            work = 0.0
+
+            # Update graph based on discovery
+            ingest.put(False, grid)
+
+            # Gossip with a few random live peers
+            if EXCHANGE == "gossip":
+                grid.heartbeat()
+                peers = [n for n in list(grid.bugs['gridbugs']) if n.get("alive") and n["id"] != ID]
+                for node in random.sample(peers, min(FANOUT, len(peers))):
+                    inflight[pool.submit(timedjob, "gossip", exchangebugs, node, grid)] = \
+                        "gossip with node %s" % node['host']
+
+            # Send in update to server node
+            inflight[pool.submit(timedjob, "server", pushbugs, SERVERNODE)] = "update server %s" % SERVERNODE
+
+            # Release connections to nodes we no longer talk to
+            evictsessions()
+        serverstats['probe_inflight'] = len(inflight)
+
+        # Wait for work to finish or the next probe to come due
+        wait = nextupdate - currentts
+        if len(inflight) < POLLCONCURRENCY:
+            due = scheduler.wait(currentts)
+            if due is not None:
+                wait = min(wait, due)
+        wait = min(max(wait, 0), 1)
+        if not inflight:
+            time.sleep(wait)
+            continue
+        done, pending = concurrent.futures.wait(inflight, timeout=wait,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        currentts = time.time()
+        grid = state
+        changed = False
+        for future in done:
+            job = inflight.pop(future)
+            if not isinstance(job, dict):
+                try:
+                    work += future.result()[1]
+                except Exception as err:
+                    log.debug("Unable to %s - %s" % (job, err))
+                continue
+            serverstats['poll'] += 1
+            (alive, payload, rtt), elapsed = future.result()
+            work += elapsed
+            node = grid.bugindex.get(job["id"])
+            if node is None:
+                scheduler.forget(job["id"])
+                continue
+            was = node.get("alive")
+            grid.setalive(node, alive)
+            grid.recordrtt(node, rtt)
+            changed = changed or was != alive
+            scheduler.done(node["id"], alive, was is not None and was != alive, currentts)
+            if payload:
+                try:
+                    ingest.put(payload, grid)
+                except ValueError as err:
+                    log.debug("Bug list from %s ignored - %s" % (node["host"], err))
+        if changed:
+            ingest.put(False, grid)
+    pool.shutdown(wait=False)
+    sys.stderr.write('\r ! pollgridbugs Exit\n')
+
+def apipost(path, headers, body):
+    """
+    Function to route a POST request - body is None if it was too heavy
+    to read.  Returns (contenttype, message).
+    """
+    started = time.perf_counter()
+    route = path
+    message = "Error"
+    gossip = None
+    if path == '/post' and body is not None and len(shardports) > 1:
+        # Aggregator - only the worker that owns the node may ingest it
+        try:
+            shard = shardfor(headers, body)
+        except Exception:
+            shard = SHARD   # invalid - rejected below
+        if shard != SHARD:
+            return forwardpost(shard, path, headers, body)
+    if path == '/post':
+        message = '{"status": "OK"}'   
+        if body is None:
+            message = "Error: Received Heavy Payload - Ignoring"
+        else:
+            bumpstat('gossip_bytes_in', len(body))
+            try:
+                key = headers.get('key', '')
+                if key != GRIDKEY:
+                    # Rejected before it is inflated or parsed
+                    log.debug("- Unauthorized Payload from %s" % headers.get(NODEHEADER, "unknown node"))
+                    bumpstat('posts_rejected')
+                else:
+                    post_json = readpayload(body, headers.get('Content-Type'))
+                    log.debug("POST %d bytes from %s (key = %s) json: %r" % (len(body), post_json["node_id"], key, post_json))
+                    log.debug("+ Authorized Payload from %s" % post_json["node_id"])
+                    if ingest.put(post_json, state):
+                        # Acknowledge the generation we now hold
+                        message = json.dumps({"status": "OK",
+                            "generation": post_json.get("generation")})
+                    else:
+                        message = '{"status": "RESYNC"}'
+            except:
+                log.debug("Error: Invalid Payload")
+                message = "Error: Invalid Payload"
+    elif path == '/gossip':
+        message = '{"status": "OK"}'
+        if body is None:
+            message = "Error: Received Heavy Payload - Ignoring"
+        elif headers.get('key', '') != GRIDKEY:
+            message = "Error: Unauthorized Gossip"
+        else:
+            bumpstat('gossip_bytes_in', len(body))
+            try:
+                if headers.get('Content-Type') != GOSSIPTYPE:
+                    raise ValueError("Not a gossip message")
+                gossip = gossipreply(decodegossip(body), state)
+            except:
+                log.debug("Error: Invalid Gossip")
+                message = "Error: Invalid Gossip"
+    else:
+        # Error
+        route = "other"
+        message = "Error: Unsupported Request"
+
+    # Counts 
+    if "Error" in message:
+        log.debug("POST Path %s = %s" % (path, message))
+        if path == '/post' or path == '/gossip':
+            bumpstat('posts_rejected')
+    countrequest('posts', route, "Error" in message, started)
+    if gossip is not None:
+        message = encodegossip(gossip)
+        bumpstat('gossip_bytes_out', len(message))
+        return GOSSIPTYPE, message
+    return 'application/json', message
+
+def apiget(path, query, headers):
+    """
+    Function to route a GET request - returns (contenttype, message, cached)
+    where cached is a CachedResponse to send instead of message
+    """
+    started = time.perf_counter()
+    route = path
+    grid = state
+    bugs = grid.bugs
+    graph = grid.graph
+    message = "Error"
+    contenttype = 'application/json'
+    cached = None
+    result = {}  # placeholder
+    if path == '/ping' or path == '/stop':
+        message = '{"status": "OK"}'
+    elif path == '/favicon.ico':
+        contenttype = 'image/x-icon'
+        message = 'data:image/x-icon;base64,iVBORw0KGgoAAAANSUhEUgAAABAAAAAQEAYAAABPYyMiAAAABmJLR0T///////8JWPfcAAAACXBIWXMAAABIAAAASABGyWs+AAAAF0lEQVRIx2NgGAWjYBSMglEwCkbBSAcACBAAAeaR9cIAAAAASUVORK5CYII='
+    elif path == '/text':
+        # Display friendly intro
+        contenttype = 'text/html'
+        message = '<html>\n<head><meta http-equiv="refresh" content="5" />\n'
+        message += '<style>p, td, th { font-family: Helvetica, Arial, sans-serif; font-size: 10px;}</style>\n' 
+        message += '<style>h1 { font-family: Helvetica, Arial, sans-serif; font-size: 20px;}</style>\n' 
+        message += '</head>\n<body>\n<h1>GridBug %s v%s - ID %s</h1>\n\n' % (ROLE.title(), BUILD, ID)
+        if len(bugs['gridbugs']) < 1:
+            message = message + "<p>Error: No gridbug data available</p>"
+        else:
+            message = message + '<table>\n<tr><th align ="right">GridBug ID</th><th align ="right">Alive</th></tr>'
+            for i in bugs['gridbugs']:
+                if 'alive' in i:
+                    message = message + '<tr><td align ="right">%s</td><td align ="right">%s</td></tr>\n' % (i['id'],i['alive'])
+            message = message + "</table>\n"
+        message = message + '\n<p>Page refresh: %s</p>\n</body>\n</html>\n' % (
+            str(datetime.datetime.fromtimestamp(time.time())))
+    elif path == '/stats':
+        # Give Internal Stats - rendered at most once a second
+        cached = responses.get(path, int(time.time()), renderstats)
+    elif path == '/metrics':
+        # Stats and histograms for Prometheus
+        contenttype = METRICTYPE
+        message = rendermetrics()
+    elif path == '/debug/profile' or path == '/debug/memory':
+        message = apidebug(path, query, headers)
+    elif (path == '/bugs' or path == '/gridbugs.json') and 'node_id' not in bugs:
+        # Still booting - an empty list would look like a real one to peers
+        message = "Error: Bug list not loaded yet\n"
+    elif path == '/bugs' or path == '/gridbugs.json':
+        # Send only changes if the caller holds our current epoch
+        since = None
+        try:
+            if query["epoch"][0] == str(bugs.get("epoch")):
+                since = int(query["since"][0])
+                if since > bugs["generation"]:
+                    since = None
+        except (KeyError, ValueError):
+            pass
+        # Peers that can read the wire format ask for it
+        encode = json.dumps
+        if WIRETYPE in headers.get('Accept', ''):
+            contenttype = WIRETYPE
+            encode = encodebugs
+            bumpstat('gossip_compact')
+        if since is None:
+            cached = responses.get('/bugs ' + contenttype, (bugs.get("epoch"), bugs.get("generation")),
+                lambda: encode(grid.bugpayload()))
+            bumpstat('gossip_bytes_out', len(cached.body))
+            bumpstat('gossip_full')
+        else:
+            message = encode(grid.bugpayload(since))
+            bumpstat('gossip_bytes_out', len(message))
+            bumpstat('gossip_delta')
+    elif path == '/raw':
+        cached = responses.get(path, graph.version(), lambda: json.dumps(graph.todict()))
+    elif path == '/graph' and "availability" in query:
+        # Edges annotated with availability - changes with time as well
+        window = query["availability"][0]
+        if not AVAILABILITY or window not in ROLLUPNAMES:
+            message = "Error: Unknown availability window - use ?availability=%s\n" % "|".join(ROLLUPNAMES)
+        elif shardports:
+            message = rendermerged(window)
+        else:
+            cached = responses.get(path + "?availability=" + window,
+                (graph.version(), int(time.time())), lambda: rendergraph(graph, window))
+    elif path == '/graph' and shardports:
+        cached = mergedgraph()
+    elif path == '/graph':
+        cached = responses.get(path, graph.version(), lambda: rendergraph(graph))
+    elif path == '/shard':
+        # Graph of this aggregator worker's nodes for the others to merge
+        window = query.get("availability", [None])[0]
+        if headers.get('key', '') != GRIDKEY:
+            message = "Error: Unauthorized Shard Request\n"
+        elif window in ROLLUPNAMES:
+            message = rendergraph(graph, window)
+        else:
+            cached = responses.get(path, graph.version(), lambda: rendergraph(graph))
+    elif path == '/partitions':
+        # Components of the grid over green edges
+        if shardports:
+            parts, version = mergedpartitions()
+        else:
+            parts, version = graph.partitions, graph.version()
+        cached = responses.get(path, version, lambda: json.dumps(parts.summary()))
+    elif path == '/reach':
+        parts = mergedpartitions()[0] if shardports else graph.partitions
+        parts.resolve()
+        source = query.get("from", [None])[0]
+        target = query.get("to", [None])[0]
+        if (source is None and target is None) or any(
+                n is not None and n not in parts.comp for n in (source, target)):
+            message = "Error: Unknown node - use ?from=ID&to=ID\n"
+        elif source is not None and target is not None:
+            steps = parts.path(source, target)
+            message = json.dumps({"from": source, "to": target, "reachable": steps is not None,
+                "same_partition": parts.comp[source] == parts.comp[target],
+                "hops": len(steps) - 1 if steps else None, "path": steps})
+        else:
+            node = source if target is None else target
+            found = parts.reachable(node, backward=target is not None)
+            others = sorted(set(parts.comp) - found - {node})
+            if target is None:
+                message = json.dumps({"from": node, "reachable": sorted(found), "unreachable": others})
+            else:
+                message = json.dumps({"to": node, "reached_by": sorted(found), "not_reached_by": others})
+    elif path == '/latency':
+        # Our own edges come straight from the probe rings
+        result = []
+        for e in list(graph.edges.values()):
+            stats = e.latency
+            if e.source == ID and e.target in grid.latency:
+                stats = grid.latency[e.target].summary()
+            if stats is None:
+                continue
+            entry = {"id": e.id, "source": e.source, "target": e.target}
+            entry.update(stats)
+            result.append(entry)
+        message = json.dumps(result)
+    elif path == '/availability':
+        window = query.get("window", [None])[0]
+        edge = query.get("edge", [None])[0]
+        if not AVAILABILITY:
+            message = "Error: Availability is not enabled\n"
+        elif window is not None and window not in ROLLUPNAMES:
+            message = "Error: Unknown window - use ?window=%s\n" % "|".join(ROLLUPNAMES)
+        elif shardports and "local" not in query:
+            message = json.dumps(mergedavailability(window, edge))
+        elif window is None and edge is None:
+            cached = responses.get(path, (graph.version(), int(time.time())),
+                lambda: json.dumps(renderavailability(graph)))
+        else:
+            message = json.dumps(renderavailability(graph, window, edge))
+    elif path == '/history':
+        if history is None:
+            message = "Error: History is not enabled\n"
+        else:
+            try:
+                start = float(query.get("from", ["0"])[0])
+                end = float(query.get("to", [str(time.time())])[0])
+                edge = query.get("edge", [None])[0]
+                message = json.dumps(history.scan(start, end, edge))
+            except ValueError:
+                message = "Error: Invalid history query\n"
+    elif path == '/' or path == '/gridbug.html':
+        contenttype = 'text/html'
+        try:
+            cached = responses.get('/', os.path.getmtime(CONSOLE), readconsole)
+        except:
+            message = "Error: Unable to open gridbug.html"
+    elif path == '/time':
+        ts = time.time()
+        result["local_time"] = str(datetime.datetime.fromtimestamp(ts))
+        result["ts"] = ts
+        result["utc"] = str(datetime.datetime.utcfromtimestamp(ts)) 
+        delta = ts - serverstats['start']
+        result['uptime'] = str(datetime.timedelta(seconds=delta))
+        message = json.dumps(result)
+    elif path == '/clear':
+        contenttype = 'text/html'
+        log.debug("Clearing and reloading bugslist")
+        try:
+            # The old state keeps serving until the new one is published
+            loadbugs()
+            hub.publish("snapshot", rendergraph(state.graph))
+            message = "Bugs Cleared\n"
+        except:
+            message = "ERROR: Unable to Clear Bugs\n"
+    else:
+        # Error
+        route = "other"
+        message = "Error: Unsupported Request\n"
+
+    # Counts 
+    error = cached is None and isinstance(message, str) and "Error" in message
+    if error:
+        log.debug("GET Path %s = %s" % (path, message))
+    countrequest('gets', route, error, started)
+    return contenttype, message, cached
+
+def apireply(contenttype, message, cached, headers, extra=()):
+    """
+    Function to build the (status, headers, body) of a response - cached
+    responses support conditional requests and gzip.  extra headers are
+    added to it.
+    """
+    if cached is None:
+        body = message if isinstance(message, bytes) else bytes(message, "utf8")
+        return 200, [('Content-type', contenttype), ('Content-Length', str(len(body)))] + list(extra), body
+    etag = cached.etag
+    body = cached.body
+    usegzip = (len(body) >= GZIPMIN and contenttype != WIRETYPE and
+               'gzip' in headers.get('Accept-Encoding', ''))
+    if usegzip:
+        etag = etag[:-1] + '-gz"'
+    if etag in [t.strip() for t in headers.get('If-None-Match', '').split(',')]:
+        bumpstat('cache_304')
+        return 304, [('ETag', etag)], b""
+    reply = [('ETag', etag), ('Cache-Control', 'no-cache'), ('Vary', 'Accept-Encoding')]
+    if usegzip:
+        body = cached.gzip()
+        reply.append(('Content-Encoding', 'gzip'))
+    reply += [('Content-type', contenttype), ('Content-Length', str(len(body)))] + list(extra)
+    return 200, reply, body
+
+# Bug list encodings we accept, advertised on every /post reply
+POSTHEADERS = [('Accept-Post', "%s, application/json" % WIRETYPE)]
+
+def countevents():
+    countrequest('gets', '/events', False, None)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def shutdown_request(self, request):
+        # Event stream sockets are closed by the hub, not the server
+        if not hub.owns(request):
+            HTTPServer.shutdown_request(self, request)
+
+class handler(BaseHTTPRequestHandler):
+    # Persistent connections - idle clients are dropped after KEEPALIVE seconds
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE
+    # Headers and body are separate writes - do not let them wait on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if DEBUGMODE:
+            sys.stderr.write("%s - - [%s] %s\n" %
+                         (self.address_string(),
+                          self.log_date_time_string(),
+                          format%args))
+        else:
+            pass
+
+    def address_string(self):
+        # replace function to avoid lookup delays
+        host, hostport = self.client_address[:2]
+        return host
+
+    def do_POST(self):
+        content_len = int(self.headers.get('content-length', 0))
+        body = None
+        if content_len > payloadlimit(self.headers):
+            # Body is left unread so the connection can not be reused
+            self.close_connection = True
+        else:
+            body = self.rfile.read(content_len)
+        contenttype, message = apipost(self.path, self.headers, body)
+        self.reply(*apireply(contenttype, message, None, self.headers, POSTHEADERS))
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/events':
+            # Hand the connection over to the event hub
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            hub.subscribe(self.connection, snapshotevent)
+            self.close_connection = True
+            countevents()
+            return
+        contenttype, message, cached = apiget(url.path, parse_qs(url.query), self.headers)
+        self.reply(*apireply(contenttype, message, cached, self.headers))
+
+    def reply(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+def api(port):
+    """
+    API Server - Thread to listen for commands on port 
+    """
+    sys.stderr.write(" + apiServer thread - Listening on http://localhost:%d\n" % port)
+
+    with ThreadingHTTPServer(('', port), handler) as server:
+        bootphase("api_ms")
+        try:
+            # server.serve_forever()
+            while running:
+                server.handle_request()
+        except:
+            print(' CANCEL \n')
+    sys.stderr.write('\r ! apiServer Exit\n')
+
+class AsyncAPI(object):
+    """
+    Event loop HTTP/1.1 server for the API routes
+
+    One thread runs an asyncio loop that serves every client connection,
+    so a burst of posts does not start a thread per connection.  At most
+    APICONCURRENCY requests are processed at once and /clear, which
+    reloads the bug list, runs on an executor thread.
+
+    An aggregator worker shares port with the other workers and also
+    listens on shardsock, its loopback socket.
+    """
+    def __init__(self, port, shardsock=None):
+        self.port = port
+        self.shardsock = shardsock
+        self.loop = None
+        self.stopped = None
+        self.limit = None
+        self.clients = {}   # idle connection writer -> client task
+
+    def run(self):
+        """
+        API Server - Thread to run the event loop
+        """
+        sys.stderr.write(" + apiServer thread (asyncio) - Listening on http://localhost:%d\n" % self.port)
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        except:
+            print(' CANCEL \n')
+        self.loop.close()
+        sys.stderr.write('\r ! apiServer Exit\n')
+
+    def stop(self):
+        if self.loop is not None and self.stopped is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def serve(self):
+        self.stopped = asyncio.Event()
+        self.limit = asyncio.Semaphore(APICONCURRENCY)
+        server = await asyncio.start_server(self.client, port=self.port,
+            reuse_address=True, reuse_port=self.shardsock is not None, backlog=128)
+        servers = [server]
+        if self.shardsock is not None:
+            servers.append(await asyncio.start_server(self.client, sock=self.shardsock))
+        bootphase("api_ms")
+        while running and not self.stopped.is_set():
+            try:
+                await asyncio.wait_for(self.stopped.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+        # Stop listening, drop idle keep-alive connections and let
+        # requests in progress finish
+        for server in servers:
+            server.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in self.clients.values():
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=TIMEOUT)
+        for server in servers:
+            await server.wait_closed()
+
+    async def readrequest(self, reader):
+        """
+        Read a request line and headers - returns None at end of stream
+        """
+        line = await asyncio.wait_for(reader.readline(), KEEPALIVE)
+        if not line:
+            return None
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise ValueError("Bad request line")
+        raw = b""
+        while True:
+            header = await asyncio.wait_for(reader.readline(), KEEPALIVE)
+            if header in (b"\r\n", b"\n", b""):
+                break
+            raw += header
+            if len(raw) > 65536:
+                raise ValueError("Headers too long")
+        return parts[0], parts[1], parts[2], http.client.parse_headers(io.BytesIO(raw + b"\r\n"))
+
+    def head(self, status, headers, keepalive):
+        lines = ["HTTP/1.1 %d %s" % (status, http.HTTPStatus(status).phrase),
+                 "Date: %s" % email.utils.formatdate(usegmt=True)]
+        lines += ["%s: %s" % h for h in headers]
+        if not keepalive:
+            lines.append("Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+    async def client(self, reader, writer):
+        self.clients[writer] = asyncio.current_task()
+        handoff = False
+        try:
+            while running:
+                try:
+                    request = await self.readrequest(reader)
+                except ValueError:
+                    writer.write(self.head(400, [('Content-Length', '0')], False))
+                    break
+                if request is None:
+                    break
+                method, target, version, headers = request
+                connection = headers.get('Connection', '').lower()
+                keepalive = ((version == 'HTTP/1.1' and connection != 'close')
+                             or connection == 'keep-alive')
+                async with self.limit:
+                    # Only idle connections are cancelled at shutdown
+                    self.clients.pop(writer, None)
+                    url = urlsplit(target)
+                    if method == 'POST':
+                        content_len = int(headers.get('content-length', 0))
+                        body = None
+                        if content_len > payloadlimit(headers):
+                            # Body is left unread so the connection can not be reused
+                            keepalive = False
+                        else:
+                            body = await reader.readexactly(content_len)
+                        if ((shardports and shardfor(headers) != SHARD)
+                                or headers.get('Content-Type') in (WIRETYPE, GOSSIPTYPE)):
+                            # Passed on to another worker or compressed (up to
+                            # MAXINFLATE to inflate) - do not wait on the loop
+                            contenttype, message = await asyncio.get_event_loop().run_in_executor(
+                                None, apipost, target, headers, body)
+                        else:
+                            contenttype, message = apipost(target, headers, body)
+                        reply = apireply(contenttype, message, None, headers, POSTHEADERS)
+                    elif method == 'GET' and url.path == '/events':
+                        # Hand the connection over to the event hub
+                        writer.write(self.head(200, [('Content-type', 'text/event-stream'),
+                            ('Cache-Control', 'no-cache')], False))
+                        await writer.drain()
+                        hub.subscribe(writer.get_extra_info('socket').dup(), snapshotevent)
+                        countevents()
+                        handoff = True
+                        break
+                    elif method == 'GET':
+                        args = (url.path, parse_qs(url.query), headers)
+                        if (url.path == '/clear' or url.path.startswith('/debug/')
+                                or url.path == '/history'
+                                or (url.path in ('/graph', '/partitions', '/reach', '/availability') and shardports)):
+                            result = await asyncio.get_event_loop().run_in_executor(None, apiget, *args)
+                        else:
+                            result = apiget(*args)
+                        reply = apireply(*result, headers)
+                    else:
+                        reply = (501, [('Content-Length', '0')], b"")
+                        keepalive = False
+                    status, replyheaders, body = reply
+                    writer.write(self.head(status, replyheaders, keepalive) + body)
+                    await writer.drain()
+                    self.clients[writer] = asyncio.current_task()
+                if not keepalive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError,
+                ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            if handoff:
+                # The hub holds a duplicate of the socket
+                writer.transport.abort()
+            else:
+                writer.close()
+
+def bootphase(name, value=None):
+    """
+    Function to record a startup phase - ms since start unless value is given
+    """
+    if value is None:
+        value = round((time.time() - BOOTSTART) * 1000, 1)
+    serverstats['boot'][name] = value
+    log.debug("Boot %s: %r" % (name, value))
+
+def autodiscover():
+    """
+    Function to look up our public address with IPSERVICE - returns the
+    NODEURL to use or None if it could not be found
+    """
+    try:
+        ip = requests.get(IPSERVICE, timeout=TIMEOUT).content.decode('utf8').strip()
+        log.debug("Autodiscover NODEURL: %s:%s" % (ip, APIPORT))
+        return "%s:%s" % (ip, APIPORT)
+    except Exception as err:
+        sys.stderr.write(" ! WARNING: Unable to autodiscover address with %s - %s\n" % (IPSERVICE, err))
+        return None
+
+def savebugs(bugs):
+    """
+    Function to keep the last good bug list from BUGLISTURL in BUGLISTCACHE
+    """
+    if not BUGLISTCACHE:
+        return
+    # Aggregator workers all save it - each writes its own file and the
+    # replace is atomic, so a reader never sees a torn cache
+    tmp = "%s.%d.tmp" % (BUGLISTCACHE, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(bugs, f)
+        os.replace(tmp, BUGLISTCACHE)
+    except Exception as err:
+        sys.stderr.write(" ! WARNING: Unable to cache bug list in %s - %s\n" % (BUGLISTCACHE, err))
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def urlversion(r):
+    """
+    Function to identify the bug list in a response from BUGLISTURL by
+    its ETag, Last-Modified and a digest of the body
+    """
+    return (r.headers.get("ETag"), r.headers.get("Last-Modified"),
+            hashlib.sha1(r.content).hexdigest())
+
+def fetchbugs():
+    """
+    Function to read the grid bug list from GRIDBUGLIST or BUGLISTURL,
+    falling back to the copy in BUGLISTCACHE if the URL fails - returns
+    (bugs, source) and exits if no list can be loaded
+    """
+    global buglistversion
+    tried = GRIDBUGLIST
+    if BUGLISTURL != "":
+        # Load from URL
+        try:
+            r = geturl(BUGLISTURL, timeout=TIMEOUT)
+            bugs = r.json()
+            buglistversion = urlversion(r)
+            sys.stderr.write(" + Loaded [%s]: %d bugs loaded (version %d)\n" 
+                % (BUGLISTURL, len(bugs['gridbugs']), bugs['version']))
+            savebugs(bugs)
+            return bugs, "url"
+        except:
+            sys.stderr.write(" ! ERROR: Unable to load grid bug list - tried %s\n" % BUGLISTURL)
+        if not BUGLISTCACHE:
+            sys.exit()
+        tried = BUGLISTCACHE
+    # Load from local file
+    try:
+        stat = os.stat(tried)
+        with open(tried, 'r') as f:
+            bugs = json.load(f)
+            f.close()
+            if tried == GRIDBUGLIST:
+                buglistversion = (stat.st_mtime_ns, stat.st_size)
+            sys.stderr.write(" + Loaded [%s]: %d bugs loaded (version %d)\n" 
+                % (tried, len(bugs['gridbugs']), bugs['version']))
+    except:
+        sys.stderr.write(" ! ERROR: Unable to load grid bug list - tried %s\n" % tried)
+        sys.exit()
+    return bugs, "file" if tried == GRIDBUGLIST else "cache"
+
+def loadbugs(warm=False, bugs=None):
+    """
+    Function to load the grid bug list (or bugs, if given, as read by
+    fetchbugs) into a new GridState and publish it in one step - exits if
+    the list can not be loaded
+    """
+    global state
+    with reloadlock:
+        start = time.time()
+        grid = readbugs(bugs)
+        if warm and history is not None:
+            # Restore edge state from the history log
+            warmgraph(grid.graph)
+        if alerts is not None:
+            # Edges of the old graph are gone
+            alerts.forget({e.id for e in grid.graph.edges.values()})
+        state = grid
+        took = round((time.time() - start) * 1000, 1)
+        bumpstat('reloads')
+        serverstats['reload_ms'] = took
+        serverstats['reload_max_ms'] = max(took, serverstats['reload_max_ms'])
+        log.debug("Published bug list in %0.1fms" % took)
+
+def boot():
+    """
+    Function to discover our address and fetch the bug list at the same
+    time, each bounded by TIMEOUT, then publish the first GridState -
+    called once the API is already answering
+    """
+    global NODEURL
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="boot") as pool:
+        discovery = None
+        if NODEURL.lower() == "autodiscover":
+            discovery = pool.submit(autodiscover)
+        buglist = pool.submit(fetchbugs)
+        bugs, source = buglist.result()
+        bootphase("buglist_ms")
+        bootphase("buglist", source)
+        if discovery is not None:
+            found = discovery.result()
+            bootphase("discover_ms")
+            if found is None:
+                # Our entry in the list wins below - otherwise use a local address
+                try:
+                    found = "%s:%s" % (socket.gethostbyname(socket.gethostname()), APIPORT)
+                except OSError:
+                    found = "127.0.0.1:%s" % APIPORT
+            NODEURL = found
+    loadbugs(warm=True, bugs=bugs)
+    bootphase("ready_ms")
+
+def checkbugs(bugs):
+    """
+    Function to validate a grid bug list in one pass - returns the set of
+    node ids or raises ValueError
+    """
+    entries = bugs.get("gridbugs") if isinstance(bugs, dict) else None
+    if not isinstance(entries, list):
+        raise ValueError("No gridbugs list in grid bug list")
+    nodes = set()
+    for n in entries:
+        if not isinstance(n, dict) or not isinstance(n.get("id"), str) \
+                or not isinstance(n.get("host"), str):
+            raise ValueError("Invalid entry in grid bug list - %r" % (n,))
+        if len(n["id"].encode("utf8")) > HistoryLog.IDSIZE:
+            raise ValueError("ID longer than %d bytes in grid bug list (%s)" % (HistoryLog.IDSIZE, n["id"]))
+        if n["id"] in nodes:
+            raise ValueError("Found duplicates in grid bug list - IDs must be unique (%s)" % n["id"])
+        nodes.add(n["id"])
+    return nodes
+
+def readbugs(bugs=None):
+    """
+    Function to load and validate the grid bug list (or bugs, if given)
+    into a new GridState without publishing it
+    """
+    global NODEURL
+    if bugs is None:
+        bugs, source = fetchbugs()
+
+    # Validate bugs DB
+    try:
+        nodes = checkbugs(bugs)
+        if len(ID.encode("utf8")) > HistoryLog.IDSIZE:
+            raise ValueError("Node ID longer than %d bytes (%s)" % (HistoryLog.IDSIZE, ID))
+    except ValueError as err:
+        sys.stderr.write(" ! ERROR: %s\n" % err)
+        sys.exit()
+    grid = GridState(bugs)
+    if ID in nodes:
+        NODEURL = grid.bugindex[ID]["host"]    # Self Hostname of Grid Node
+
+    if ID not in nodes:
+        # We need to add ourself
+        sys.stderr.write(" * NOTICE: Adding myself to the grid bug list (%s, %s)\n" % (ID, NODEURL))
+        grid.addbug(NODEURL, ID)
+
+    # Add local identity to DB
+    bugs['node_id'] = ID
+    bugs['node_role'] = ROLE
+    bugs['node_build'] = BUILD
+    bugs['node_host'] = NODEURL
+    return grid
+
+def changedbugs():
+    """
+    Function to fetch the grid bug list if it has changed since it was
+    last read (by mtime and size of GRIDBUGLIST, or ETag, Last-Modified
+    and content of BUGLISTURL) - returns the new list or None.  A list
+    that fails validation raises ValueError and is not read again until
+    it changes.
+    """
+    global buglistversion
+    if BUGLISTURL != "":
+        headers = {}
+        if buglistversion is not None and len(buglistversion) == 3:
+            if buglistversion[0]:
+                headers["If-None-Match"] = buglistversion[0]
+            if buglistversion[1]:
+                headers["If-Modified-Since"] = buglistversion[1]
+        r = geturl(BUGLISTURL, headers=headers, timeout=TIMEOUT)
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        version = urlversion(r)
+        changed = buglistversion is None or version[2] != buglistversion[2]
+        buglistversion = version
+        if not changed:
+            return None
+        bugs = r.json()
+        checkbugs(bugs)
+        savebugs(bugs)
+        return bugs
+    stat = os.stat(GRIDBUGLIST)
+    version = (stat.st_mtime_ns, stat.st_size)
+    if version == buglistversion:
+        return None
+    # A list caught half written changes again when it is finished
+    buglistversion = version
+    with open(GRIDBUGLIST, 'r') as f:
+        bugs = json.load(f)
+    checkbugs(bugs)
+    return bugs
+
+def applybugs(grid, bugs):
+    """
+    Function to apply a changed grid bug list to grid in place - nodes
+    added to the list are polled and nodes removed from it are dropped
+    with their edges, and every other edge keeps its state.  Runs on the
+    ingest thread.
+    """
+    if grid is not state:
+        # Reloaded since the list was read
+        return
+    entries = {n["id"]: n for n in bugs["gridbugs"] if n["id"] != ID}
+    grid.removed -= set(entries)
+    added = 0
+    for host_id, n in entries.items():
+        bug = grid.bugindex.get(host_id)
+        if bug is None:
+            grid.addbug(n["host"], host_id)
+            added += 1
+        elif bug["host"] != n["host"]:
+            bug["host"] = n["host"]
+            grid.bumpgeneration(bug)
+    removed = grid.listed - set(entries) - {ID}
+    if removed:
+        grid.removebugs(removed)
+        grid.graph.removenodes(removed)
+    grid.listed = set(entries) | (grid.listed & {ID})
+    grid.graph.generation += 1
+    serverstats['buglist_updates'] += 1
+    serverstats['buglist_added'] += added
+    serverstats['buglist_removed'] += len(removed)
+    sys.stderr.write(" + Updated grid bug list: %d added, %d removed, %d bugs\n"
+        % (added, len(removed), len(grid.bugindex)))
+    if removed and not shardports and hub.subscribers:
+        # Diffs can only add - send subscribers the whole graph
+        grid.graph.takechanges()
+        hub.publish("snapshot", rendergraph(grid.graph))
+
+def watchbugs():
+    """
+    Thread to check the grid bug list for changes every BUGLISTRELOAD
+    seconds and hand a changed list to the ingest thread
+    """
+    sys.stderr.write(" + watchbugs thread\n")
+    nextcheck = time.time() + BUGLISTRELOAD
+    while running:
+        wait = nextcheck - time.time()
+        if wait > 0:
+            time.sleep(min(wait, 1))
+            continue
+        nextcheck = time.time() + BUGLISTRELOAD
+        grid = state
+        try:
+            bugs = changedbugs()
+        except ValueError as err:
+            serverstats['buglist_rejected'] += 1
+            sys.stderr.write(" ! WARNING: Ignoring changed grid bug list - %s\n" % err)
+            continue
+        except Exception as err:
+            log.debug("Unable to check grid bug list - %s" % err)
+            continue
+        if bugs is not None:
+            ingest.call(applybugs, grid, bugs)
+    sys.stderr.write('\r ! watchbugs Exit\n')
+
+# MAIN Thread
+if __name__ == "__main__":
+    bootphase("import_ms")
+
+    # Create threads
+    thread_pollgridbugs = threading.Thread(target=pollgridbugs, name="pollgridbugs")
+    if APISERVER == "thread":
+        thread_api = threading.Thread(target=api, args=(APIPORT,), name="api")
+    else:
+        asyncapi = AsyncAPI(APIPORT)
+        thread_api = threading.Thread(target=asyncapi.run, name="api")
+    thread_ingest = threading.Thread(target=ingestgraph, name="ingest")
+    thread_eventhub = threading.Thread(target=hub.run, name="eventhub")
+    thread_udpecho = threading.Thread(target=udpecho, args=(APIPORT,), name="udpecho")
+    thread_watchbugs = threading.Thread(target=watchbugs, name="watchbugs")
+    if ALERT and ALERTURL:
+        alerts = AlertDispatcher(ALERTURL)
+        thread_alerts = threading.Thread(target=alerts.run, name="alerts")
     
-    log.debug("Start Polling" )
+    # Print header
+    sys.stderr.write("GridBug %s [%s] - Node ID: %s\n" % (ROLE.title(), BUILD, ID))
+    sys.stderr.write("* Validating Configuration [%s]\n" % CONFIGFILE)
+    sys.stderr.write(" + GridBug - Debug: %s, Activate API: %s, API Port: %s\n" 
+        % (DEBUGMODE, API, APIPORT))
+    sys.stderr.write(" + GridKey: [%s]\n" % GRIDKEY)
+
+    # Data Validation and Warnings
+    if NODEURL.startswith("http:") or NODEURL.startswith("https:"):
+        NODEURL = NODEURL.replace("http://","")
+        NODEURL = NODEURL.replace("https://","")
+        sys.stderr.write(" * NOTICE: Removed http prefix from NODEURL %s.\n" % NODEURL)
+    if SERVERNODE.startswith("http:") or SERVERNODE.startswith("https:"):
+        SERVERNODE = SERVERNODE.replace("http://","")
+        SERVERNODE = SERVERNODE.replace("https://","")
+        sys.stderr.write(" * NOTICE: Removed http prefix from SERVERNODE %s.\n" % SERVERNODE)
+    if EXCHANGE == "server" and SERVERNODE == "" and ROLE != "server":
+        sys.stderr.write(" ! WARNING: EXCHANGE is server but SERVERNODE is not set - bug lists will not be shared.\n")
+
+    if ROLE == "server":
+        # Workers open their own history logs and load the bug list
+        aggregator()
+        sys.stderr.write("* Stopping\n")
+        sys.exit()
+
+    # Open history log
+    if HISTORY:
+        try:
+            history = HistoryLog(HISTORY)
+            sys.stderr.write(" + History log: %s (%d records x %d segments)\n"
+                % (HISTORY, HISTORYRECORDS, HISTORYSEGMENTS))
+        except Exception as err:
+            sys.stderr.write(" ! WARNING: Unable to open history log %s - %s\n" % (HISTORY, err))
+
+    # Answer /ping while the bug list loads - requests see an empty grid
+    sys.stderr.write("* Starting threads\n")
+    thread_api.start()
+    thread_ingest.start()
+    thread_eventhub.start()
+    if UDPECHO:
+        thread_udpecho.start()
+    if alerts is not None:
+        sys.stderr.write(" + Alerts: %s (hold %ss, batch %d, queue %d)\n"
+            % (ALERTURL, ALERTHOLD, ALERTBATCH, ALERTQUEUE))
+        thread_alerts.start()
+
     try:
+        # Discover address and load bugs - exits if there is no list
+        boot()
+        if NODEURL.startswith("localhost") or NODEURL.startswith("example.com"):
+            sys.stderr.write(" ! WARNING: Setting my NODEURL to %s may not be what you want.\n" % NODEURL)
+
+        # Start polling
+        sys.stderr.write("\nGridBug %s [%s] - Running Node ID: %s on %s\n" % (ROLE.title(), BUILD, ID, NODEURL))
+        thread_pollgridbugs.start()
+        if BUGLISTRELOAD:
+            thread_watchbugs.start()
+        sys.stderr.write(" + Started in %0.1fms (%s)\n" % (serverstats['boot']['ready_ms'],
+            ", ".join("%s %s" % (k, v) for k, v in serverstats['boot'].items() if k != 'ready_ms')))
+        sys.stderr.flush()
+
+        log.debug("Start Polling" )
         while(True):
             time.sleep(2)
     except (KeyboardInterrupt, SystemExit):
         running = False
         # Close down API thread
-        requests.get('http://localhost:%d/stop' % APIPORT)
+        if APISERVER == "thread":
+            requests.get('http://localhost:%d/stop' % APIPORT)
+        else:
+            asyncapi.stop()
         sys.stderr.write("\n")
 
+    if history is not None:
+        history.close()
     sys.stderr.write("* Stopping\n")
     sys.stderr.flush()
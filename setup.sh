@@ -90,6 +90,7 @@ echo "Starting up GridBug..."
 docker run \
 -d \
 -p 8777:8777 \
+-p 8777:8777/udp \
 -e GRIDBUGCONF='/var/lib/gridbug/gridbug.conf' \
 -e GRIDBUGLIST='/var/lib/gridbug/gridbugs.json' \
 -v ${PWD}:/var/lib/gridbug:ro \